@@ -0,0 +1,146 @@
+"""
+file: data_iterators.py
+brief: helpers to feed XGBoost with candidates read in chunks from the input trees (out-of-core training)
+"""
+
+import numpy as np  # pylint: disable=import-error
+import uproot  # pylint: disable=import-error
+import xgboost as xgb  # pylint: disable=import-error
+
+# assignment of the selected candidates
+NOT_USED = -1
+TRAIN = 0
+TEST = 1
+
+
+def get_selection_mask(df, selection, name_pt_var, pt_bin):
+    """
+    Helper method to get the mask of the candidates passing a selection in a pT bin
+
+    Parameters
+    -----------------
+    - df: pandas dataframe
+    - selection: pandas query selection
+    - name_pt_var: name of the pT column
+    - pt_bin: pT bin (same convention as TreeHandler.slice_data_frame)
+
+    Returns
+    -----------------
+    - mask: numpy boolean array
+    """
+
+    pt_values = df[name_pt_var].to_numpy()
+    return df.eval(selection).to_numpy() & (pt_values > pt_bin[0]) & (pt_values < pt_bin[1])
+
+
+# pylint: disable=too-many-arguments
+def count_selected_candidates(tree_paths, columns, chunk_size, selection, name_pt_var, pt_bins):
+    """
+    Helper method to count, reading the trees in chunks, the candidates passing a selection in each pT bin
+
+    Parameters
+    -----------------
+    - tree_paths: list of trees in uproot format (file_name:folder/tree_name)
+    - columns: list of branches to be read
+    - chunk_size: number of candidates per chunk
+    - selection: pandas query selection
+    - name_pt_var: name of the pT column
+    - pt_bins: list of pT bins
+
+    Returns
+    -----------------
+    - n_cands: numpy array with the number of selected candidates in each pT bin
+    """
+
+    n_cands = np.zeros(len(pt_bins), dtype=np.int64)
+    for df_chunk in uproot.iterate(tree_paths, columns, step_size=chunk_size, library="pd"):
+        for i_pt, pt_bin in enumerate(pt_bins):
+            n_cands[i_pt] += np.count_nonzero(get_selection_mask(df_chunk, selection, name_pt_var, pt_bin))
+
+    return n_cands
+
+
+def iterate_assigned_candidates(sources, columns, chunk_size, name_pt_var, pt_bin, target):
+    """
+    Generator over the chunks of candidates of a pT bin assigned to the training or to the test set
+
+    Parameters
+    -----------------
+    - sources: list of (tree_paths, selection, label, assignment) tuples, where assignment is
+        an int8 array with the assignment (NOT_USED, TRAIN, TEST) of each selected candidate
+    - columns: list of branches to be read
+    - chunk_size: number of candidates per chunk
+    - name_pt_var: name of the pT column
+    - pt_bin: pT bin
+    - target: assignment of the candidates to be returned (TRAIN or TEST)
+
+    Yields
+    -----------------
+    - df_chunk: pandas dataframe with the assigned candidates of the chunk
+    - label: label of the candidates
+    """
+
+    for tree_paths, selection, label, assignment in sources:
+        offset = 0
+        for df_chunk in uproot.iterate(tree_paths, columns, step_size=chunk_size, library="pd"):
+            df_chunk = df_chunk[get_selection_mask(df_chunk, selection, name_pt_var, pt_bin)]
+            assignment_chunk = assignment[offset:offset + len(df_chunk)]
+            offset += len(df_chunk)
+            df_chunk = df_chunk[assignment_chunk == target]
+            if len(df_chunk) > 0:
+                yield df_chunk, label
+
+
+class CandidateIter(xgb.DataIter):
+    """
+    XGBoost data iterator over the candidates of a pT bin assigned to the training or to the test set
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, sources, columns, training_vars, chunk_size, name_pt_var, pt_bin, target, cache_prefix=None):
+        """
+        Init method
+
+        Parameters
+        -----------------
+        - sources, columns, chunk_size, name_pt_var, pt_bin, target: see iterate_assigned_candidates
+        - training_vars: list of training variables
+        - cache_prefix: prefix of the external-memory cache files (None for an in-memory QuantileDMatrix)
+        """
+
+        self.sources = sources
+        self.columns = columns
+        self.training_vars = training_vars
+        self.chunk_size = chunk_size
+        self.name_pt_var = name_pt_var
+        self.pt_bin = pt_bin
+        self.target = target
+        self.chunks = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        """
+        Pass the next chunk of candidates to XGBoost, returning 0 when the iteration is over
+        """
+
+        if self.chunks is None:
+            self.reset()
+        try:
+            df_chunk, label = next(self.chunks)
+        except StopIteration:
+            return 0
+        input_data(
+            data=np.ascontiguousarray(df_chunk[self.training_vars].to_numpy(dtype=np.float32)),
+            label=np.full(len(df_chunk), label, dtype=np.float32),
+            feature_names=self.training_vars,
+        )
+        return 1
+
+    def reset(self):
+        """
+        Restart the iteration from the first chunk
+        """
+
+        self.chunks = iterate_assigned_candidates(
+            self.sources, self.columns, self.chunk_size, self.name_pt_var, self.pt_bin, self.target
+        )
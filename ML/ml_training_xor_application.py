@@ -1,13 +1,20 @@
 """
 file: ml_training_xor_application.py
 brief: script to run basic training XOR application using the hipe4ml package
-usage: python3 ml_training_xor_application.py --config CONFIG (--train XOR --apply)
+usage: python3 ml_training_xor_application.py --config CONFIG (--train XOR --apply XOR --plots-only)
 """
 
 import argparse
+import glob
+import multiprocessing
 import os
 import pickle
+import re
 import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from fnmatch import fnmatch
 
 import uproot
 
@@ -22,21 +29,54 @@ except ModuleNotFoundError:
 import matplotlib.pyplot as plt  # pylint: disable=import-error
 import numpy as np  # pylint: disable=import-error
 import pandas as pd  # pylint: disable=import-error
-import xgboost as xgb  # pylint: disable=import-error
+import pyarrow as pa  # pylint: disable=import-error
+import pyarrow.parquet as pq  # pylint: disable=import-error
 import yaml  # pylint: disable=import-error
-from sklearn.model_selection import \
-    train_test_split  # pylint: disable=import-error
+from tree_ensemble import TreeEnsemble
+
+try:
+    import xgboost as xgb
+    from data_iterators import (NOT_USED, TEST, TRAIN, CandidateIter,
+                                count_selected_candidates,
+                                iterate_assigned_candidates)
+    from sklearn.model_selection import cross_val_score, train_test_split
+except ModuleNotFoundError:
+    print("Modules 'xgboost' and/or 'scikit-learn' are not installed. Please install them to run the training")
+
+try:
+    import optuna
+    from optuna.study import MaxTrialsCallback
+    from optuna.trial import TrialState
+except ModuleNotFoundError:
+    print("Module 'optuna' is not installed. Please install it to run the hyper-parameters optimisation")
 
 try:
     from hipe4ml_converter.h4ml_converter import H4MLConverter
 except ModuleNotFoundError:
     print("Module 'hipe4ml_converter' is not installed. Please install it to run this macro")
 
+try:
+    import onnx
+    import onnxruntime as ort
+except ModuleNotFoundError:
+    onnx = ort = None  # the ONNX parity check of the training is skipped
+    print("Modules 'onnx' and/or 'onnxruntime' are not installed. Please install them to use the onnx backend")
+
 LABEL_BKG = 0
 LABEL_SIG = 1
 
 MAX_BKG_FRAC = 0.4  # max of bkg fraction to keep for training
 
+ML_APPLICATION = None  # MlApplication instance of the worker processes of the parallel application
+PARTITIONED_DATASET_NAME = "ModelApplied_dataset"  # name of the partitioned output dataset of the application
+PLOT_EXECUTOR = None  # plotting worker pool of the current process
+PLOT_FUTURES = []  # plotting tasks submitted by the current process
+ONNX_PARITY_N_CANDS = 1000  # number of test candidates of the ONNX vs hipe4ml parity check
+ONNX_PARITY_TOLERANCE = 1.e-4  # max difference of the ML_output of the ONNX vs hipe4ml parity check
+
+# onnxruntime session with the features in the order expected by the model (None if not known)
+OnnxModel = namedtuple("OnnxModel", ["session", "feature_names"])
+
 
 def enforce_list(x):
     """
@@ -60,6 +100,452 @@ def enforce_list(x):
     return x
 
 
+def get_vars_from_selection(selection):
+    """
+    Helper method to get the names of the variables used in a pandas query selection
+
+    Parameters
+    -----------------
+    - selection: selection string (e.g. "fM < 5.0 or fM > 5.56")
+
+    Returns
+    -----------------
+    - vars_list: list of variables used in the selection
+    """
+
+    keywords = ["and", "or", "not", "in", "True", "False", "abs"]
+    vars_list = []
+    for var in re.findall(r"[A-Za-z_]\w*", selection):
+        if var not in keywords and var not in vars_list:
+            vars_list.append(var)
+
+    return vars_list
+
+
+def get_unique_columns(*columns_lists):
+    """
+    Helper method to merge lists of columns removing duplicates and preserving the order
+
+    Parameters
+    -----------------
+    - columns_lists: lists of column names
+
+    Returns
+    -----------------
+    - columns: merged list of column names
+    """
+
+    columns = []
+    for columns_list in columns_lists:
+        for col in columns_list:
+            if col not in columns:
+                columns.append(col)
+
+    return columns
+
+
+def downcast_float64(df):
+    """
+    Helper method to convert the float64 columns of a dataframe to float32
+
+    Parameters
+    -----------------
+    - df: pandas dataframe
+
+    Returns
+    -----------------
+    - df: pandas dataframe with float32 columns instead of float64 ones
+    """
+
+    cols_float64 = df.select_dtypes(include="float64").columns
+    if len(cols_float64) > 0:
+        df[cols_float64] = df[cols_float64].astype(np.float32)
+
+    return df
+
+
+def get_optuna_storage(storage_url):
+    """
+    Helper method to get an optuna storage that can be shared by several processes
+
+    Parameters
+    -----------------
+    - storage_url: url of the database (e.g. sqlite:///path/to/optuna_study.db)
+
+    Returns
+    -----------------
+    - storage: optuna RDBStorage instance
+    """
+
+    # wait for the lock of the sqlite file instead of failing when several processes write at the same time
+    return optuna.storages.RDBStorage(storage_url, engine_kwargs={"connect_args": {"timeout": 300}})
+
+
+# pylint: disable=too-many-arguments
+def optuna_objective(trial, model_clf, x_train, y_train, hyper_pars, hyper_par_ranges, score_metric):
+    """
+    Objective function of the optuna hyper-parameters optimisation,
+    following the one of hipe4ml ModelHandler.optimize_params_optuna
+
+    Parameters
+    -----------------
+    - trial: optuna Trial instance
+    - model_clf: XGBClassifier instance
+    - x_train: pandas dataframe with the training variables of the training set
+    - y_train: labels of the training set
+    - hyper_pars: default hyper-parameters
+    - hyper_par_ranges: dict with ranges (tuples) or values (lists) of the hyper-parameters to optimise
+    - score_metric: scikit-learn scoring metric
+
+    Returns
+    -----------------
+    - score: mean cross-validation score
+    """
+
+    trial_pars = {}
+    for par, par_range in hyper_par_ranges.items():
+        if not isinstance(par_range, tuple):
+            trial_pars[par] = trial.suggest_categorical(par, par_range)
+        elif isinstance(par_range[0], int) and isinstance(par_range[1], int):
+            trial_pars[par] = trial.suggest_int(par, par_range[0], par_range[1])
+        else:
+            trial_pars[par] = trial.suggest_float(par, par_range[0], par_range[1])
+    model_clf.set_params(**{**hyper_pars, **trial_pars})
+
+    return np.mean(cross_val_score(model_clf, x_train, y_train, cv=5, scoring=score_metric))
+
+
+def run_optuna_trials(args):
+    """
+    Task running optuna trials of a study stored in a database until
+    the requested number of completed trials (or the timeout) is reached
+
+    Parameters
+    -----------------
+    - args: tuple with study name, storage url, number of trials, timeout, number of threads,
+        training set, labels, default hyper-parameters, hyper-parameters ranges and scoring metric
+    """
+
+    (study_name, storage_url, n_trials, timeout, n_jobs,
+     x_train, y_train, hyper_pars, hyper_par_ranges, score_metric) = args
+
+    study = optuna.load_study(study_name=study_name, storage=get_optuna_storage(storage_url))
+    model_clf = xgb.XGBClassifier(use_label_encoder=False)
+    study.optimize(
+        lambda trial: optuna_objective(trial, model_clf, x_train, y_train, hyper_pars, hyper_par_ranges, score_metric),
+        timeout=timeout,
+        n_jobs=n_jobs,
+        callbacks=[MaxTrialsCallback(n_trials, states=(TrialState.COMPLETE,))],
+    )
+
+
+def get_tree_paths(file_name, folder_name, tree_name):
+    """
+    Helper method to get the paths of the trees stored in the folders matching a pattern
+
+    Parameters
+    -----------------
+    - file_name: name of the input .root file
+    - folder_name: name (or wildcard pattern, e.g. DF*) of the folders containing the tree
+    - tree_name: name of the tree
+
+    Returns
+    -----------------
+    - tree_paths: list of paths of the trees inside the input file
+    """
+
+    with uproot.open(file_name) as infile:
+        folders = [key for key in infile.keys(recursive=False, cycle=False) if fnmatch(key, folder_name)]
+
+    return [f"{folder}/{tree_name}" for folder in folders]
+
+
+def get_onnx_features_file(onnx_file_name):
+    """
+    Helper method to get the file with the training columns (in the order of the model) of an onnx model
+
+    Parameters
+    -----------------
+    - onnx_file_name: name of the .onnx file
+
+    Returns
+    -----------------
+    - features_file_name: name of the .yml file next to the .onnx file
+    """
+
+    return f"{os.path.splitext(onnx_file_name)[0]}_features.yml"
+
+
+def load_onnx_model(path_model, intra_op_threads=0):
+    """
+    Helper method to load an onnx model in an onnxruntime inference session with dynamic batch size,
+    together with its training columns if saved next to the .onnx file
+
+    Parameters
+    -----------------
+    - path_model: path of the .onnx file
+    - intra_op_threads: number of threads of the session (0 -> ONNX Runtime default)
+
+    Returns
+    -----------------
+    - model: OnnxModel instance (feature_names is None if the training columns were not saved)
+    """
+
+    model_onnx = onnx.load(path_model)
+    # models are dumped with batch size 1 for O2Physics, the batch dimension is made dynamic
+    for value_info in list(model_onnx.graph.input) + list(model_onnx.graph.output):
+        if not value_info.type.HasField("tensor_type"):
+            continue
+        dims = value_info.type.tensor_type.shape.dim
+        if len(dims) > 0:
+            dims[0].dim_param = "n_cands"
+
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = intra_op_threads
+    sess_options.inter_op_num_threads = 1
+    session = ort.InferenceSession(model_onnx.SerializeToString(), sess_options, providers=["CPUExecutionProvider"])
+
+    feature_names = None
+    if os.path.isfile(get_onnx_features_file(path_model)):
+        with open(get_onnx_features_file(path_model), "r", encoding="utf-8") as file:
+            feature_names = yaml.safe_load(file)
+
+    return OnnxModel(session, feature_names)
+
+
+def predict_onnx(session, features):
+    """
+    Helper method to compute the probability of the candidates to be signal with an onnxruntime session
+
+    Parameters
+    -----------------
+    - session: onnxruntime InferenceSession instance
+    - features: float32 numpy array with shape (n_candidates, n_features), columns in the order of the model
+
+    Returns
+    -----------------
+    - ypred: numpy array with the probability of each candidate to be signal
+    """
+
+    outputs = session.run(None, {session.get_inputs()[0].name: features})
+    probs = outputs[-1]  # outputs are [label, probabilities]
+    if isinstance(probs, list):  # ZipMap output, list of {label: probability}
+        return np.array([prob[LABEL_SIG] for prob in probs], dtype=np.float32)
+    return probs[:, LABEL_SIG]
+
+
+def get_tmp_file_name(file_name):
+    """
+    Helper method to get the temporary name of an output file, hidden (dot prefix) so that
+    it is not picked up by the readers of the output directory until renamed
+
+    Parameters
+    -----------------
+    - file_name: name of the output file
+
+    Returns
+    -----------------
+    - tmp_file_name: temporary name in the same directory
+    """
+
+    return os.path.join(os.path.dirname(file_name), f".{os.path.basename(file_name)}.tmp")
+
+
+def plot_distributions(args):
+    """
+    Task drawing the distributions and the correlation matrices of the variables of each class
+
+    Parameters
+    -----------------
+    - args: tuple with list of dataframes (one per class), variables to draw,
+        labels, pT bin, output directory and extensions of the saved plots
+    """
+
+    df_list, vars_to_draw, labels, pt_bin, out_dir, extension = args
+
+    # _____________________________________________
+    plot_utils.plot_distr(
+        df_list, vars_to_draw, 100, labels, figsize=(12, 7), alpha=0.3, log=True, grid=False, density=True
+    )
+    plt.subplots_adjust(left=0.06, bottom=0.06, right=0.99, top=0.96, hspace=0.55, wspace=0.55)
+    for ext in extension:
+        plt.savefig(f"{out_dir}/DistributionsAll_pT_{pt_bin[0]}_{pt_bin[1]}.{ext}")
+    plt.close("all")
+    # _____________________________________________
+    corr_matrix_fig = plot_utils.plot_corr(df_list, vars_to_draw, labels)
+    for fig, lab in zip(corr_matrix_fig, labels):
+        plt.figure(fig.number)
+        plt.subplots_adjust(left=0.2, bottom=0.25, right=0.95, top=0.9)
+        for ext in extension:
+            fig.savefig(f"{out_dir}/CorrMatrix{lab}_pT_{pt_bin[0]}_{pt_bin[1]}.{ext}")
+    plt.close("all")
+
+
+# pylint: disable=too-many-arguments
+def plot_output_train_test(y_pred_train, y_train, y_pred_test, y_test, bins, labels, density):
+    """
+    Helper method drawing the ML output distributions of each class in the training and test sets
+    from the predictions, same style as hipe4ml.plot_utils.plot_output_train_test (binary classification)
+
+    Parameters
+    -----------------
+    - y_pred_train, y_train: predictions and labels of the training set
+    - y_pred_test, y_test: predictions and labels of the test set
+    - bins: number of bins
+    - labels: labels of the classes
+    - density: whether the distributions are normalised
+
+    Returns
+    -----------------
+    - fig: matplotlib figure
+    """
+
+    predictions = [y_pred[y_true == i_class] for y_pred, y_true in ((y_pred_train, y_train), (y_pred_test, y_test))
+                   for i_class in range(len(labels))]
+    low_high = (min(np.min(pred) for pred in predictions), max(np.max(pred) for pred in predictions))
+    colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+
+    fig = plt.figure()
+    for i_class, (color, label) in enumerate(zip(colors, labels)):
+        plt.hist(predictions[i_class], color=color, alpha=0.5, range=low_high, bins=bins,
+                 histtype="stepfilled", label=f"{label} pdf Training Set", density=density)
+        pred_test = predictions[i_class + len(labels)]
+        hist, edges = np.histogram(pred_test, bins=bins, range=low_high, density=density)
+        if density:
+            scale = len(pred_test) / sum(hist)
+            err = np.sqrt(hist * scale) / scale
+        else:
+            err = np.sqrt(hist)
+        plt.errorbar((edges[:-1] + edges[1:]) / 2, hist, yerr=err, fmt="o", c=color, label=f"{label} pdf Test Set")
+    plt.yscale("log")
+    plt.xlabel("BDT output", fontsize=13, ha="right", position=(1, 20))
+    plt.ylabel("Counts (arb. units)", fontsize=13, ha="right", position=(20, 1))
+    plt.legend(frameon=False, fontsize=12, loc="best")
+
+    return fig
+
+
+# pylint: disable=too-many-locals
+def plot_train_test(args):
+    """
+    Task drawing the ML output distributions, ROC and precision-recall curves and feature importance
+
+    Parameters
+    -----------------
+    - args: tuple with ModelHandler, labels and predictions of the training set, test features (training columns),
+        labels and predictions of the test set, labels, ROC AUC average and approach,
+        channel, pT bin, output directory and extensions of the saved plots
+    """
+
+    (model_hdl, y_train, y_pred_train, x_test, y_test, y_pred_test, labels,
+     roc_auc_average, roc_auc_approach, channel, pt_bin, out_dir, extension) = args
+
+    # _____________________________________________
+    plt.rcParams["figure.figsize"] = (10, 7)
+    fig_ml_output = plot_output_train_test(y_pred_train, y_train, y_pred_test, y_test, 80, labels, True)
+    for ext in extension:
+        fig_ml_output.savefig(f"{out_dir}/MLOutputDistr_pT_{pt_bin[0]}_{pt_bin[1]}.{ext}")
+    # _____________________________________________
+    plt.rcParams["figure.figsize"] = (10, 9)
+    fig_roc_curve = plot_utils.plot_roc(
+        y_test, y_pred_test, None, labels, roc_auc_average, roc_auc_approach
+    )
+    for ext in extension:
+        fig_roc_curve.savefig(f"{out_dir}/ROCCurveAll_pT_{pt_bin[0]}_{pt_bin[1]}.{ext}")
+    with open(f"{out_dir}/ROCCurveAll_pT_{pt_bin[0]}_{pt_bin[1]}.pkl", "wb") as file:
+        pickle.dump(fig_roc_curve, file)
+    # _____________________________________________
+    plt.rcParams["figure.figsize"] = (10, 9)
+    fig_roc_curve_tt = plot_utils.plot_roc_train_test(
+        y_test,
+        y_pred_test,
+        y_train,
+        y_pred_train,
+        None,
+        labels,
+        roc_auc_average,
+        roc_auc_approach,
+    )
+
+    fig_roc_curve_tt.savefig(f"{out_dir}/ROCCurveTrainTest_pT_{pt_bin[0]}_{pt_bin[1]}.pdf")
+    # _____________________________________________
+    precision_recall_fig = plot_utils.plot_precision_recall(y_test, y_pred_test, labels)
+    precision_recall_fig.savefig(f"{out_dir}/PrecisionRecallAll_pT_{pt_bin[0]}_{pt_bin[1]}.pdf")
+    # _____________________________________________
+    plt.rcParams["figure.figsize"] = (12, 7)
+    fig_feat_importance = plot_utils.plot_feature_imp(x_test, y_test, model_hdl, labels)
+    n_plot = 1
+    for i_fig, fig in enumerate(fig_feat_importance):
+        if i_fig < n_plot:
+            lab = ""
+            for ext in extension:
+                fig.savefig(f"{out_dir}/FeatureImportance_{lab}_{channel}.{ext}")
+        else:
+            for ext in extension:
+                fig.savefig(f"{out_dir}/FeatureImportanceAll_{channel}.{ext}")
+    plt.close("all")
+
+
+def plot_test(args):
+    """
+    Task drawing the ROC and precision-recall curves from the test set only (out-of-core training)
+
+    Parameters
+    -----------------
+    - args: tuple with labels and predictions of the test set, labels, ROC AUC average and approach,
+        pT bin, output directory and extensions of the saved plots
+    """
+
+    y_test, y_pred_test, labels, roc_auc_average, roc_auc_approach, pt_bin, out_dir, extension = args
+
+    # _____________________________________________
+    plt.rcParams["figure.figsize"] = (10, 9)
+    fig_roc_curve = plot_utils.plot_roc(y_test, y_pred_test, None, labels, roc_auc_average, roc_auc_approach)
+    for ext in extension:
+        fig_roc_curve.savefig(f"{out_dir}/ROCCurveAll_pT_{pt_bin[0]}_{pt_bin[1]}.{ext}")
+    with open(f"{out_dir}/ROCCurveAll_pT_{pt_bin[0]}_{pt_bin[1]}.pkl", "wb") as file:
+        pickle.dump(fig_roc_curve, file)
+    # _____________________________________________
+    precision_recall_fig = plot_utils.plot_precision_recall(y_test, y_pred_test, labels)
+    precision_recall_fig.savefig(f"{out_dir}/PrecisionRecallAll_pT_{pt_bin[0]}_{pt_bin[1]}.pdf")
+    plt.close("all")
+
+
+PLOT_FUNCTIONS = {"distributions": plot_distributions, "train_test": plot_train_test, "test": plot_test}
+
+
+def submit_plots(plot_name, args, max_workers):
+    """
+    Helper method to submit a plotting task to the plotting worker pool of the current process
+
+    Parameters
+    -----------------
+    - plot_name: name of the plotting task (key of PLOT_FUNCTIONS)
+    - args: tuple with the arguments of the plotting task
+    - max_workers: number of plotting worker processes
+    """
+
+    global PLOT_EXECUTOR  # pylint: disable=global-statement
+    if PLOT_EXECUTOR is None:
+        # spawn instead of fork, the parent may have already initialised the OpenMP threads of xgboost
+        PLOT_EXECUTOR = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+    PLOT_FUTURES.append(PLOT_EXECUTOR.submit(PLOT_FUNCTIONS[plot_name], args))
+
+
+def wait_for_plots():
+    """
+    Helper method to wait for the completion of the plotting tasks submitted by the current process
+    """
+
+    global PLOT_EXECUTOR  # pylint: disable=global-statement
+    for future in PLOT_FUTURES:
+        future.result()
+    PLOT_FUTURES.clear()
+    if PLOT_EXECUTOR is not None:
+        PLOT_EXECUTOR.shutdown()
+        PLOT_EXECUTOR = None
+
+
 # pylint: disable= too-few-public-methods
 class MlCommon:
     """
@@ -87,6 +573,7 @@ class MlCommon:
         # keeping mass and pT
         self.name_pt_var = config["name_pt_var"]
         self.column_to_save_list = config["column_to_save_list"]
+        self.downcast_to_float32 = config["downcast_to_float32"]
 
 
 # pylint: disable= too-many-instance-attributes, too-few-public-methods
@@ -138,8 +625,17 @@ class MlTraining(MlCommon):
         # output
         self.outdir = config_train["output"]["dir"]
         self.extension = config_train["plots"]["extension"]
+        self.plot_mode = config_train["plots"]["mode"]
+        self.plot_max_workers = config_train["plots"]["max_workers"]
         self.log_file = config_train["output"]["log_file"]
 
+        # parallelisation over pT bins
+        self.max_workers = config_train["multiprocessing"]["max_workers"]
+        self.xgb_n_jobs = config_train["multiprocessing"]["xgb_n_jobs"]
+
+        # out-of-core training
+        self.out_of_core = config_train["out_of_core"]
+
     def __check_input_consistency(self):
         """
         Helper method to check self consistency of inputs
@@ -169,6 +665,20 @@ class MlTraining(MlCommon):
         if not isinstance(self.hyper_pars_opt["hyper_par_ranges"], dict):
             print("\033[91mERROR: hyper_pars_opt_config must be defined!\033[0m")
             sys.exit()
+        if self.hyper_pars_opt["storage"] not in (None, "sqlite"):
+            print(f"\033[91mERROR: optuna storage {self.hyper_pars_opt['storage']} not supported!\033[0m")
+            sys.exit()
+        if not isinstance(self.hyper_pars_opt["n_processes"], int) or self.hyper_pars_opt["n_processes"] < 1:
+            print("\033[91mERROR: n_processes must be a positive integer!\033[0m")
+            sys.exit()
+        # multiprocessing
+        if not isinstance(self.max_workers, int) or self.max_workers < 1:
+            print("\033[91mERROR: max_workers must be a positive integer!\033[0m")
+            sys.exit()
+        # plots
+        if self.plot_mode not in ("inline", "parallel", "deferred", "none"):
+            print(f"\033[91mERROR: plot mode {self.plot_mode} not implemented\033[0m")
+            sys.exit()
 
     def __get_sliced_dfs(self):
         """
@@ -184,12 +694,26 @@ class MlTraining(MlCommon):
 
         # folders = ["DF_2262112103719808;1", "DF_2262112099588224;1", "DF_2262112099851392;1"]
 
+        # read only the branches needed for selections, training, plots and outputs
+        columns_to_read = get_unique_columns(
+            self.training_vars,
+            self.vars_to_draw,
+            self.column_to_save_list,
+            [self.name_pt_var, self.tag, "fFlagWrongCollision"],
+            get_vars_from_selection(self.filt_bkg_mass),
+        )
+
         hdl_bkg = TreeHandler(
-            file_name=self.bkg_infile_name, tree_name=self.tree_name, folder_name=self.folder_name
+            file_name=self.bkg_infile_name, tree_name=self.tree_name,
+            columns_names=columns_to_read, folder_name=self.folder_name
             ).get_subset(f"{self.tag} == 0 and ({self.filt_bkg_mass})")
         hdl_sig = TreeHandler(
-            file_name=self.sig_infile_name, tree_name=self.tree_name, folder_name=self.folder_name
+            file_name=self.sig_infile_name, tree_name=self.tree_name,
+            columns_names=columns_to_read, folder_name=self.folder_name
             ).get_subset(f"{self.tag} == 1 and fFlagWrongCollision == 0")
+        if self.downcast_to_float32:
+            hdl_bkg.set_data_frame(downcast_float64(hdl_bkg.get_data_frame()))
+            hdl_sig.set_data_frame(downcast_float64(hdl_sig.get_data_frame()))
 
         hdl_bkg.slice_data_frame(self.name_pt_var, self.pt_bins, True)
         hdl_sig.slice_data_frame(self.name_pt_var, self.pt_bins, True)
@@ -296,26 +820,154 @@ class MlTraining(MlCommon):
             sys.exit()
 
         # plots
-        df_list = [df_bkg, df_sig]
-
-        # _____________________________________________
-        plot_utils.plot_distr(
-            df_list, self.vars_to_draw, 100, self.labels, figsize=(12, 7), alpha=0.3, log=True, grid=False, density=True
+        self.__draw_plots(
+            "distributions",
+            ([df_bkg[self.vars_to_draw], df_sig[self.vars_to_draw]], self.vars_to_draw, self.labels,
+             pt_bin, out_dir, self.extension),
+            pt_bin, out_dir
         )
-        plt.subplots_adjust(left=0.06, bottom=0.06, right=0.99, top=0.96, hspace=0.55, wspace=0.55)
-        for ext in self.extension:
-            plt.savefig(f"{out_dir}/DistributionsAll_pT_{pt_bin[0]}_{pt_bin[1]}.{ext}")
-        plt.close("all")
-        # _____________________________________________
-        corr_matrix_fig = plot_utils.plot_corr(df_list, self.vars_to_draw, self.labels)
-        for fig, lab in zip(corr_matrix_fig, self.labels):
-            plt.figure(fig.number)
-            plt.subplots_adjust(left=0.2, bottom=0.25, right=0.95, top=0.9)
-            for ext in self.extension:
-                fig.savefig(f"{out_dir}/CorrMatrix{lab}_pT_{pt_bin[0]}_{pt_bin[1]}.{ext}")
 
         return train_test_data
 
+    def __optimise_stored_study(self, model_hdl, train_test_data, hyper_pars, pt_bin, out_dir):
+        """
+        Helper method for the optuna hyper-parameters optimisation with a study stored
+        in a sqlite database, which can be resumed and shared by several processes
+
+        Parameters
+        -----------------
+        - model_hdl: ModelHandler instance
+        - train_test_data: list containing train/test sets and the associated model predictions
+        - hyper_pars: default hyper-parameters
+        - pt_bin: pT bin
+        - out_dir: output directory
+        """
+
+        study_name = f"{self.channel}_pT_{pt_bin[0]}_{pt_bin[1]}"
+        storage_url = f"sqlite:///{os.path.abspath(out_dir)}/optuna_study.db"
+        study = optuna.create_study(
+            study_name=study_name, storage=get_optuna_storage(storage_url), direction="maximize", load_if_exists=True
+        )
+        n_trials_done = len(study.get_trials(deepcopy=False, states=(TrialState.COMPLETE,)))
+        print(f"Optuna study {study_name} in {storage_url}: {n_trials_done} completed trials found")
+
+        args = (study_name, storage_url, self.hyper_pars_opt["ntrials"], self.hyper_pars_opt["timeout"],
+                self.hyper_pars_opt["njobs"], train_test_data[0][self.training_vars], train_test_data[1],
+                hyper_pars, self.hyper_pars_opt["hyper_par_ranges"], self.score_metric)
+        n_processes = self.hyper_pars_opt["n_processes"]
+        if n_trials_done >= self.hyper_pars_opt["ntrials"]:
+            print("Requested number of trials already reached, optimisation not resumed")
+        elif n_processes == 1:
+            run_optuna_trials(args)
+        else:
+            with ProcessPoolExecutor(max_workers=n_processes) as executor:
+                futures = [executor.submit(run_optuna_trials, args) for _ in range(n_processes)]
+                for future in futures:
+                    future.result()
+
+        study = optuna.load_study(study_name=study_name, storage=get_optuna_storage(storage_url))
+        # best_trial is not defined without completed trials (e.g. ntrials: 0, all trials failed or pruned)
+        has_completed_trials = len(study.get_trials(deepcopy=False, states=(TrialState.COMPLETE,))) > 0
+        with open(os.path.join(out_dir, self.log_file), "a", encoding="utf-8") as file:
+            file.write(f"\nOptuna hyper-parameters optimisation (study {study_name} in {storage_url}):")
+            for trial in study.get_trials(deepcopy=False):
+                file.write(
+                    f"\n   Trial {trial.number} ({trial.state.name}): {self.score_metric} = {trial.value}, {trial.params}"
+                )
+            if has_completed_trials:
+                file.write(
+                    f"\nBest trial {study.best_trial.number}: {self.score_metric} = {study.best_value}"
+                    f"\nBest hyper-parameters: {study.best_params}"
+                )
+            else:
+                file.write("\nNo completed trial, default hyper-parameters used")
+
+        if not has_completed_trials:
+            print(f"\033[93mWARNING: no completed trial in the optuna study {study_name}, "
+                  "default hyper-parameters used!\033[0m")
+            model_hdl.set_model_params(hyper_pars)
+            return
+        model_hdl.set_model_params({**hyper_pars, **study.best_params})
+
+    def __draw_plots(self, plot_name, args, pt_bin, out_dir):
+        """
+        Helper method to draw the plots inline, in the plotting worker pool or to defer them
+
+        Parameters
+        -----------------
+        - plot_name: name of the plotting task (key of PLOT_FUNCTIONS)
+        - args: tuple with the arguments of the plotting task
+        - pt_bin: pT bin
+        - out_dir: output directory
+        """
+
+        if self.plot_mode == "inline":
+            PLOT_FUNCTIONS[plot_name](args)
+        elif self.plot_mode == "parallel":
+            submit_plots(plot_name, args, self.plot_max_workers)
+        elif self.plot_mode == "deferred":
+            with open(f"{out_dir}/DeferredPlots_{plot_name}_pT_{pt_bin[0]}_{pt_bin[1]}.pkl", "wb") as file:
+                pickle.dump({"plot_name": plot_name, "args": args}, file)
+
+    def __dump_model(self, model_hdl, pt_bin, out_dir, df_sample=None):
+        """
+        Helper method to save the model in pickle, onnx (with its training columns) and numpy formats
+
+        Parameters
+        -----------------
+        - model_hdl: ModelHandler instance
+        - pt_bin: pT bin
+        - out_dir: output directory
+        - df_sample: pandas dataframe with candidates (e.g. of the test set) used to check that
+            the onnx model gives the same ML_output as hipe4ml (None to skip the check)
+        """
+
+        if os.path.isfile(f"{out_dir}/ModelHandler_{self.channel}.pickle"):
+            os.remove(f"{out_dir}/ModelHandler_{self.channel}.pickle")
+        if os.path.isfile(f"{out_dir}/ModelHandler_onnx_{self.channel}.onnx"):
+            os.remove(f"{out_dir}/ModelHandler_onnx_{self.channel}.onnx")
+
+        model_hdl.dump_model_handler(f"{out_dir}/ModelHandler_{self.channel}" f"_pT_{pt_bin[0]}_{pt_bin[1]}.pickle")
+        model_conv = H4MLConverter(model_hdl)
+        model_conv.convert_model_onnx(1)
+        onnx_file_name = f"{out_dir}/ModelHandler_onnx_{self.channel}" f"_pT_{pt_bin[0]}_{pt_bin[1]}.onnx"
+        model_conv.dump_model_onnx(onnx_file_name)
+        with open(get_onnx_features_file(onnx_file_name), "w", encoding="utf-8") as file:
+            yaml.safe_dump(list(model_hdl.get_training_columns()), file)
+        if df_sample is not None and onnx is not None:
+            self.__check_onnx_parity(model_hdl, onnx_file_name, df_sample, out_dir)
+        TreeEnsemble.from_booster(model_hdl.get_original_model().get_booster(),
+                                  model_hdl.get_training_columns()).save(
+            f"{out_dir}/ModelHandler_numpy_{self.channel}" f"_pT_{pt_bin[0]}_{pt_bin[1]}.npz"
+        )
+
+    def __check_onnx_parity(self, model_hdl, onnx_file_name, df_sample, out_dir):
+        """
+        Helper method to check that the dumped onnx model gives the same ML_output as hipe4ml
+        on a sample of candidates, within ONNX_PARITY_TOLERANCE
+
+        Parameters
+        -----------------
+        - model_hdl: ModelHandler instance
+        - onnx_file_name: name of the dumped .onnx file
+        - df_sample: pandas dataframe with the candidates (only the first ONNX_PARITY_N_CANDS are used)
+        - out_dir: output directory
+        """
+
+        model_onnx = load_onnx_model(onnx_file_name)
+        df_sample = df_sample[model_onnx.feature_names].iloc[:ONNX_PARITY_N_CANDS]
+        ypred_hipe4ml = np.asarray(model_hdl.predict(df_sample, False), dtype=np.float64)
+        ypred_onnx = predict_onnx(model_onnx.session,
+                                  np.ascontiguousarray(df_sample.to_numpy(dtype=np.float32))).astype(np.float64)
+        max_diff = float(np.max(np.abs(ypred_onnx - ypred_hipe4ml))) if len(df_sample) > 0 else 0.
+        message = f"ONNX vs hipe4ml ML_output on {len(df_sample)} candidates: max |difference| = {max_diff:.2e}"
+        with open(os.path.join(out_dir, self.log_file), "a", encoding="utf-8") as file:
+            file.write(f"\n{message}")
+        if max_diff > ONNX_PARITY_TOLERANCE:
+            print(f"\033[91mERROR: {message} above the tolerance {ONNX_PARITY_TOLERANCE}!\033[0m")
+        else:
+            print(message)
+
     # pylint: disable=too-many-statements, too-many-branches
     def __train_test(self, train_test_data, hyper_pars, pt_bin, out_dir):
         """
@@ -333,7 +985,12 @@ class MlTraining(MlCommon):
         model_hdl = ModelHandler(model_clf, self.training_vars, hyper_pars)
 
         # hyperparams optimization
-        if self.hyper_pars_opt["activate"]:
+        if self.hyper_pars_opt["activate"] and self.hyper_pars_opt["storage"] is not None:
+            print("Performing optuna hyper-parameters optimisation: ...")
+            self.__optimise_stored_study(model_hdl, train_test_data, hyper_pars, pt_bin, out_dir)
+            print("Performing optuna hyper-parameters optimisation: Done!")
+            print(f"Optuna hyper-parameters:\n{model_hdl.get_model_params()}")
+        elif self.hyper_pars_opt["activate"]:
             print("Performing optuna hyper-parameters optimisation: ...", end="\r")
 
             with open(os.path.join(out_dir, self.log_file), "a", encoding="utf-8") as file:
@@ -383,97 +1040,253 @@ class MlTraining(MlCommon):
         test_set_df_bkg.to_parquet(f"{out_dir}/{self.channel}_ModelApplied" f"_pT_{pt_bin[0]}_{pt_bin[1]}_bkg.parquet.gzip")
 
         # save model
-        if os.path.isfile(f"{out_dir}/ModelHandler_{self.channel}.pickle"):
-            os.remove(f"{out_dir}/ModelHandler_{self.channel}.pickle")
-        if os.path.isfile(f"{out_dir}/ModelHandler_onnx_{self.channel}.onnx"):
-            os.remove(f"{out_dir}/ModelHandler_onnx_{self.channel}.onnx")
+        self.__dump_model(model_hdl, pt_bin, out_dir, train_test_data[2])
+
+        # plots, only the test features and the labels and predictions are passed (not the training set)
+        self.__draw_plots(
+            "train_test",
+            (model_hdl, np.asarray(train_test_data[1]), np.asarray(y_pred_train),
+             train_test_data[2][model_hdl.get_training_columns()], np.asarray(train_test_data[3]),
+             np.asarray(y_pred_test), self.labels, self.roc_auc_average, self.roc_auc_approach,
+             self.channel, pt_bin, out_dir, self.extension),
+            pt_bin, out_dir
+        )
 
-        model_hdl.dump_model_handler(f"{out_dir}/ModelHandler_{self.channel}" f"_pT_{pt_bin[0]}_{pt_bin[1]}.pickle")
-        model_conv = H4MLConverter(model_hdl)
-        model_conv.convert_model_onnx(1)
-        model_conv.dump_model_onnx(f"{out_dir}/ModelHandler_onnx_{self.channel}" f"_pT_{pt_bin[0]}_{pt_bin[1]}.onnx")
+    def process_pt_bin(self, i_pt, df_bkg_pt, df_sig_pt):
+        """
+        Process a single pT bin, performing data preparation,
+        training, testing, saving the model and important plots
 
-        # plots
-        # _____________________________________________
-        plt.rcParams["figure.figsize"] = (10, 7)
-        fig_ml_output = plot_utils.plot_output_train_test(
-            model_hdl, train_test_data, 80, self.raw_output, self.labels, True, density=True
+        Parameters
+        -----------------
+        - i_pt: index of the pT bin
+        - df_bkg_pt: pandas dataframe containing only background candidates of the pT bin
+        - df_sig_pt: pandas dataframe containing only signal candidates of the pT bin
+        """
+
+        pt_bin = self.pt_bins[i_pt]
+        print(f"\n\033[94mStarting ML analysis --- {pt_bin[0]} < pT < {pt_bin[1]} GeV/c\033[0m")
+
+        out_dir_pt = os.path.join(os.path.expanduser(self.outdir), f"pt{pt_bin[0]}_{pt_bin[1]}")
+        if os.path.isdir(out_dir_pt):
+            print(
+                (
+                    f"\033[93mWARNING: Output directory '{out_dir_pt}' already exists,"
+                    " overwrites possibly ongoing!\033[0m"
+                )
+            )
+        else:
+            os.makedirs(out_dir_pt, exist_ok=True)
+
+        if self.share == "all_signal":
+            bkg_factor = self.bkg_factor[i_pt]
+        else:
+            bkg_factor = None
+
+        hyper_pars = self.hyper_pars[i_pt].copy()
+        if self.xgb_n_jobs is not None:
+            hyper_pars["n_jobs"] = self.xgb_n_jobs
+
+        train_test_data = self.__data_prep(df_bkg_pt, df_sig_pt, pt_bin, out_dir_pt, bkg_factor)
+        self.__train_test(train_test_data, hyper_pars, pt_bin, out_dir_pt)
+        if self.max_workers > 1:
+            # pT bin processed in a worker process, its plots must be completed before returning
+            wait_for_plots()
+
+    # pylint: disable=too-many-locals, too-many-statements
+    def __process_out_of_core(self):
+        """
+        Helper method performing the training and testing in each pT bin feeding XGBoost
+        with data iterators over chunks of the input trees, without loading the full dataframes
+        """
+
+        chunk_size = self.out_of_core["chunk_size"]
+        cache_dir = self.out_of_core["cache_dir"]
+        if self.hyper_pars_opt["activate"]:
+            print("\033[93mWARNING: optuna optimisation not available for out-of-core training, skipped!\033[0m")
+
+        columns_to_read = get_unique_columns(
+            self.training_vars,
+            self.column_to_save_list,
+            [self.name_pt_var, self.tag, "fFlagWrongCollision"],
+            get_vars_from_selection(self.filt_bkg_mass),
         )
-        for ext in self.extension:
-            fig_ml_output.savefig(f"{out_dir}/MLOutputDistr_pT_{pt_bin[0]}_{pt_bin[1]}.{ext}")
-        # _____________________________________________
-        plt.rcParams["figure.figsize"] = (10, 9)
-        fig_roc_curve = plot_utils.plot_roc(
-            train_test_data[3], y_pred_test, None, self.labels, self.roc_auc_average, self.roc_auc_approach
+        sel_bkg = f"{self.tag} == 0 and ({self.filt_bkg_mass})"
+        sel_sig = f"{self.tag} == 1 and fFlagWrongCollision == 0"
+        tree_paths_bkg = [
+            f"{file_name}:{tree_path}" for file_name in enforce_list(self.bkg_infile_name)
+            for tree_path in get_tree_paths(file_name, self.folder_name, self.tree_name)
+        ]
+        tree_paths_sig = [
+            f"{file_name}:{tree_path}" for file_name in enforce_list(self.sig_infile_name)
+            for tree_path in get_tree_paths(file_name, self.folder_name, self.tree_name)
+        ]
+
+        print("Counting selected candidates: ...", end="\r")
+        n_bkg_avail = count_selected_candidates(
+            tree_paths_bkg, columns_to_read, chunk_size, sel_bkg, self.name_pt_var, self.pt_bins
         )
-        for ext in self.extension:
-            fig_roc_curve.savefig(f"{out_dir}/ROCCurveAll_pT_{pt_bin[0]}_{pt_bin[1]}.{ext}")
-        with open(f"{out_dir}/ROCCurveAll_pT_{pt_bin[0]}_{pt_bin[1]}.pkl", "wb") as file:
-            pickle.dump(fig_roc_curve, file)
-        # _____________________________________________
-        plt.rcParams["figure.figsize"] = (10, 9)
-        fig_roc_curve_tt = plot_utils.plot_roc_train_test(
-            train_test_data[3],
-            y_pred_test,
-            train_test_data[1],
-            y_pred_train,
-            None,
-            self.labels,
-            self.roc_auc_average,
-            self.roc_auc_approach,
+        n_sig_avail = count_selected_candidates(
+            tree_paths_sig, columns_to_read, chunk_size, sel_sig, self.name_pt_var, self.pt_bins
         )
+        print("Counting selected candidates: Done!")
 
-        fig_roc_curve_tt.savefig(f"{out_dir}/ROCCurveTrainTest_pT_{pt_bin[0]}_{pt_bin[1]}.pdf")
-        # _____________________________________________
-        precision_recall_fig = plot_utils.plot_precision_recall(train_test_data[3], y_pred_test, self.labels)
-        precision_recall_fig.savefig(f"{out_dir}/PrecisionRecallAll_pT_{pt_bin[0]}_{pt_bin[1]}.pdf")
-        # _____________________________________________
-        plt.rcParams["figure.figsize"] = (12, 7)
-        fig_feat_importance = plot_utils.plot_feature_imp(
-            train_test_data[2][train_test_data[0].columns], train_test_data[3], model_hdl, self.labels
-        )
-        n_plot = 1
-        for i_fig, fig in enumerate(fig_feat_importance):
-            if i_fig < n_plot:
-                lab = ""
-                for ext in self.extension:
-                    fig.savefig(f"{out_dir}/FeatureImportance_{lab}_{self.channel}.{ext}")
+        for i_pt, pt_bin in enumerate(self.pt_bins):
+            print(f"\n\033[94mStarting out-of-core ML analysis --- {pt_bin[0]} < pT < {pt_bin[1]} GeV/c\033[0m")
+            out_dir_pt = os.path.join(os.path.expanduser(self.outdir), f"pt{pt_bin[0]}_{pt_bin[1]}")
+            os.makedirs(out_dir_pt, exist_ok=True)
+
+            # same class balance and train/test split as __data_prep, done on index arrays
+            if self.share == "equal":
+                n_bkg = n_sig = min(n_sig_avail[i_pt], n_bkg_avail[i_pt])
+            else:
+                n_sig = n_sig_avail[i_pt]
+                n_bkg = int(min(n_bkg_avail[i_pt], n_sig * self.bkg_factor[i_pt]))
+            if not 0 < self.test_frac < 1:
+                print("ERROR: test_fraction must belong to ]0,1[")
+                sys.exit(0)
+            idx_train, idx_test = train_test_split(
+                np.arange(n_bkg + n_sig), test_size=self.test_frac, random_state=self.seed_split
+            )
+            assignment_bkg = np.full(n_bkg_avail[i_pt], NOT_USED, dtype=np.int8)
+            assignment_sig = np.full(n_sig_avail[i_pt], NOT_USED, dtype=np.int8)
+            assignment_bkg[idx_train[idx_train < n_bkg]] = TRAIN
+            assignment_bkg[idx_test[idx_test < n_bkg]] = TEST
+            assignment_sig[idx_train[idx_train >= n_bkg] - n_bkg] = TRAIN
+            assignment_sig[idx_test[idx_test >= n_bkg] - n_bkg] = TEST
+            del idx_train, idx_test
+            sources = [
+                (tree_paths_bkg, sel_bkg, LABEL_BKG, assignment_bkg),
+                (tree_paths_sig, sel_sig, LABEL_SIG, assignment_sig),
+            ]
+
+            # XGBoost matrices built chunk by chunk
+            iters = []
+            for target, suffix in zip([TRAIN, TEST], ["train", "test"]):
+                cache_prefix = None
+                if cache_dir is not None:
+                    cache_prefix = os.path.join(
+                        os.path.expanduser(cache_dir), f"cache_pT_{pt_bin[0]}_{pt_bin[1]}_{suffix}"
+                    )
+                iters.append(CandidateIter(sources, columns_to_read, self.training_vars, chunk_size,
+                                           self.name_pt_var, pt_bin, target, cache_prefix))
+            if cache_dir is None:
+                dtrain = xgb.QuantileDMatrix(iters[0])
+                dtest = xgb.QuantileDMatrix(iters[1], ref=dtrain)
             else:
-                for ext in self.extension:
-                    fig.savefig(f"{out_dir}/FeatureImportanceAll_{self.channel}.{ext}")
+                dtrain, dtest = xgb.DMatrix(iters[0]), xgb.DMatrix(iters[1])
+
+            hyper_pars = self.hyper_pars[i_pt].copy()
+            if self.xgb_n_jobs is not None:
+                hyper_pars["n_jobs"] = self.xgb_n_jobs
+            params = {"objective": "binary:logistic", "eval_metric": "auc", **hyper_pars, "tree_method": "hist"}
+            num_boost_round = params.pop("n_estimators", 100)
+            if "n_jobs" in params:
+                params["nthread"] = params.pop("n_jobs")
+            evals_result = {}
+            print("Training the model: ...", end="\r")
+            booster = xgb.train(params, dtrain, num_boost_round, evals=[(dtrain, "train"), (dtest, "test")],
+                                evals_result=evals_result, verbose_eval=False)
+            print("Training the model: Done!")
+            del dtrain, dtest
+
+            # test set predictions
+            dfs_test, df_parity = [], None
+            for df_chunk, label in iterate_assigned_candidates(
+                sources, columns_to_read, chunk_size, self.name_pt_var, pt_bin, TEST
+            ):
+                df_test_chunk = df_chunk.loc[:, self.column_to_save_list]
+                df_test_chunk["ML_output"] = booster.inplace_predict(
+                    np.ascontiguousarray(df_chunk[self.training_vars].to_numpy(dtype=np.float32)),
+                    predict_type="margin" if self.raw_output else "value"
+                )
+                df_test_chunk["Labels"] = label
+                dfs_test.append(df_test_chunk)
+                if df_parity is None:
+                    df_parity = df_chunk[self.training_vars].iloc[:ONNX_PARITY_N_CANDS]
+            test_set_df = pd.concat(dfs_test)
+            test_set_df[test_set_df["Labels"] == 1].to_parquet(
+                f"{out_dir_pt}/{self.channel}_ModelApplied" f"_pT_{pt_bin[0]}_{pt_bin[1]}_signal.parquet.gzip"
+            )
+            test_set_df[test_set_df["Labels"] == 0].to_parquet(
+                f"{out_dir_pt}/{self.channel}_ModelApplied" f"_pT_{pt_bin[0]}_{pt_bin[1]}_bkg.parquet.gzip"
+            )
+
+            # model saved through hipe4ml as for the in-memory training
+            model_clf = xgb.XGBClassifier(use_label_encoder=False, **hyper_pars)
+            model_clf.load_model(booster.save_raw("json"))
+            model_hdl = ModelHandler(model_clf, self.training_vars, hyper_pars)
+            self.__dump_model(model_hdl, pt_bin, out_dir_pt, df_parity)
+
+            with open(os.path.join(out_dir_pt, self.log_file), "w", encoding="utf-8") as file:
+                file.write(
+                    f"\nNumber of available candidates in {pt_bin[0]} < pT < {pt_bin[1]} GeV/c: \n   "
+                    f"Signal: {n_sig_avail[i_pt]}\n   Bkg: {n_bkg_avail[i_pt]}"
+                    "\nNumber of candidates used for training and testing (out-of-core): \n   "
+                    f"Signal: {n_sig}\n   Bkg: {n_bkg}\n"
+                    f"\nModel hyperparameters:\n {params}, num_boost_round: {num_boost_round}"
+                    f"\nROC AUC train: {evals_result['train']['auc'][-1]:.4f}"
+                    f"\nROC AUC test: {evals_result['test']['auc'][-1]:.4f}"
+                )
+
+            # plots (only the ones not requiring the full training set)
+            self.__draw_plots(
+                "test",
+                (test_set_df["Labels"].to_numpy(), test_set_df["ML_output"].to_numpy(), self.labels,
+                 self.roc_auc_average, self.roc_auc_approach, pt_bin, out_dir_pt, self.extension),
+                pt_bin, out_dir_pt
+            )
+
+            del test_set_df, dfs_test, assignment_bkg, assignment_sig
 
     def process(self):
         """
         Process function of the class, performing data preparation,
         training, testing, saving the model and important plots
+        for each pT bin (sequentially or in parallel worker processes)
         """
 
         self.__check_input_consistency()
-        df_bkg, df_sig = self.__get_sliced_dfs()
+        if self.out_of_core["activate"]:
+            self.__process_out_of_core()
+            wait_for_plots()
+            return
 
-        for i_pt, pt_bin in enumerate(self.pt_bins):
-            print(f"\n\033[94mStarting ML analysis --- {pt_bin[0]} < pT < {pt_bin[1]} GeV/c\033[0m")
+        df_bkg, df_sig = self.__get_sliced_dfs()
 
-            out_dir_pt = os.path.join(os.path.expanduser(self.outdir), f"pt{pt_bin[0]}_{pt_bin[1]}")
-            if os.path.isdir(out_dir_pt):
-                print(
-                    (
-                        f"\033[93mWARNING: Output directory '{out_dir_pt}' already exists,"
-                        " overwrites possibly ongoing!\033[0m"
-                    )
-                )
-            else:
-                os.makedirs(out_dir_pt)
+        if self.max_workers == 1:
+            for i_pt, _ in enumerate(self.pt_bins):
+                self.process_pt_bin(i_pt, df_bkg.get_slice(i_pt), df_sig.get_slice(i_pt))
+            wait_for_plots()
+            return
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(self.process_pt_bin, i_pt, df_bkg.get_slice(i_pt), df_sig.get_slice(i_pt))
+                for i_pt, _ in enumerate(self.pt_bins)
+            ]
+            for future in futures:
+                future.result()
+
+    def process_plots(self):
+        """
+        Process function drawing the plots deferred by a previous training
+        """
 
-            if self.share == "all_signal":
-                bkg_factor = self.bkg_factor[i_pt]
+        plot_files = sorted(glob.glob(os.path.join(os.path.expanduser(self.outdir), "pt*", "DeferredPlots_*.pkl")))
+        if len(plot_files) == 0:
+            print(f"\033[93mWARNING: no deferred plots found in {self.outdir}\033[0m")
+            return
+
+        for plot_file in plot_files:
+            print(f"Drawing deferred plots {plot_file}")
+            with open(plot_file, "rb") as file:
+                plot_task = pickle.load(file)
+            if self.plot_max_workers > 1:
+                submit_plots(plot_task["plot_name"], plot_task["args"], self.plot_max_workers)
             else:
-                bkg_factor = None
-
-            train_test_data = self.__data_prep(
-                df_bkg.get_slice(i_pt), df_sig.get_slice(i_pt), pt_bin, out_dir_pt, bkg_factor
-            )
-            self.__train_test(train_test_data, self.hyper_pars[i_pt], pt_bin, out_dir_pt)
+                PLOT_FUNCTIONS[plot_task["plot_name"]](plot_task["args"])
+        wait_for_plots()
 
 
 # pylint: disable= too-many-instance-attributes, too-few-public-methods
@@ -503,15 +1316,62 @@ class MlApplication(MlCommon):
         self.outdir = config_apply["output"]["dir"]
         self.out_tree_name = config_apply["output"]["tree_name"]
         self.data_tags = config_apply["output"]["data_tags"]
+        self.partitioned_dataset = config_apply["output"]["partitioned_dataset"]
+        self.save_root = config_apply["output"]["save_root"]
+        self.row_group_size = config_apply["output"]["row_group_size"]
+        self.chunk_size = config_apply["chunk_size"]
+        # inference backend
+        self.backend = config_apply["backend"]
+        self.onnx_model_names = enforce_list(config_apply["input"]["onnx_model_names"])
+        self.onnx_intra_op_threads = config_apply["onnx_intra_op_threads"]
+        self.numpy_model_names = enforce_list(config_apply["input"]["numpy_model_names"])
+        self.numpy_batch_size = config_apply["numpy_batch_size"]
+        self.training_vars = enforce_list(config["train_ml"]["training"]["training_vars"])
+        self.columns_to_read = None
+        # parallelisation over input files
+        self.max_workers = config_apply["multiprocessing"]["max_workers"]
+        self.max_concurrent_readers = config_apply["multiprocessing"]["max_concurrent_readers"]
+        self.model_hdls = None
+        self.read_lock = nullcontext()
 
     def __check_input_consistency(self):
         """
         Helper method to check self consistency of inputs
         """
 
-        if len(self.pt_bins) != len(self.model_names):
+        if self.backend not in ["hipe4ml", "onnx", "numpy"]:
+            print(
+                f"\033[91mERROR: backend {self.backend} not supported, choose among hipe4ml, onnx and numpy!\033[0m"
+            )
+            sys.exit()
+        if len(self.pt_bins) != len(self.__get_model_names()):
             print("\033[91mERROR: pT binning does not match the number of BDT models!\033[0m")
             sys.exit()
+        if self.chunk_size is not None and (not isinstance(self.chunk_size, int) or self.chunk_size <= 0):
+            print("\033[91mERROR: chunk_size must be a positive integer or null!\033[0m")
+            sys.exit()
+        if not isinstance(self.max_workers, int) or self.max_workers < 1:
+            print("\033[91mERROR: max_workers must be a positive integer!\033[0m")
+            sys.exit()
+        if self.max_concurrent_readers is not None and \
+                (not isinstance(self.max_concurrent_readers, int) or self.max_concurrent_readers < 1):
+            print("\033[91mERROR: max_concurrent_readers must be a positive integer or null!\033[0m")
+            sys.exit()
+
+    def __get_model_names(self):
+        """
+        Helper method to get the model files of the chosen backend
+
+        Returns
+        -----------------
+        - model_names: list of model files (one per pT bin)
+        """
+
+        if self.backend == "onnx":
+            return self.onnx_model_names
+        if self.backend == "numpy":
+            return self.numpy_model_names
+        return self.model_names
 
     def __load_models(self):
         """
@@ -519,79 +1379,438 @@ class MlApplication(MlCommon):
 
         Returns
         -----------------
-        - model_hdls: list of ModelHanlder instances
+        - model_hdls: list of ModelHanlder instances (or OnnxModel instances
+            for the onnx backend, TreeEnsemble instances for the numpy backend)
         """
+        model_names = self.__get_model_names()
         model_hdls = []
         for i_bin, _ in enumerate(self.pt_bins):
-            path_model = self.model_names[i_bin]
+            path_model = model_names[i_bin]
             if not isinstance(path_model, str):
                 print("\033[91mERROR: path to model not correctly defined!\033[0m")
                 sys.exit()
             path_model = os.path.expanduser(path_model)
             print(f"Loaded saved model: {path_model}")
+            if self.backend == "onnx":
+                model_hdls.append(self.__load_onnx_session(path_model))
+                continue
+            if self.backend == "numpy":
+                model_hdls.append(TreeEnsemble.load(path_model))
+                continue
             model_hdl = ModelHandler()
             model_hdl.load_model_handler(path_model)
             model_hdls.append(model_hdl)
         return model_hdls
 
-    def process(self):
+    def __load_onnx_session(self, path_model):
         """
-        Process function
+        Helper method to load an onnx model in an onnxruntime inference session
+
+        Parameters
+        -----------------
+        - path_model: path of the .onnx file
+
+        Returns
+        -----------------
+        - model: OnnxModel instance, with the training columns saved next to the model
+            (the training_vars of the config for models dumped without them)
         """
 
-        self.__check_input_consistency()
-        model_hdls = self.__load_models()
+        model = load_onnx_model(path_model, self.onnx_intra_op_threads)
+        if model.feature_names is None:
+            print(
+                f"\033[93mWARNING: no training columns found for {path_model}, the training_vars "
+                "of the config are used and must be in the order of the training!\033[0m"
+            )
+            model = model._replace(feature_names=self.training_vars)
 
-        for infile_name, data_tag in zip(self.infile_names, self.data_tags):
-            print(f"Loading and preparing data file {infile_name}: ...", end="\r")
-            hdl_data = TreeHandler(file_name=infile_name, tree_name=self.tree_name, folder_name=self.folder_name)
-            if self.merge_mc_with_check_decay:
-                try:
-                    hdl_data_check_decay = TreeHandler(
-                        file_name=infile_name, tree_name=self.tree_name_check_decay, folder_name=self.folder_name
-                    )
-                    cols_to_merge = ["fPdgCodeBeautyMother", "fPdgCodeCharmMother"]
-                    hdl_data.set_data_frame(pd.concat(
-                        [hdl_data.get_data_frame(), hdl_data_check_decay.get_data_frame()[cols_to_merge]],
-                        axis=1
-                    ))
-                except:
-                    print(
-                        "No deacy check tree found, only the main tree will be used for the application"
-                    )
-                    cols_to_merge = []
-            hdl_data.slice_data_frame(self.name_pt_var, self.pt_bins, True)
-            print(f"Loading and preparing data files {infile_name}: Done!")
+        n_features = model.session.get_inputs()[0].shape[1]
+        if n_features != len(model.feature_names):
+            print(
+                f"\033[91mERROR: model {path_model} expects {n_features} features, "
+                f"but {len(model.feature_names)} training variables are defined!\033[0m"
+            )
+            sys.exit()
+
+        return model
+
+    def __predict(self, model_hdl, df):
+        """
+        Helper method to compute the ML output of the candidates with the chosen backend
+
+        Parameters
+        -----------------
+        - model_hdl: ModelHandler (or OnnxModel or TreeEnsemble) instance
+        - df: pandas dataframe containing the candidates
+
+        Returns
+        -----------------
+        - ypred: numpy array with the probability of each candidate to be signal
+        """
+
+        if self.backend == "hipe4ml":
+            return model_hdl.predict(df, False)
+        if self.backend == "numpy":
+            features = np.ascontiguousarray(df[model_hdl.feature_names].to_numpy(dtype=np.float32))
+            return model_hdl.predict(features, self.numpy_batch_size)
+
+        features = np.ascontiguousarray(df[model_hdl.feature_names].to_numpy(dtype=np.float32))
+        return predict_onnx(model_hdl.session, features)
+
+    def __get_columns_to_read(self, model_hdls):
+        """
+        Helper method to get the minimal list of branches needed for the application
+
+        Parameters
+        -----------------
+        - model_hdls: list of ModelHandler (or OnnxModel or TreeEnsemble) instances
+
+        Returns
+        -----------------
+        - columns_to_read: list of branches to be read from the input trees
+        """
+
+        if self.backend == "hipe4ml":
+            training_vars = get_unique_columns(*[model_hdl.get_training_columns() for model_hdl in model_hdls])
+        else:
+            training_vars = get_unique_columns(*[model_hdl.feature_names for model_hdl in model_hdls])
 
+        return get_unique_columns([self.name_pt_var], self.column_to_save_list, training_vars)
+
+    def __iterate_chunks(self, infile_name):
+        """
+        Helper method to iterate over the input trees in chunks of at most chunk_size candidates
+
+        Parameters
+        -----------------
+        - infile_name: name of the input .root file
+
+        Yields
+        -----------------
+        - df_chunk: pandas dataframe containing a chunk of candidates
+        """
+
+        with uproot.open(infile_name) as infile:
+            for tree_path in get_tree_paths(infile_name, self.folder_name, self.tree_name):
+                tree = infile[tree_path]
+                tree_check_decay = None
+                cols_to_merge = []
+                if self.merge_mc_with_check_decay:
+                    tree_path_check_decay = tree_path.replace(self.tree_name, self.tree_name_check_decay)
+                    if tree_path_check_decay in infile:
+                        tree_check_decay = infile[tree_path_check_decay]
+                        cols_to_merge = ["fPdgCodeBeautyMother", "fPdgCodeCharmMother"]
+                    else:
+                        print(
+                            f"No deacy check tree found in {tree_path.split('/')[0]}, "
+                            "only the main tree will be used for the application"
+                        )
+                for entry_start in range(0, tree.num_entries, self.chunk_size):
+                    entry_stop = min(entry_start + self.chunk_size, tree.num_entries)
+                    with self.read_lock:
+                        df_chunk = tree.arrays(self.columns_to_read, library="pd",
+                                               entry_start=entry_start, entry_stop=entry_stop)
+                        if tree_check_decay is not None:
+                            df_chunk = pd.concat([
+                                df_chunk,
+                                tree_check_decay.arrays(cols_to_merge, library="pd",
+                                                        entry_start=entry_start, entry_stop=entry_stop)
+                            ], axis=1)
+                    if self.downcast_to_float32:
+                        df_chunk = downcast_float64(df_chunk)
+                    yield df_chunk, cols_to_merge
+
+    @staticmethod
+    def __get_partition_file(out_dir, data_tag, pt_bin, i_part=0):
+        """
+        Helper method to get the file of a data tag and pT bin in the partitioned output dataset
+
+        Parameters
+        -----------------
+        - out_dir: output directory
+        - data_tag: tag of the input dataset
+        - pt_bin: pT bin
+        - i_part: index of the part (one part per chunk in the application in chunks)
+
+        Returns
+        -----------------
+        - partition_file: name of the .parquet file
+        """
+
+        partition_dir = os.path.join(
+            out_dir, PARTITIONED_DATASET_NAME, f"data_tag={data_tag}", f"pt_bin={pt_bin[0]}_{pt_bin[1]}"
+        )
+        os.makedirs(partition_dir, exist_ok=True)
+
+        return os.path.join(partition_dir, f"part-{i_part}.parquet")
+
+    @staticmethod
+    def __remove_partition_files(partition_file):
+        """
+        Helper method to remove the files of a previous application from a partition of the output dataset
+
+        Parameters
+        -----------------
+        - partition_file: name of a .parquet file of the partition
+        """
+
+        for old_partition_file in glob.glob(os.path.join(os.path.dirname(partition_file), "part-*.parquet")):
+            os.remove(old_partition_file)
+
+    # pylint: disable=too-many-locals, too-many-branches, too-many-statements
+    def __apply_in_chunks(self, model_hdls, infile_name, data_tag, out_dir):
+        """
+        Helper method to apply the models chunk by chunk, appending the scored candidates
+        to the per-pT-bin outputs, so that the memory usage depends only on the chunk size.
+        The outputs are written with temporary names, renamed only once all the chunks are processed,
+        so that an interrupted application does not leave truncated files
+
+        Parameters
+        -----------------
+        - model_hdls: list of ModelHandler instances (one per pT bin)
+        - infile_name: name of the input .root file
+        - data_tag: tag of the input dataset used in the output file names
+        - out_dir: output directory
+        """
+
+        outfile_names = [
+            f"{out_dir}/{data_tag}_{self.channel}_pT_{pt_bin[0]}_{pt_bin[1]}_ModelApplied" for pt_bin in self.pt_bins
+        ]
+        ofiles_root = [None] * len(self.pt_bins)
+        writers_parquet = [None] * len(self.pt_bins)
+        n_chunks_written = [0] * len(self.pt_bins)
+        tmp_file_names = {}  # final name: temporary name
+        completed = False
+        try:
+            if self.save_root:
+                for ibin, outfile_name in enumerate(outfile_names):
+                    tmp_file_names[outfile_name + ".root"] = get_tmp_file_name(outfile_name + ".root")
+                    ofiles_root[ibin] = uproot.recreate(tmp_file_names[outfile_name + ".root"])
+
+            n_cands = 0
+            for df_chunk, cols_to_merge in self.__iterate_chunks(infile_name):
+                n_cands += len(df_chunk)
+                print(f"Applying ML model to {infile_name}: {n_cands} candidates processed", end="\r")
+                pt_values = df_chunk[self.name_pt_var].to_numpy()
+                for ibin, pt_bin in enumerate(self.pt_bins):
+                    # same convention as TreeHandler.slice_data_frame
+                    df_data_pt_sel = df_chunk[(pt_values > pt_bin[0]) & (pt_values < pt_bin[1])]
+                    if len(df_data_pt_sel) == 0:
+                        continue
+                    ypred = self.__predict(model_hdls[ibin], df_data_pt_sel)
+
+                    df_data_pt_sel = df_data_pt_sel.loc[:, self.column_to_save_list + cols_to_merge]
+                    df_data_pt_sel["ML_output"] = ypred
+
+                    if ofiles_root[ibin] is not None:
+                        arrays = {col: df_data_pt_sel[col].to_numpy() for col in df_data_pt_sel.columns}
+                        if n_chunks_written[ibin] == 0:
+                            ofiles_root[ibin][self.out_tree_name] = arrays
+                        else:
+                            ofiles_root[ibin][self.out_tree_name].extend(arrays)
+                        del arrays
+                    if self.partitioned_dataset:
+                        # one part per chunk, sorted by ML_output (the pT bin is the partition key)
+                        # so that the row groups span narrow ML_output ranges
+                        partition_file = self.__get_partition_file(out_dir, data_tag, pt_bin, n_chunks_written[ibin])
+                        tmp_file_names[partition_file] = get_tmp_file_name(partition_file)
+                        pq.write_table(
+                            pa.Table.from_pandas(df_data_pt_sel.sort_values("ML_output"), preserve_index=False),
+                            tmp_file_names[partition_file],
+                            compression="zstd", row_group_size=self.row_group_size, write_statistics=True
+                        )
+                    elif writers_parquet[ibin] is None:
+                        table = pa.Table.from_pandas(df_data_pt_sel, preserve_index=False)
+                        tmp_file_names[outfile_names[ibin] + ".parquet.gzip"] = get_tmp_file_name(
+                            outfile_names[ibin] + ".parquet.gzip")
+                        writers_parquet[ibin] = pq.ParquetWriter(
+                            tmp_file_names[outfile_names[ibin] + ".parquet.gzip"], table.schema)
+                        writers_parquet[ibin].write_table(table, row_group_size=self.row_group_size)
+                        del table
+                    else:
+                        table = pa.Table.from_pandas(df_data_pt_sel, preserve_index=False,
+                                                     schema=writers_parquet[ibin].schema)
+                        writers_parquet[ibin].write_table(table, row_group_size=self.row_group_size)
+                        del table
+                    n_chunks_written[ibin] += 1
+
+                    del df_data_pt_sel
+            completed = True
+        finally:
+            for ofile_root, writer_parquet in zip(ofiles_root, writers_parquet):
+                if ofile_root is not None:
+                    ofile_root.close()
+                if writer_parquet is not None:
+                    writer_parquet.close()
+            if completed and self.partitioned_dataset:
+                for pt_bin in self.pt_bins:
+                    self.__remove_partition_files(self.__get_partition_file(out_dir, data_tag, pt_bin))
+            for file_name, tmp_file_name in tmp_file_names.items():
+                if completed:
+                    os.replace(tmp_file_name, file_name)
+                elif os.path.isfile(tmp_file_name):
+                    os.remove(tmp_file_name)
+
+        for ibin, n_chunks in enumerate(n_chunks_written):
+            if n_chunks == 0:
+                print(f"\033[93mWARNING: no candidates found in {self.pt_bins[ibin]} for {infile_name}\033[0m")
+        print(f"Applying ML model to {infile_name}: {n_cands} candidates processed, Done!")
+
+    def init_worker(self, read_semaphore):
+        """
+        Method to initialise a worker process of the parallel application,
+        loading the models once per worker to be reused for all the files processed by it
+
+        Parameters
+        -----------------
+        - read_semaphore: multiprocessing Semaphore limiting the number of concurrent file readers (None for no limit)
+        """
+
+        self.model_hdls = self.__load_models()
+        if read_semaphore is not None:
+            self.read_lock = read_semaphore
+
+    def process_file(self, infile_name, data_tag):
+        """
+        Method to apply the models to a single input file
+
+        Parameters
+        -----------------
+        - infile_name: name of the input .root file
+        - data_tag: tag of the input dataset used in the output file names
+        """
+
+        if self.chunk_size is not None:
             out_dir = os.path.expanduser(self.outdir)
-            if os.path.isdir(out_dir):
-                print(
-                    (
-                        f"\033[93mWARNING: Output directory '{out_dir}' already exists,"
-                        " overwrites possibly ongoing!\033[0m"
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir, exist_ok=True)
+            self.__apply_in_chunks(self.model_hdls, infile_name, data_tag, out_dir)
+            return
+
+        print(f"Loading and preparing data file {infile_name}: ...", end="\r")
+        with self.read_lock:
+            hdl_data = TreeHandler(file_name=infile_name, tree_name=self.tree_name,
+                                   columns_names=self.columns_to_read, folder_name=self.folder_name)
+        if self.downcast_to_float32:
+            hdl_data.set_data_frame(downcast_float64(hdl_data.get_data_frame()))
+        cols_to_merge = []
+        if self.merge_mc_with_check_decay:
+            try:
+                cols_to_merge = ["fPdgCodeBeautyMother", "fPdgCodeCharmMother"]
+                with self.read_lock:
+                    hdl_data_check_decay = TreeHandler(
+                        file_name=infile_name, tree_name=self.tree_name_check_decay,
+                        columns_names=cols_to_merge, folder_name=self.folder_name
                     )
+                hdl_data.set_data_frame(pd.concat(
+                    [hdl_data.get_data_frame(), hdl_data_check_decay.get_data_frame()[cols_to_merge]],
+                    axis=1
+                ))
+            except:
+                print(
+                    "No deacy check tree found, only the main tree will be used for the application"
                 )
-            else:
-                os.makedirs(out_dir)
-            print("Applying ML model to dataframes: ...", end="\r")
-            for ibin, pt_bin in enumerate(self.pt_bins):
-                df_data_pt_sel = hdl_data.get_slice(ibin)
-                ypred = model_hdls[ibin].predict(df_data_pt_sel, False)
+                cols_to_merge = []
+        hdl_data.slice_data_frame(self.name_pt_var, self.pt_bins, True)
+        print(f"Loading and preparing data files {infile_name}: Done!")
+
+        out_dir = os.path.expanduser(self.outdir)
+        if os.path.isdir(out_dir):
+            print(
+                (
+                    f"\033[93mWARNING: Output directory '{out_dir}' already exists,"
+                    " overwrites possibly ongoing!\033[0m"
+                )
+            )
+        else:
+            os.makedirs(out_dir, exist_ok=True)
+        print("Applying ML model to dataframes: ...", end="\r")
+        for ibin, pt_bin in enumerate(self.pt_bins):
+            df_data_pt_sel = hdl_data.get_slice(ibin)
+            ypred = self.__predict(self.model_hdls[ibin], df_data_pt_sel)
 
-                df_data_pt_sel = df_data_pt_sel.loc[:, self.column_to_save_list + cols_to_merge]
-                df_data_pt_sel["ML_output"] = ypred
+            df_data_pt_sel = df_data_pt_sel.loc[:, self.column_to_save_list + cols_to_merge]
+            df_data_pt_sel["ML_output"] = ypred
 
-                outfile_name = f"{out_dir}/{data_tag}_{self.channel}_pT_{pt_bin[0]}_{pt_bin[1]}_ModelApplied"
+            outfile_name = f"{out_dir}/{data_tag}_{self.channel}_pT_{pt_bin[0]}_{pt_bin[1]}_ModelApplied"
+            if self.save_root:
                 outfile_name_root = outfile_name + ".root"
                 with uproot.recreate(outfile_name_root) as ofile:
                     ofile[self.out_tree_name] = df_data_pt_sel
+            if self.partitioned_dataset:
+                self.__remove_partition_files(self.__get_partition_file(out_dir, data_tag, pt_bin))
+                pq.write_table(
+                    pa.Table.from_pandas(
+                        df_data_pt_sel.sort_values("ML_output"), preserve_index=False
+                    ),
+                    self.__get_partition_file(out_dir, data_tag, pt_bin),
+                    compression="zstd", row_group_size=self.row_group_size, write_statistics=True
+                )
+            else:
                 outfile_name_parquet = outfile_name + ".parquet.gzip"
                 df_data_pt_sel.to_parquet(outfile_name_parquet)
 
-                del df_data_pt_sel
+            del df_data_pt_sel
+
+    def process(self):
+        """
+        Process function
+        """
+
+        self.__check_input_consistency()
+        model_hdls = self.__load_models()
+        self.columns_to_read = self.__get_columns_to_read(model_hdls)
+
+        if self.max_workers == 1:
+            self.model_hdls = model_hdls
+            for infile_name, data_tag in zip(self.infile_names, self.data_tags):
+                self.process_file(infile_name, data_tag)
+            return
+
+        # the models are loaded again by each worker in init_worker
+        del model_hdls
+        read_semaphore = None
+        if self.max_concurrent_readers is not None:
+            read_semaphore = multiprocessing.Semaphore(self.max_concurrent_readers)
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_application_worker,
+                                 initargs=(self, read_semaphore)) as executor:
+            futures = [
+                executor.submit(apply_to_file, (infile_name, data_tag))
+                for infile_name, data_tag in zip(self.infile_names, self.data_tags)
+            ]
+            for future in futures:
+                future.result()
+
+
+def init_application_worker(ml_application, read_semaphore):
+    """
+    Initializer of the worker processes of the parallel application
+
+    Parameters
+    -----------------
+    - ml_application: MlApplication instance
+    - read_semaphore: multiprocessing Semaphore limiting the number of concurrent file readers (None for no limit)
+    """
+
+    global ML_APPLICATION  # pylint: disable=global-statement
+    ML_APPLICATION = ml_application
+    ML_APPLICATION.init_worker(read_semaphore)
+
+
+def apply_to_file(args):
+    """
+    Task of the parallel application, applying the models of the worker to a single input file
 
+    Parameters
+    -----------------
+    - args: tuple with input file name and data tag
+    """
 
-def main(cfg, train):
+    infile_name, data_tag = args
+    ML_APPLICATION.process_file(infile_name, data_tag)
+
+
+def main(cfg, train, plots_only=False):
     """
     Main function
 
@@ -600,9 +1819,13 @@ def main(cfg, train):
     - cfg: dictionary with config read from a yaml file
 
     - train: boolean implying ML training&testing (if true) or application (if false)
+
+    - plots_only: boolean implying only the drawing of the plots deferred by a previous training
     """
 
-    if train:
+    if plots_only:
+        MlTraining(cfg).process_plots()
+    elif train:
         MlTraining(cfg).process()
     else:  # if we do not train, we apply
         MlApplication(cfg).process()
@@ -614,6 +1837,8 @@ if __name__ == "__main__":
                         help="yaml config file for BDT training and application", required=True)
     parser.add_argument("--train", help="perform only training and testing", action="store_true")
     parser.add_argument("--apply", help="perform only application", action="store_true")
+    parser.add_argument("--plots-only", help="draw only the plots deferred by a previous training",
+                        action="store_true")
     args = parser.parse_args()
 
     print("Loading configuration: ...", end="\r")
@@ -624,8 +1849,8 @@ if __name__ == "__main__":
     if args.train and args.apply:
         print("\033[91mERROR: Both --train and --apply options are activated, choose only one.\033[0m")
         sys.exit()
-    elif not args.train and not args.apply:
+    elif not args.train and not args.apply and not args.plots_only:
         print("\033[91mERROR: None of --train or --apply options are activated, choose (only) one.\033[0m")
         sys.exit()
 
-    main(configuration, args.train)
+    main(configuration, args.train, args.plots_only)
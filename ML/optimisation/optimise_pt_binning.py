@@ -0,0 +1,278 @@
+"""
+Script to search for the pT binning and the BDT score cuts maximising the expected significance
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import uproot
+import yaml
+
+sys.path.append('../../utils')
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+from df_utils import read_parquet_in_batches
+from scan_bdt_score import (enforce_trailing_slash, get_labeled_dfs, get_integrated_luminosity,
+                            get_acc_eff_presel, get_cumulative_mass_histograms,
+                            get_expected_background_from_histograms)
+
+
+def get_fine_histograms(df_mc_sig, df_data, fine_pt_edges, selections, mass_edges):
+    """
+    Helper method to fill once the fine (pT, ML_output, mass) histograms used by the optimisation
+
+    Parameters
+    -----------------
+    - df_mc_sig: pandas.DataFrame
+        MC signal dataframe
+
+    - df_data: pandas.DataFrame
+        Real data dataframe
+
+    - fine_pt_edges: list(float)
+        Edges of the fine pT bins
+
+    - selections: list(float)
+        Cuts on the BDT output score in ascending order
+
+    - mass_edges: numpy.array
+        Edges of the invariant-mass bins
+
+    Returns
+    -----------------
+    - hists: dict
+        Cumulative (over pT) histograms with a leading axis of size (number of fine bins + 1):
+        "n_sig_tot" (MC signal candidates), "n_sig", "sum_mass", "sum_mass2" (MC signal candidates
+        passing each cut and moments of their mass) and "counts_data" (data mass histograms for each cut)
+    """
+    n_fine, n_sels, n_bins = len(fine_pt_edges) - 1, len(selections), len(mass_edges) - 1
+    hists = {
+        "n_sig_tot": np.zeros(n_fine),
+        "n_sig": np.zeros((n_fine, n_sels)),
+        "sum_mass": np.zeros((n_fine, n_sels)),
+        "sum_mass2": np.zeros((n_fine, n_sels)),
+        "counts_data": np.zeros((n_fine, n_sels, n_bins)),
+    }
+    for i_pt, (pt_min, pt_max) in enumerate(zip(fine_pt_edges[:-1], fine_pt_edges[1:])):
+        df_mc_sig_pt = df_mc_sig.query(f"{pt_min} < fPt < {pt_max}")
+        df_data_pt = df_data.query(f"{pt_min} < fPt < {pt_max}")
+
+        # MC signal: candidates and mass moments passing each cut
+        n_passed = np.searchsorted(selections, df_mc_sig_pt["ML_output"].to_numpy(), side="left")
+        masses = df_mc_sig_pt["fM"].to_numpy()
+        hists["n_sig_tot"][i_pt] = len(df_mc_sig_pt)
+        for key, weights in zip(["n_sig", "sum_mass", "sum_mass2"], [None, masses, masses**2]):
+            counts = np.bincount(n_passed, weights=weights, minlength=n_sels + 1)[1:]
+            hists[key][i_pt] = np.cumsum(counts[::-1])[::-1]
+
+        hists["counts_data"][i_pt] = get_cumulative_mass_histograms(
+            df_data_pt["fM"].to_numpy(), df_data_pt["ML_output"].to_numpy(), selections, mass_edges)
+
+    # cumulative sums over the fine pT bins, the content of a merged bin is then a difference
+    for key, hist in hists.items():
+        hists[key] = np.concatenate([np.zeros((1,) + hist.shape[1:]), np.cumsum(hist, axis=0)])
+
+    return hists
+
+
+def get_merged_bin_significance(hists, exp_sig_fine, i_low, i_high, mass_edges, sidebands_regions,
+                                bkg_func, n_sigma_signal_region):
+    """
+    Helper method to get the expected significance of all the cuts for the pT bin
+    obtained by merging the fine bins from i_low to i_high (excluded)
+
+    Parameters
+    -----------------
+    - hists: dict
+        Cumulative histograms from get_fine_histograms
+
+    - exp_sig_fine: numpy.array
+        Expected signal for each fine pT bin and cut
+
+    - i_low, i_high: int
+        Indices of the first and last (excluded) fine pT bin
+
+    - mass_edges: numpy.array
+        Edges of the invariant-mass bins
+
+    - sidebands_region: list(list((float))
+        The fitting range for sidebands (leftband + rightband)
+
+    - bkg_func: str
+        Name of the bkg pdf (expo or chebpolN)
+
+    - n_sigma_signal_region: float
+        Half width of the signal region in units of the width of the MC signal peak
+
+    Returns
+    -----------------
+    - exp_signif: numpy.array
+        Expected significance for each cut (0 if not available)
+    """
+    def merged(key):
+        return hists[key][i_high] - hists[key][i_low]
+
+    n_sig = merged("n_sig")
+    valid = n_sig > 1
+    n_sig_safe = np.where(valid, n_sig, 1.)
+    mean = merged("sum_mass") / n_sig_safe
+    sigma = np.sqrt(np.maximum(merged("sum_mass2") / n_sig_safe - mean**2, 0.))
+    signal_regions = np.stack([mean - n_sigma_signal_region * sigma, mean + n_sigma_signal_region * sigma], axis=-1)
+    signal_regions[~valid] = [mass_edges[0], mass_edges[1]]  # dummy region, the cut is discarded anyway
+
+    exp_bkg, _ = get_expected_background_from_histograms(merged("counts_data"), mass_edges,
+                                                         sidebands_regions, signal_regions, bkg_func)
+    exp_sig = np.sum(exp_sig_fine[i_low:i_high], axis=0)
+    valid &= (exp_bkg > 0) & (exp_sig > 0)
+
+    return np.where(valid, exp_sig / np.sqrt(np.where(valid, exp_sig + exp_bkg, 1.)), 0.)
+
+
+def find_optimal_binning(signif_max, min_signif, max_merged_bins):
+    """
+    Helper method to find with dynamic programming the partition of the fine pT bins maximising
+    the summed expected significance with a minimum significance in each pT bin
+
+    Parameters
+    -----------------
+    - signif_max: dict
+        Maximum expected significance (over the cuts) of each merged bin, keyed by (i_low, i_high)
+
+    - min_signif: float
+        Minimum expected significance in each pT bin
+
+    - max_merged_bins: int
+        Maximum number of fine bins merged in a pT bin
+
+    Returns
+    -----------------
+    - bin_limits: list(tuple(int, int))
+        Indices (i_low, i_high) of the fine bins of each optimal pT bin, empty if no partition satisfies the constraint
+    """
+    n_fine = max(i_high for _, i_high in signif_max)
+    best = np.full(n_fine + 1, -np.inf)
+    best[0] = 0.
+    previous = np.full(n_fine + 1, -1)
+    for i_high in range(1, n_fine + 1):
+        for i_low in range(max(0, i_high - max_merged_bins), i_high):
+            signif = signif_max[(i_low, i_high)]
+            if signif < min_signif or best[i_low] == -np.inf:
+                continue
+            if best[i_low] + signif > best[i_high]:
+                best[i_high] = best[i_low] + signif
+                previous[i_high] = i_low
+
+    if best[n_fine] == -np.inf:
+        return []
+    bin_limits, i_high = [], n_fine
+    while i_high > 0:
+        bin_limits.append((previous[i_high], i_high))
+        i_high = previous[i_high]
+
+    return bin_limits[::-1]
+
+
+def optimise(config):
+    """
+    Main method for the pT-binning optimisation
+
+    Parameter
+    -----------------
+    - config: dict
+        Configuration from the YAML file
+    """
+    cfg_binning = config["pt_binning_optimisation"]
+    fine_pt_edges = cfg_binning["fine_pt_edges"]
+    n_fine = len(fine_pt_edges) - 1
+    selections = np.arange(cfg_binning["ML_selections"]["min"],
+                           cfg_binning["ML_selections"]["max"] + 0.1 * cfg_binning["ML_selections"]["step"],
+                           cfg_binning["ML_selections"]["step"]).tolist()
+    bkg_func = cfg_binning["bkg_func"]
+    if bkg_func != "expo" and not bkg_func.startswith("chebpol"):
+        print("\033[91mERROR: only expo or chebpolN bkg pdfs supported for the pT-binning optimisation!\033[0m")
+        sys.exit()
+    outdir = enforce_trailing_slash(config["output"]["outdir"])
+    os.makedirs(outdir, exist_ok=True)
+
+    # expected signal over pT bin width and (acceptance times efficiency) at the centre of the fine bins
+    with uproot.open(config["inputs"]["fonll"]["file_name"])[config["inputs"]["fonll"]["graph_name"]] as graph:
+        fonll_pt, fonll_values = graph.values(axis="x"), graph.values(axis="y")
+    int_lumi = get_integrated_luminosity(config["inputs"]["zorro"]["file_names"],
+                                         config["inputs"]["zorro"]["folder_name"],
+                                         config["inputs"]["zorro"]["triggers_of_interest"],
+                                         config["inputs"]["zorro"]["h_collisions_path"],
+                                         config["inputs"]["zorro"]["tvx_cross_section"],
+                                         config["inputs"]["zorro"]["index_file"])
+    br = config["channel"]["br"]["b0_todminuspi"] * config["channel"]["br"]["dplus_tokpipi"]
+    pt_centres = (np.array(fine_pt_edges[:-1]) + np.array(fine_pt_edges[1:])) / 2
+    pt_widths = np.diff(fine_pt_edges)
+    exp_sig_over_acceff = (2 * config["inputs"]["fonll"]["frag_frac"] * br * int_lumi
+                           * np.interp(pt_centres, fonll_pt, fonll_values) * pt_widths)
+    acc_eff_presel, _, acc_eff_bins = get_acc_eff_presel(config["inputs"]["acc_eff_presel"]["file_name"],
+                                                         config["inputs"]["acc_eff_presel"]["hist_name"])
+    acc_eff_presel = np.asarray(acc_eff_presel)[np.digitize(pt_centres, acc_eff_bins) - 1]
+
+    # fine histograms, filled once
+    print("Filling fine (pT, ML_output, mass) histograms: ...", end="\r")
+    _, df_mc_sig = get_labeled_dfs(config["inputs"]["mc"]["file_names"])
+    df_data = pd.concat(
+        [read_parquet_in_batches(parquet) for parquet in config["inputs"]["real_data"]["file_names"]])
+    mass_limits = config["fit_bkg"]["mass_limits_for_fit"]
+    mass_range_to_exclude = config["fit_bkg"]["mass_range_to_exclude"]
+    mass_edges = np.linspace(mass_limits[0], mass_limits[1], config["fit_bkg"]["nbins"] + 1)
+    sidebands_regions = [[mass_limits[0], mass_range_to_exclude[0]], [mass_range_to_exclude[1], mass_limits[1]]]
+    hists = get_fine_histograms(df_mc_sig, df_data, fine_pt_edges, selections, mass_edges)
+    del df_mc_sig, df_data
+    print("Filling fine (pT, ML_output, mass) histograms: Done!")
+
+    # expected signal of each fine bin for all the cuts
+    n_sig_tot = np.diff(hists["n_sig_tot"])
+    eff_bdt = np.diff(hists["n_sig"], axis=0) / np.where(n_sig_tot > 0, n_sig_tot, 1.)[:, np.newaxis]
+    exp_sig_fine = (exp_sig_over_acceff * acc_eff_presel)[:, np.newaxis] * eff_bdt
+
+    # best cut of all the merged bins
+    max_merged_bins = cfg_binning["max_merged_bins"]
+    signif_max, best_sel = {}, {}
+    for i_high in range(1, n_fine + 1):
+        for i_low in range(max(0, i_high - max_merged_bins), i_high):
+            exp_signif = get_merged_bin_significance(hists, exp_sig_fine, i_low, i_high, mass_edges,
+                                                     sidebands_regions, bkg_func,
+                                                     cfg_binning["n_sigma_signal_region"])
+            i_best = int(np.argmax(exp_signif))
+            signif_max[(i_low, i_high)] = float(exp_signif[i_best])
+            best_sel[(i_low, i_high)] = selections[i_best]
+
+    bin_limits = find_optimal_binning(signif_max, cfg_binning["min_signif"], max_merged_bins)
+    if not bin_limits:
+        print(f"\033[91mERROR: no pT binning with expected significance > {cfg_binning['min_signif']}"
+              " in all the pT bins!\033[0m")
+        sys.exit()
+
+    results = {"pt": {"mins": [], "maxs": []}, "ML_output": [], "expected_significance": []}
+    for i_low, i_high in bin_limits:
+        results["pt"]["mins"].append(float(fine_pt_edges[i_low]))
+        results["pt"]["maxs"].append(float(fine_pt_edges[i_high]))
+        results["ML_output"].append(float(best_sel[(i_low, i_high)]))
+        results["expected_significance"].append(signif_max[(i_low, i_high)])
+        print(f"{fine_pt_edges[i_low]:.1f} < pT < {fine_pt_edges[i_high]:.1f}: "
+              f"ML_output > {best_sel[(i_low, i_high)]:.3f}, expected significance {signif_max[(i_low, i_high)]:.2f}")
+
+    output_file_name = outdir + config["channel"]["name"] + "_" + cfg_binning["output_file_name"]
+    with open(output_file_name, "w", encoding="utf-8") as ofile:
+        yaml.dump(results, ofile, default_flow_style=None, sort_keys=False)
+    print(f"Optimal pT binning saved in {output_file_name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Arguments")
+    parser.add_argument("--config", "-c", metavar="text", default="config_scan.yml",
+                        help="yaml config file for BDT score scan", required=True)
+    args = parser.parse_args()
+
+    print("Loading configuration: ...", end="\r")
+    with open(args.config, "r", encoding="utf-8") as yml_cfg:
+        configuration = yaml.load(yml_cfg, yaml.FullLoader)
+    print("Loading configuration: Done!")
+    optimise(configuration)
@@ -3,10 +3,14 @@ Script to scan B-meson BDT score and compute relevant quantities to optimise sel
 """
 
 import argparse
+import multiprocessing
 import os
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
+from numpy.polynomial import chebyshev
 import pandas as pd
 import matplotlib.pyplot as plt
 import uproot
@@ -16,11 +20,24 @@ from hist import Hist
 sys.path.append('../../utils')
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
 from df_utils import read_parquet_in_batches
+from fit_cache import FitCache, get_fit_key
+from template_pool import CorrelatedBkgTemplatePool
 from analysis_utils import get_n_events_from_zorro
+from lumi_utils import load_lumi_index, get_n_events_from_index
+from task_journal import TaskJournal, get_inputs_hash, get_task_key
 from flarefly.data_handler import DataHandler
 from flarefly.fitter import F2MassFitter
 import zfit
 
+SCAN_DFS_PER_PT = None  # dataframes of each pT bin used by the scan_point tasks
+# default initial values and limits of the parameters of the sideband fits (bkg index, name, value, limits)
+BKG_INIT_PARS = [
+    (0, "frac", 0.2, [0., 1.]),
+    (1, "lam", -1.2, [-10., 10.]),
+    (1, "c1", -0.05, [-0.2, 0.]),
+    (1, "c2", 0.008, [0.000, 0.03]),
+]
+
 # TODO currently, the script assumes that the input distributions have the same pT binning as the one defined in
 # the configuration file !
 
@@ -142,7 +159,8 @@ def get_integrated_luminosity(
               zorro_folder,
               triggers_of_interest_names,
               h_collisions_path,
-              tvx_cross_section
+              tvx_cross_section,
+              index_file=None
         ):
     """
     Helper method to get the integrated luminosity
@@ -164,17 +182,24 @@ def get_integrated_luminosity(
     - tvx_cross_section: float
         TVX cross section
 
+    - index_file: str
+        Parquet file with the per-run index of the input files (None to read the Zorro folders)
+
     Returns
     -----------------
     - int_lumi: float
         Integrated luminosity
     """
-    n_events = get_n_events_from_zorro(
-        infile_names,
-        zorro_folder,
-        triggers_of_interest_names,
-        h_collisions_path
-        )
+    if index_file is not None:
+        df_index = load_lumi_index(infile_names, zorro_folder, h_collisions_path, index_file=index_file)
+        n_events = get_n_events_from_index(df_index, triggers_of_interest_names)
+    else:
+        n_events = get_n_events_from_zorro(
+            infile_names,
+            zorro_folder,
+            triggers_of_interest_names,
+            h_collisions_path
+            )
     int_lumi = float(n_events) / tvx_cross_section
     return int_lumi
 
@@ -278,7 +303,36 @@ def get_acc_eff_presel(file_name, hist_name):
     return values, uncs, bins
 
 
-def get_signal_region(df_mc_sig, fit_limits, nbins, pt_bin, sel, pdg_code, verbosity=None):
+def get_bdt_efficiency(sorted_scores, selections):
+    """
+    Helper method to get the BDT efficiency and its binomial uncertainty for an array of BDT score cuts
+
+    Parameters
+    -----------------
+    - sorted_scores: numpy.array
+        BDT output scores of the MC signal candidates sorted in ascending order
+
+    - selections: list(float) or numpy.array
+        Cuts on the BDT output score (candidates with score > cut are selected)
+
+    Returns
+    -----------------
+    - first_selected_idx: numpy.array
+        Index of the first selected candidate in sorted_scores for each cut
+
+    - eff, eff_unc: numpy.array, numpy.array
+        BDT efficiencies and their binomial uncertainties
+    """
+    n_tot = len(sorted_scores)
+    first_selected_idx = np.searchsorted(sorted_scores, selections, side="right")
+    eff = (n_tot - first_selected_idx) / n_tot
+    eff_unc = np.sqrt(eff * (1 - eff) / n_tot)
+
+    return first_selected_idx, eff, eff_unc
+
+
+# pylint: disable=too-many-arguments
+def get_signal_region(df_mc_sig, fit_limits, nbins, pt_bin, sel, pdg_code, verbosity=None, cache_dir=None):
     """
     Helper method to get B(3sigma) from sidebands
 
@@ -305,11 +359,25 @@ def get_signal_region(df_mc_sig, fit_limits, nbins, pt_bin, sel, pdg_code, verbo
     - verbosity: int
         Verbosity level (from 0 to 10) Default value to 0
 
+    - cache_dir: str
+        Directory of the cache of the MC signal fits (None to always perform the fit)
+
     Returns
     -----------------
     - signal_region: list(float)
-        The region of the signal peak [mu - 3sigma, mu + 3sigma]
+        The region of the signal peak [mu - 3sigma, mu + 3sigma] (None if the fit did not converge)
     """
+    # the fit is identified by the fitted masses and the fit settings, not by the pT bin and the cut,
+    # the non-converged fits are cached as well so that they are not repeated
+    fit_cache = FitCache(cache_dir)
+    fit_key = get_fit_key(df_mc_sig["fM"].to_numpy(), model="gaussian", fit_limits=fit_limits, nbins=nbins,
+                          pdg_code=pdg_code, sigma_init=[0.03, 0.01, 0.08])
+    fit_result = fit_cache.load(fit_key)
+    if fit_result is not None:
+        if not fit_result["converged"]:
+            return None
+        return [fit_result["mu"] - 3 * fit_result["sigma"], fit_result["mu"] + 3 * fit_result["sigma"]]
+
     data_hdl_mc = DataHandler(df_mc_sig,
                               var_name="fM",
                               limits=fit_limits,
@@ -322,9 +390,12 @@ def get_signal_region(df_mc_sig, fit_limits, nbins, pt_bin, sel, pdg_code, verbo
     fitter.set_signal_initpar(0, "sigma", 0.03, limits=[0.01, 0.08])
     fitter.set_particle_mass(0, pdg_id=pdg_code)
     result = fitter.mass_zfit()
-    if result.converged:
-        mu, _ = fitter.get_mass(0)
-        sigma, _ = fitter.get_sigma(0)
+    if not result.converged:
+        fit_cache.save(fit_key, {"converged": False})
+        return None
+    mu, _ = fitter.get_mass(0)
+    sigma, _ = fitter.get_sigma(0)
+    fit_cache.save(fit_key, {"mu": mu, "sigma": sigma, "converged": True})
 
     signal_region = [mu - 3 * sigma, mu + 3 * sigma]
     return signal_region
@@ -342,7 +413,8 @@ def get_expected_background_from_sidebands(
         sel,
         outdir_name,
         df_mc_prd_bkg=None,
-        verbosity=None):
+        verbosity=None,
+        init_pars=None):
     """
     Helper method to get B(3sigma) from sidebands
 
@@ -381,10 +453,17 @@ def get_expected_background_from_sidebands(
     - verbosity: int
         Verbosity level (from 0 to 10) Default value to 0
 
+    - init_pars: dict
+        Initial values of the bkg parameters {(bkg index, parameter name): value}, e.g. the converged
+        parameters of the fit with the neighbouring BDT score cut. Default values of BKG_INIT_PARS if None
+
     Returns
     -----------------
     - exp_bkg, exp_bkg_unc: (float, float)
         Expected background and its uncertainty in the signal region
+
+    - converged_pars: dict
+        Converged values of the bkg parameters {(bkg index, parameter name): value}, None if the fit did not converge
     """
     data_hdl = DataHandler(df_data,
                            var_name="fM",
@@ -408,15 +487,22 @@ def get_expected_background_from_sidebands(
     if df_mc_prd_bkg is not None:
         fitter.set_background_kde(0, data_hdl_prd_bkg)
 
-    fitter.set_background_initpar(0, "frac", 0.2, limits=[0., 1.])
-    fitter.set_background_initpar(1, "lam", -1.2, limits=[-10., 10.])
-    fitter.set_background_initpar(1, "c1", -0.05, limits=[-0.2, 0.])
-    fitter.set_background_initpar(1, "c2", 0.008, limits=[0.000, 0.03])
+    for idx, par_name, init_value, limits in BKG_INIT_PARS:
+        if init_pars is not None and (idx, par_name) in init_pars:
+            init_value = min(max(init_pars[(idx, par_name)], limits[0]), limits[1])
+        fitter.set_background_initpar(idx, par_name, init_value, limits=limits)
     result = fitter.mass_zfit()
 
     exp_bkg, exp_bkg_unc = 0., 0.
+    converged_pars = None
     if result.converged:
         exp_bkg, exp_bkg_unc = fitter.get_background(min=signal_region[0], max=signal_region[1])
+        converged_pars = {}
+        for idx, par_name, _, _ in BKG_INIT_PARS:
+            try:
+                converged_pars[(idx, par_name)], _ = fitter.get_background_parameter(idx, par_name)
+            except (KeyError, IndexError):  # parameter not present in the chosen bkg pdfs
+                continue
 
         fig, _ = fitter.plot_mass_fit(
             style="ATLAS",
@@ -425,7 +511,289 @@ def get_expected_background_from_sidebands(
             show_extra_info=False)
         fig.savefig(f"{outdir_name}sidebands_fit_pT_{pt_bin[0]:.0f}_{pt_bin[1]:.0f}_ML_cut_{1000*sel:.0f}.pdf")
 
-    return exp_bkg, exp_bkg_unc
+    return exp_bkg, exp_bkg_unc, converged_pars
+
+
+def get_cumulative_mass_histograms(masses, scores, selections, mass_edges):
+    """
+    Helper method to get the invariant-mass histograms of the candidates passing each BDT score cut
+    with a single pass over the candidates
+
+    Parameters
+    -----------------
+    - masses: numpy.array
+        Invariant masses of the candidates
+
+    - scores: numpy.array
+        BDT output scores of the candidates
+
+    - selections: list(float)
+        Cuts on the BDT output score in ascending order (candidates with score > cut are selected)
+
+    - mass_edges: numpy.array
+        Edges of the invariant-mass bins
+
+    Returns
+    -----------------
+    - counts: numpy.array
+        Histogram contents with shape (number of cuts, number of mass bins)
+    """
+    n_sels, n_bins = len(selections), len(mass_edges) - 1
+    # number of cuts passed by each candidate and invariant-mass bin
+    n_passed = np.searchsorted(selections, scores, side="left")
+    mass_bin = np.searchsorted(mass_edges, masses, side="right") - 1
+    mask = (n_passed > 0) & (mass_bin >= 0) & (mass_bin < n_bins)
+    counts = np.bincount((n_passed[mask] - 1) * n_bins + mass_bin[mask], minlength=n_sels * n_bins)
+    counts = counts.reshape(n_sels, n_bins)
+
+    # candidates passing the cut i pass also all the looser ones
+    return np.cumsum(counts[::-1], axis=0)[::-1].astype(np.float64)
+
+
+def get_chebyshev_integrals(edges_low, edges_high, mass_limits, degree):
+    """
+    Helper method to get the integrals of the Chebyshev polynomials T_0, ..., T_degree
+    (defined in the invariant-mass range mass_limits) in invariant-mass intervals
+
+    Parameters
+    -----------------
+    - edges_low, edges_high: numpy.array
+        Lower and upper edges of the invariant-mass intervals (any shape)
+
+    - mass_limits: list(float)
+        Invariant-mass range mapped to [-1, 1]
+
+    - degree: int
+        Degree of the Chebyshev polynomial
+
+    Returns
+    -----------------
+    - integrals: numpy.array
+        Integrals with shape edges_low.shape + (degree + 1,)
+    """
+    half_width = (mass_limits[1] - mass_limits[0]) / 2
+    x_low = (np.asarray(edges_low) - mass_limits[0]) / half_width - 1
+    x_high = (np.asarray(edges_high) - mass_limits[0]) / half_width - 1
+    integrals = np.empty(x_low.shape + (degree + 1,))
+    for deg in range(degree + 1):
+        antiderivative = chebyshev.chebint(np.eye(degree + 1)[deg])
+        integrals[..., deg] = (chebyshev.chebval(x_high, antiderivative)
+                               - chebyshev.chebval(x_low, antiderivative)) * half_width
+
+    return integrals
+
+
+def get_bkg_model(bkg_func, mass_limits):
+    """
+    Helper method to get the background model (integrals in invariant-mass intervals and their derivatives)
+    for the analytic sideband fits
+
+    Parameters
+    -----------------
+    - bkg_func: str
+        Name of the bkg pdf (expo or chebpolN)
+
+    - mass_limits: list(float)
+        Full invariant-mass range of the fit
+
+    Returns
+    -----------------
+    - model: function
+        Function of (pars, edges_low, edges_high) returning the integrals and their derivatives w.r.t. the pars,
+        pars with shape (number of cuts, number of parameters), edges broadcastable to (number of cuts, number of bins)
+
+    - n_pars: int
+        Number of parameters of the model
+    """
+    if bkg_func == "expo":
+        def model(pars, edges_low, edges_high):
+            norm, lam = np.exp(pars[:, 0:1]), pars[:, 1:2]
+            lam = np.where(np.abs(lam) < 1.e-9, 1.e-9, lam)
+            exp_low, exp_high = np.exp(lam * edges_low), np.exp(lam * edges_high)
+            integrals = norm * (exp_high - exp_low) / lam
+            deriv_lam = norm * (edges_high * exp_high - edges_low * exp_low) / lam - integrals / lam
+            return integrals, np.stack([integrals, deriv_lam], axis=-1)
+        return model, 2
+
+    degree = int(bkg_func.replace("chebpol", ""))
+    def model(pars, edges_low, edges_high):  # pylint: disable=function-redefined
+        cheb_integrals = get_chebyshev_integrals(edges_low, edges_high, mass_limits, degree)
+        integrals = np.sum(cheb_integrals * pars[:, np.newaxis, :], axis=-1)
+        return integrals, np.broadcast_to(cheb_integrals, integrals.shape + (degree + 1,))
+    return model, degree + 1
+
+
+def fit_sidebands_analytic(counts, edges_low, edges_high, model, pars_init, max_iter=100, tol=1.e-6):
+    """
+    Helper method to perform binned Poisson likelihood fits of the sidebands for all the BDT score cuts
+    at the same time (Fisher scoring with step halving)
+
+    Parameters
+    -----------------
+    - counts: numpy.array
+        Sideband histogram contents with shape (number of cuts, number of bins)
+
+    - edges_low, edges_high: numpy.array
+        Lower and upper edges of the sideband bins
+
+    - model: function
+        Background model from get_bkg_model
+
+    - pars_init: numpy.array
+        Initial parameters with shape (number of cuts, number of parameters)
+
+    - max_iter: int
+        Maximum number of iterations
+
+    - tol: float
+        Tolerance on the change of the negative log-likelihood
+
+    Returns
+    -----------------
+    - pars, cov, converged: numpy.array, numpy.array, numpy.array
+        Fitted parameters, their covariance matrices and convergence flags of each fit
+    """
+    def get_nll(mu):
+        valid = np.all(mu > 0, axis=1)
+        mu = np.where(mu > 0, mu, 1.)
+        return np.where(valid, np.sum(mu - counts * np.log(mu), axis=1), np.inf)
+
+    pars = pars_init.copy()
+    mu, jac = model(pars, edges_low, edges_high)
+    nll = get_nll(mu)
+    converged = np.zeros(len(pars), dtype=bool)
+    for _ in range(max_iter):
+        grad = np.einsum("cb,cbp->cp", 1 - counts / mu, jac)
+        fisher = np.einsum("cb,cbp,cbq->cpq", 1 / mu, jac, jac) + 1.e-12 * np.eye(pars.shape[1])
+        step = np.linalg.solve(fisher, grad[..., np.newaxis])[..., 0]
+        step[converged] = 0.
+        scale = np.ones(len(pars))
+        for _ in range(30):
+            new_pars = pars - scale[:, np.newaxis] * step
+            new_nll = get_nll(model(new_pars, edges_low, edges_high)[0])
+            worse = new_nll > nll + 1.e-12
+            if not np.any(worse):
+                break
+            scale = np.where(worse, scale / 2, scale)
+        accepted = new_nll <= nll + 1.e-12
+        pars = np.where(accepted[:, np.newaxis], new_pars, pars)
+        converged |= accepted & (np.abs(nll - new_nll) < tol)
+        nll = np.where(accepted, new_nll, nll)
+        mu, jac = model(pars, edges_low, edges_high)
+        if np.all(converged):
+            break
+
+    fisher = np.einsum("cb,cbp,cbq->cpq", 1 / mu, jac, jac) + 1.e-12 * np.eye(pars.shape[1])
+    return pars, np.linalg.inv(fisher), converged
+
+
+# pylint: disable=too-many-arguments
+def get_expected_background_analytic(
+        df_data,
+        selections,
+        full_inv_mass_region,
+        sidebands_regions,
+        signal_regions,
+        nbins,
+        bkg_func):
+    """
+    Helper method to get B(3sigma) from binned Poisson fits of the sidebands with expo or Chebyshev
+    bkg pdfs and closed-form integrals, vectorised over all the BDT score cuts
+
+    Parameters
+    -----------------
+    - df_data: pandas.DataFrame
+        Dataframe containing real data
+
+    - selections: list(float)
+        Cuts on the BDT output score in ascending order
+
+    - full_inv_mass_region: list(float)
+        The full fitting range considered (sidebands + excluded region under the expected signal peak)
+
+    - sidebands_region: list(list((float))
+        The fitting range for sidebands (leftband + rightband)
+
+    - signal_regions: list(list(float))
+        Signal region determined by a fit of MC signal for each cut
+
+    - nbins: int
+        Number of bins in the full fitting range
+
+    - bkg_func: str
+        Name of the bkg pdf (expo or chebpolN)
+
+    Returns
+    -----------------
+    - exp_bkg, exp_bkg_unc: (numpy.array, numpy.array)
+        Expected background and its uncertainty in the signal region for each cut (0 if the fit did not converge)
+    """
+    mass_edges = np.linspace(full_inv_mass_region[0], full_inv_mass_region[1], nbins + 1)
+    counts = get_cumulative_mass_histograms(df_data["fM"].to_numpy(), df_data["ML_output"].to_numpy(),
+                                            selections, mass_edges)
+
+    return get_expected_background_from_histograms(counts, mass_edges, sidebands_regions, signal_regions, bkg_func)
+
+
+def get_expected_background_from_histograms(counts, mass_edges, sidebands_regions, signal_regions, bkg_func):
+    """
+    Helper method to get B(3sigma) from binned Poisson fits of the sidebands of invariant-mass histograms
+    with expo or Chebyshev bkg pdfs, vectorised over all the BDT score cuts
+
+    Parameters
+    -----------------
+    - counts: numpy.array
+        Invariant-mass histogram contents for each cut with shape (number of cuts, number of mass bins)
+
+    - mass_edges: numpy.array
+        Edges of the invariant-mass bins (full fitting range)
+
+    - sidebands_region: list(list((float))
+        The fitting range for sidebands (leftband + rightband)
+
+    - signal_regions: list(list(float))
+        Signal region for each cut (None if the MC signal fit did not converge)
+
+    - bkg_func: str
+        Name of the bkg pdf (expo or chebpolN)
+
+    Returns
+    -----------------
+    - exp_bkg, exp_bkg_unc: (numpy.array, numpy.array)
+        Expected background and its uncertainty in the signal region for each cut
+        (0 if the fit did not converge or the signal region is not available)
+    """
+    full_inv_mass_region = [mass_edges[0], mass_edges[-1]]
+    n_sels = len(counts)
+    mass_centres = (mass_edges[:-1] + mass_edges[1:]) / 2
+    in_sidebands = np.zeros(len(mass_centres), dtype=bool)
+    for sideband in sidebands_regions:
+        in_sidebands |= (mass_centres > sideband[0]) & (mass_centres < sideband[1])
+    counts = counts[:, in_sidebands]
+    edges_low, edges_high = mass_edges[:-1][in_sidebands], mass_edges[1:][in_sidebands]
+
+    # initial parameters: flat background with the sideband normalisation
+    model, n_pars = get_bkg_model(bkg_func, full_inv_mass_region)
+    n_sidebands = np.maximum(counts.sum(axis=1), 1.e-3)
+    width_sidebands = np.sum(edges_high - edges_low)
+    pars_init = np.zeros((n_sels, n_pars))
+    if bkg_func == "expo":
+        pars_init[:, 0] = np.log(n_sidebands / width_sidebands)
+    else:
+        pars_init[:, 0] = n_sidebands / width_sidebands
+
+    pars, cov, converged = fit_sidebands_analytic(counts, edges_low, edges_high, model, pars_init)
+
+    # the cuts without signal region are skipped
+    has_signal_region = np.array([signal_region is not None for signal_region in signal_regions])
+    signal_regions = np.asarray([signal_region if signal_region is not None else full_inv_mass_region
+                                 for signal_region in signal_regions])
+    integrals, jac = model(pars, signal_regions[:, 0:1], signal_regions[:, 1:2])
+    exp_bkg = integrals[:, 0]
+    exp_bkg_unc = np.sqrt(np.einsum("cp,cpq,cq->c", jac[:, 0, :], cov, jac[:, 0, :]))
+    converged &= (counts.sum(axis=1) > 0) & has_signal_region
+
+    return np.where(converged, exp_bkg, 0.), np.where(converged, exp_bkg_unc, 0.)
 
 
 def get_expected_significance(exp_sig, exp_sig_unc, exp_bkg, exp_bkg_unc):
@@ -459,6 +827,182 @@ def get_expected_significance(exp_sig, exp_sig_unc, exp_bkg, exp_bkg_unc):
 
     return exp_signif, exp_signif_unc
 
+
+def init_scan_worker(dfs_per_pt, zfit_cpus):
+    """
+    Initializer of the processes performing the fits of the scan
+
+    Parameter
+    -----------------
+    - dfs_per_pt: list(tuple)
+        MC signal (sorted by BDT score) and real data dataframes and correlated-bkg template pool
+        (None without templates) of each pT bin
+
+    - zfit_cpus: dict
+        Intra- and inter-op number of threads of zfit for each worker (None to keep the current ones)
+    """
+    global SCAN_DFS_PER_PT  # pylint: disable=global-statement
+    SCAN_DFS_PER_PT = dfs_per_pt
+    if zfit_cpus is not None:
+        zfit.run.set_cpus_explicit(intra=zfit_cpus["intra"], inter=zfit_cpus["inter"])
+
+
+# pylint: disable=too-many-locals
+def scan_point(args):
+    """
+    Task performing the fits of a (pT bin, BDT score cut) point of the scan
+
+    Parameter
+    -----------------
+    - args: tuple
+        pT bin index, cut index, BDT score cut, index of the first selected MC signal candidate,
+        pT bin, bkg pdfs, fit_bkg configuration, sidebands fit directory, PDG code
+        and initial values of the bkg parameters (None for the default ones)
+
+    Returns
+    -----------------
+    - i_pt, i_sel, exp_bkg, exp_bkg_unc, converged_pars: (int, int, float, float, dict)
+        Indices of the point, expected background, its uncertainty and converged bkg parameters
+    """
+    (i_pt, i_sel, bdt_sel, first_selected_idx, pt_bin,
+     bkg_funcs, config_fit, sidebands_fit_dir, pdg_code, init_pars) = args
+    df_mc_sig_pt, df_data_pt, template_pool_pt = SCAN_DFS_PER_PT[i_pt]
+    df_mc_sig_pt_sel = df_mc_sig_pt.iloc[first_selected_idx:]
+    leftband_range = [config_fit["mass_limits_for_fit"][0], config_fit["mass_range_to_exclude"][0]]
+    rightband_range = [config_fit["mass_range_to_exclude"][1], config_fit["mass_limits_for_fit"][1]]
+
+    # expected bkg
+    signal_region = get_signal_region(df_mc_sig_pt_sel,
+                                      config_fit["mass_limits_for_fit"],
+                                      config_fit["nbins"],
+                                      pt_bin,
+                                      i_sel,
+                                      pdg_code,
+                                      verbosity=config_fit["verbosity"],
+                                      cache_dir=config_fit["mc_fit_cache_dir"])
+    if signal_region is None:
+        print(f"\033[93mWARNING: MC signal fit for {pt_bin[0]:.0f} < pT < {pt_bin[1]:.0f} and "
+              f"ML_output > {bdt_sel:.3f} not converged, point skipped\033[0m")
+        return i_pt, i_sel, 0., 0., None
+
+    df_for_template_bkg_sampled = None
+    if config_fit["use_bkg_templ"]:
+        # weighted average of the correlated backgrounds passing the cut
+        den_norm = len(df_mc_sig_pt_sel) * config_fit["signal_br"]["pdg"] / config_fit["signal_br"]["sim"]
+        df_for_template_bkg_sampled, _ = template_pool_pt.get_template(den_norm, score_range=[bdt_sel, None])
+
+    exp_bkg, exp_bkg_unc, converged_pars = get_expected_background_from_sidebands(
+        df_data_pt.query(f"ML_output > {bdt_sel}"),
+        config_fit["mass_limits_for_fit"],
+        [leftband_range, rightband_range],
+        signal_region,
+        config_fit["nbins"],
+        bkg_funcs.copy(),
+        pt_bin,
+        bdt_sel,
+        sidebands_fit_dir,
+        df_mc_prd_bkg=df_for_template_bkg_sampled,
+        verbosity=config_fit["verbosity"],
+        init_pars=init_pars)
+    print(f"Fits for {pt_bin[0]:.0f} < pT < {pt_bin[1]:.0f} and ML_output > {bdt_sel:.3f}: Done!")
+
+    return i_pt, i_sel, exp_bkg, exp_bkg_unc, converged_pars
+
+
+def get_signal_region_point(args):
+    """
+    Task performing the MC signal fit of a (pT bin, BDT score cut) point of the scan
+
+    Parameter
+    -----------------
+    - args: tuple
+        Same arguments as scan_point (without initial bkg parameters)
+
+    Returns
+    -----------------
+    - i_pt, i_sel, signal_region: (int, int, list(float))
+        Indices of the point and signal region
+    """
+    i_pt, i_sel, _, first_selected_idx, pt_bin, _, config_fit, _, pdg_code = args
+    df_mc_sig_pt = SCAN_DFS_PER_PT[i_pt][0]
+    signal_region = get_signal_region(df_mc_sig_pt.iloc[first_selected_idx:],
+                                      config_fit["mass_limits_for_fit"],
+                                      config_fit["nbins"],
+                                      pt_bin,
+                                      i_sel,
+                                      pdg_code,
+                                      verbosity=config_fit["verbosity"],
+                                      cache_dir=config_fit["mc_fit_cache_dir"])
+
+    return i_pt, i_sel, signal_region
+
+
+def run_scan_tasks(task_function, tasks, dfs_per_pt, config):
+    """
+    Helper method to run the tasks of the scan sequentially or in a process pool
+
+    Parameter
+    -----------------
+    - task_function: function
+        Task to be run
+
+    - tasks: list
+        Arguments of the tasks
+
+    - dfs_per_pt: list(tuple(pandas.DataFrame))
+        Dataframes of each pT bin used by the tasks
+
+    - config: dict
+        Configuration from the YAML file
+
+    Returns
+    -----------------
+    - results: list
+        Results of the tasks
+    """
+    max_workers = config["multiprocessing"]["max_workers"]
+    if max_workers == 1:
+        init_scan_worker(dfs_per_pt, None)
+        return [task_function(task) for task in tasks]
+
+    # spawn instead of fork, TensorFlow is not fork-safe once initialised in the main process
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_scan_worker,
+                             initargs=(dfs_per_pt, config["multiprocessing"]["zfit_cpus_per_worker"])) as executor:
+        return list(executor.map(task_function, tasks))
+
+
+def scan_points_in_sequence(args):
+    """
+    Task performing one after the other the fits of a list of scan points
+
+    Parameter
+    -----------------
+    - args: tuple
+        List of scan_point arguments (without initial bkg parameters), warm start flag,
+        journal file (None to not journal the points) and journal keys of the points.
+        With warm start, each sideband fit is seeded with the converged parameters of the previous point
+
+    Returns
+    -----------------
+    - results: list(tuple(int, int, float, float))
+        Indices of the points, expected backgrounds and their uncertainties
+    """
+    tasks, warm_start, journal_file, task_keys = args
+    journal = TaskJournal(journal_file, load_records=False)
+    results, bkg_pars = [], None
+    for task, task_key in zip(tasks, task_keys):
+        i_pt, i_sel, exp_bkg, exp_bkg_unc, converged_pars = scan_point(task + (bkg_pars,))
+        if warm_start and converged_pars is not None:
+            bkg_pars = converged_pars
+        # each point is journaled as soon as done
+        journal.append(task_key, [exp_bkg, exp_bkg_unc], group=f"pt_{task[4][0]}_{task[4][1]}")
+        results.append((i_pt, i_sel, exp_bkg, exp_bkg_unc))
+
+    return results
+
+
 # pylint: disable=too-many-locals,too-many-statements,too-many-branches
 def scan(config):
     """
@@ -502,7 +1046,8 @@ def scan(config):
                                          config["inputs"]["zorro"]["folder_name"],
                                          config["inputs"]["zorro"]["triggers_of_interest"],
                                          config["inputs"]["zorro"]["h_collisions_path"],
-                                         config["inputs"]["zorro"]["tvx_cross_section"])
+                                         config["inputs"]["zorro"]["tvx_cross_section"],
+                                         config["inputs"]["zorro"]["index_file"])
 
     frag_frac = config["inputs"]["fonll"]["frag_frac"]
     if channel == "B0ToDPi":
@@ -525,13 +1070,12 @@ def scan(config):
     # Get real data candidates for expected background computation
     df_data = pd.concat(
         [read_parquet_in_batches(parquet) for parquet in config["inputs"]["real_data"]["file_names"]])
-    leftband_range = [config["fit_bkg"]["mass_limits_for_fit"][0], config["fit_bkg"]["mass_range_to_exclude"][0]]
-    rightband_range = [config["fit_bkg"]["mass_range_to_exclude"][1], config["fit_bkg"]["mass_limits_for_fit"][1]]
     bkg_funcs = config["fit_bkg"]["bkg_funcs"]
-    nbins = config["fit_bkg"]["nbins"]
-    fit_verbosity = config["fit_bkg"]["verbosity"]
 
-    # loop over pT bins
+    # prepare the scan points of all the pT bins
+    fit_bkg_settings = {key: value for key, value in config["fit_bkg"].items()
+                        if key not in ("analytic", "mc_fit_cache_dir", "verbosity")}
+    dfs_per_pt, scan_points, tasks, task_keys = [], [], [], []
     for i_pt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
         # configure scan
         selection_steps = config['ML_selections']['steps'][i_pt]
@@ -544,104 +1088,153 @@ def scan(config):
         xaxis_hist.append(bdt_selections[-1] + selection_steps/2)
         bdt_selections = bdt_selections.tolist()
         # get the dataframes entries for this pT interval
-        df_mc_sig_pt = df_mc_sig.query(f"{pt_min} < fPt < {pt_max}")
+        # MC signal sorted by BDT score once, the selected candidates for each cut are then a slice
+        df_mc_sig_pt = df_mc_sig.query(f"{pt_min} < fPt < {pt_max}").sort_values("ML_output")
+        first_selected_idx, eff_bdt_ipt, eff_bdt_unc_ipt = get_bdt_efficiency(
+            df_mc_sig_pt["ML_output"].to_numpy(), bdt_selections)
         df_data_pt = df_data.query(f"{pt_min} < fPt < {pt_max}")
+        # correlated backgrounds grouped once, the template for each cut is then sampled from the pool
+        template_pool_pt = None
         if config["fit_bkg"]["use_bkg_templ"]:
-            df_mc_prd_bkg_pt = df_mc_prd_bkg.query(f"{pt_min} < fPt < {pt_max}")
+            template_pool_pt = CorrelatedBkgTemplatePool(df_mc_prd_bkg.query(f"{pt_min} < fPt < {pt_max}"),
+                                                         config["fit_bkg"]["correlated_bkgs"],
+                                                         seed=config["fit_bkg"]["templ_seed"])
+        dfs_per_pt.append((df_mc_sig_pt, df_data_pt, template_pool_pt))
+        inputs_hash = get_inputs_hash(df_mc_sig_pt["fM"].to_numpy(), df_mc_sig_pt["ML_output"].to_numpy(),
+                                      df_data_pt["fM"].to_numpy(), df_data_pt["ML_output"].to_numpy())
 
         acc_eff_presel_ipt = acc_eff_presel[np.digitize((pt_min+pt_max)/2, acc_eff_bins) - 1]
         acc_eff_unc_presel_ipt = acc_eff_unc_presel[np.digitize((pt_min+pt_max)/2, acc_eff_bins) - 1]
 
-        # perform the scan
+        # expected signal for all the cuts
         exp_sig_ipt, exp_sig_unc_ipt = [[] for _ in range(2)]
-        exp_bkg_ipt, exp_bkg_unc_ipt = [[] for _ in range(2)]
         acc_eff_ipt, acc_eff_unc_ipt = [[] for _ in range(2)]
-        exp_signif_ipt, exp_signif_unc_ipt = [[] for _ in range(2)]
-        print(f"Starting ML score scan for {pt_min:.0f} < pT < {pt_max:.0f}: ...", end="\r")
         for i_sel, bdt_sel in enumerate(bdt_selections):
-            df_mc_sig_pt_sel = df_mc_sig_pt.query(f"ML_output > {bdt_sel}")
-            eff_bdt = len(df_mc_sig_pt_sel) / len(df_mc_sig_pt)  # TODO add uncertainty for BDT efficiency
-            acc_eff, acc_eff_unc = acc_eff_presel_ipt * eff_bdt, acc_eff_unc_presel_ipt * eff_bdt
+            eff_bdt, eff_bdt_unc = eff_bdt_ipt[i_sel], eff_bdt_unc_ipt[i_sel]
+            acc_eff = acc_eff_presel_ipt * eff_bdt
+            acc_eff_unc = np.hypot(acc_eff_unc_presel_ipt * eff_bdt, acc_eff_presel_ipt * eff_bdt_unc)
 
-            # expected signal
             exp_sig, exp_sig_unc = get_expected_signal(exp_sig_over_deltapt_over_acceff_tuple[i_pt],
                                                        pt_max-pt_min,
                                                        acc_eff, acc_eff_unc)
+            exp_sig_ipt.append(exp_sig)
+            exp_sig_unc_ipt.append(exp_sig_unc)
+            acc_eff_ipt.append(acc_eff)
+            acc_eff_unc_ipt.append(acc_eff_unc)
 
-            # expected bkg
-            signal_region = get_signal_region(df_mc_sig_pt_sel,
-                                              config["fit_bkg"]["mass_limits_for_fit"],
-                                              nbins,
-                                              [pt_min, pt_max],
-                                              i_sel,
-                                              pdg_code,
-                                              verbosity=fit_verbosity)
-
-            if config["fit_bkg"]["use_bkg_templ"]:
-                df_for_template_bkg = df_mc_prd_bkg_pt.query(f"ML_output > {bdt_sel}")
-                correlated_bkgs = config["fit_bkg"]["correlated_bkgs"]
-                dfs_prd_bkg_orig_pt, fracs_pt = [], []
-                den_norm = len(df_mc_sig_pt_sel) * config["fit_bkg"]["signal_br"]["pdg"] / config["fit_bkg"]["signal_br"]["sim"]
-                for bkg in correlated_bkgs:
-                    dfs_prd_bkg_pt = df_for_template_bkg.query("fFlagMcMatchRec == 8 "
-                        f"and fPdgCodeBeautyMother == {bkg['beauty_id']} and "
-                        f"fPdgCodeCharmMother == {bkg['charm_id']}"
-                    )
-                    dfs_prd_bkg_orig_pt.append(dfs_prd_bkg_pt)
-                    # store all fractions to fix it later in the fit
-                    fracs_pt.append(len(dfs_prd_bkg_pt) * bkg["br_pdg"] / bkg["br_sim"] / den_norm)
-                # sum of all fractions to normalise the weighted average
-                sum_fracs_pt = sum(fracs_pt)
-                fracs_pt_norm = [frac / sum_fracs_pt for frac in fracs_pt]
-
-                # dfs for weighted average
-                dfs_prd_bkg_sampled = []
-                for frac, df_bkg in zip(fracs_pt_norm, dfs_prd_bkg_orig_pt):
-                    dfs_prd_bkg_sampled.append(df_bkg.sample(frac=frac))
-
-                df_for_template_bkg_sampled = pd.concat(dfs_prd_bkg_sampled)
+            # the fits for the expected background are done in the scan_point tasks
+            tasks.append((i_pt, i_sel, bdt_sel, first_selected_idx[i_sel], [pt_min, pt_max],
+                          bkg_funcs[i_pt], config["fit_bkg"], sidebands_fit_dir, pdg_code))
+            task_keys.append(get_task_key(inputs=inputs_hash, bdt_sel=bdt_sel, pt_bin=[pt_min, pt_max],
+                                          bkg_funcs=bkg_funcs[i_pt], fit_bkg=fit_bkg_settings, pdg_code=pdg_code))
+
+        scan_points.append({"xaxis_hist": xaxis_hist, "selections": bdt_selections,
+                            "exp_sig": exp_sig_ipt, "exp_sig_unc": exp_sig_unc_ipt,
+                            "acc_eff": acc_eff_ipt, "acc_eff_unc": acc_eff_unc_ipt,
+                            "exp_bkg": [0.] * len(bdt_selections), "exp_bkg_unc": [0.] * len(bdt_selections)})
+
+    # analytic sideband fits (not available with bkg templates)
+    analytic = config["fit_bkg"]["analytic"]["activate"]
+    validate_analytic = config["fit_bkg"]["analytic"]["validate"]
+    if analytic and config["fit_bkg"]["use_bkg_templ"]:
+        print("\033[93mWARNING: analytic sideband fits not available with bkg templates, zfit fits used!\033[0m")
+        analytic = False
+    if analytic:
+        for bkg_funcs_ipt in bkg_funcs:
+            if len(bkg_funcs_ipt) != 1 or not re.fullmatch(r"expo|chebpol\d+", bkg_funcs_ipt[0]):
+                print("\033[91mERROR: analytic sideband fits available only for a single expo or chebpolN pdf!\033[0m")
+                sys.exit()
+
+    # perform the zfit fits of all the (pT bin, cut) points
+    max_workers = config["multiprocessing"]["max_workers"]
+    print(f"Starting ML score scan ({len(tasks)} points, {max_workers} workers): ...")
+    if not analytic or validate_analytic:
+        # the points already in the journal are not fitted again
+        journal = TaskJournal(config["output"]["task_journal"])
+        results, tasks_to_run, task_keys_to_run = [], [], []
+        for task, task_key in zip(tasks, task_keys):
+            if journal.get(task_key) is not None:
+                results.append((task[0], task[1], *journal.get(task_key)))
             else:
-                df_for_template_bkg = None
-
-            exp_bkg, exp_bkg_unc = get_expected_background_from_sidebands(
-                df_data_pt.query(f"ML_output > {bdt_sel}"),
-                config["fit_bkg"]["mass_limits_for_fit"],
-                [leftband_range, rightband_range],
-                signal_region,
-                nbins,
-                bkg_funcs[i_pt].copy(),
-                [pt_min, pt_max],
-                bdt_sel,
-                sidebands_fit_dir,
-                df_mc_prd_bkg=df_for_template_bkg_sampled,
-                verbosity=fit_verbosity)
-
-            del df_for_template_bkg
-
-            # expected significance
+                tasks_to_run.append(task)
+                task_keys_to_run.append(task_key)
+        print(f"{len(results)} points found in the journal, {len(tasks_to_run)} points to be fitted")
+        # with warm start, the points of a pT bin are fitted in sequence from the loosest to the tightest cut
+        warm_start = config["fit_bkg"]["warm_start"]
+        if warm_start:
+            task_groups = [([task for task in tasks_to_run if task[0] == i_pt], True, journal.file_name,
+                            [key for task, key in zip(tasks_to_run, task_keys_to_run) if task[0] == i_pt])
+                           for i_pt in range(len(pt_mins))]
+        else:
+            task_groups = [([task], False, journal.file_name, [task_key])
+                           for task, task_key in zip(tasks_to_run, task_keys_to_run)]
+        results_groups = run_scan_tasks(scan_points_in_sequence, task_groups, dfs_per_pt, config)
+        results += [result for results_group in results_groups for result in results_group]
+        for i_pt, i_sel, exp_bkg, exp_bkg_unc in results:
+            scan_points[i_pt]["exp_bkg"][i_sel] = exp_bkg
+            scan_points[i_pt]["exp_bkg_unc"][i_sel] = exp_bkg_unc
+
+    # analytic fits of all the cuts of each pT bin at the same time
+    if analytic:
+        for i_pt, i_sel, signal_region in run_scan_tasks(get_signal_region_point, tasks, dfs_per_pt, config):
+            scan_points[i_pt].setdefault("signal_regions", [None] * len(scan_points[i_pt]["exp_bkg"]))
+            scan_points[i_pt]["signal_regions"][i_sel] = signal_region
+        mass_limits = config["fit_bkg"]["mass_limits_for_fit"]
+        mass_range_to_exclude = config["fit_bkg"]["mass_range_to_exclude"]
+        for i_pt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
+            exp_bkg_analytic, exp_bkg_unc_analytic = get_expected_background_analytic(
+                dfs_per_pt[i_pt][1],
+                scan_points[i_pt]["selections"],
+                mass_limits,
+                [[mass_limits[0], mass_range_to_exclude[0]], [mass_range_to_exclude[1], mass_limits[1]]],
+                scan_points[i_pt]["signal_regions"],
+                config["fit_bkg"]["nbins"],
+                bkg_funcs[i_pt][0])
+            if validate_analytic:
+                exp_bkg_zfit = np.array(scan_points[i_pt]["exp_bkg"])
+                ratio = np.divide(exp_bkg_analytic, exp_bkg_zfit,
+                                  out=np.zeros_like(exp_bkg_analytic), where=exp_bkg_zfit > 0)
+                valid = (exp_bkg_zfit > 0) & (exp_bkg_analytic > 0)
+                max_dev = np.max(np.abs(ratio[valid] - 1)) if np.any(valid) else float("nan")
+                print(f"Analytic vs zfit B(3sigma) for {pt_min:.0f} < pT < {pt_max:.0f}: "
+                      f"{np.count_nonzero(valid)}/{len(valid)} points compared, max |ratio - 1| = {max_dev:.4f}")
+                scan_points[i_pt]["exp_bkg_ratio"] = ratio.tolist()
+            scan_points[i_pt]["exp_bkg"] = exp_bkg_analytic.tolist()
+            scan_points[i_pt]["exp_bkg_unc"] = exp_bkg_unc_analytic.tolist()
+
+    # collect the results in the output histograms
+    for i_pt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
+        scan_point_ipt = scan_points[i_pt]
+        xaxis_hist = scan_point_ipt["xaxis_hist"]
+
+        # expected significance
+        exp_signif_ipt, exp_signif_unc_ipt = [[] for _ in range(2)]
+        for exp_sig, exp_sig_unc, exp_bkg, exp_bkg_unc in zip(scan_point_ipt["exp_sig"],
+                                                              scan_point_ipt["exp_sig_unc"],
+                                                              scan_point_ipt["exp_bkg"],
+                                                              scan_point_ipt["exp_bkg_unc"]):
             exp_signif, exp_signif_unc = get_expected_significance(exp_sig,
                                                                    exp_sig_unc,
                                                                    exp_bkg,
                                                                    exp_bkg_unc)
-
-            # fill lists
-            exp_sig_ipt.append(exp_sig)
-            exp_sig_unc_ipt.append(exp_sig_unc)
-            exp_bkg_ipt.append(exp_bkg)
-            exp_bkg_unc_ipt.append(exp_bkg_unc)
-            acc_eff_ipt.append(acc_eff)
-            acc_eff_unc_ipt.append(acc_eff_unc)
             exp_signif_ipt.append(exp_signif)
             exp_signif_unc_ipt.append(exp_signif_unc)
 
-        values_quantities = [exp_sig_ipt, exp_bkg_ipt, acc_eff_ipt, exp_signif_ipt]
-        uncs_quantities = [exp_sig_unc_ipt, exp_bkg_unc_ipt, acc_eff_unc_ipt, exp_signif_unc_ipt]
+        values_quantities = [scan_point_ipt["exp_sig"], scan_point_ipt["exp_bkg"],
+                             scan_point_ipt["acc_eff"], exp_signif_ipt]
+        uncs_quantities = [scan_point_ipt["exp_sig_unc"], scan_point_ipt["exp_bkg_unc"],
+                           scan_point_ipt["acc_eff_unc"], exp_signif_unc_ipt]
         hists = []
         for values_quantity, uncs_quantity in zip(values_quantities, uncs_quantities):
             hists.append(create_hist(xaxis_hist, values_quantity, uncs_quantity, label="BDT score"))
 
         ofile_dir_name = f"pT_{pt_min:.0f}_{pt_max:.0f}"
         labels = ["ExpSig", "ExpBkg", "AccEff", "ExpSignif"]
+        if "exp_bkg_ratio" in scan_point_ipt:
+            # validation of the analytic sideband fits, not drawn in the canvas
+            hists.append(create_hist(xaxis_hist, scan_point_ipt["exp_bkg_ratio"],
+                                     [0.] * len(xaxis_hist[:-1]), label="BDT score"))
+            labels.append("ExpBkgAnalyticOverZfit")
         if i_pt == 0:
             with uproot.recreate(scan_results_file_name) as ofile:
                 for label, hist in zip(labels, hists):
@@ -663,7 +1256,7 @@ def scan(config):
             ax.set_xlim(xaxis_hist[0], xaxis_hist[-1])
             hist.plot(ax=ax)
         fig.savefig(f"{outdir}scan_{ofile_dir_name}.png")
-        print(f"Starting ML score scan for {pt_min:.0f} < pT < {pt_max:.0f}: Done!")
+        print(f"ML score scan for {pt_min:.0f} < pT < {pt_max:.0f}: Done!")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+"""
+file: tree_ensemble.py
+brief: vectorised evaluation of XGBoost binary classifiers with numpy only
+"""
+
+import json
+
+import numpy as np  # pylint: disable=import-error
+
+
+class TreeEnsemble:
+    """
+    Class to evaluate a (binary) XGBoost tree ensemble compiled into flat numpy node arrays.
+    All the trees are concatenated, each leaf points to itself as left and right child,
+    so that all candidates and trees can be moved down by one level at a time for max_depth steps
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, nodes, roots, base_margin, max_depth, feature_names, objective):
+        """
+        Init method
+
+        Parameters
+        -----------------
+        - nodes: dict of numpy arrays with the concatenated nodes of all the trees
+            (feature, threshold, left, right, default_left, value)
+        - roots: numpy array with the index of the root node of each tree
+        - base_margin: global bias of the model (in margin space)
+        - max_depth: maximum depth of the trees
+        - feature_names: list of features in the order expected by the model
+        - objective: XGBoost objective (binary:logistic or binary:logitraw)
+        """
+
+        self.feature = nodes["feature"]
+        self.threshold = nodes["threshold"]
+        self.left = nodes["left"]
+        self.right = nodes["right"]
+        self.default_left = nodes["default_left"]
+        self.value = nodes["value"]
+        self.roots = roots
+        self.base_margin = base_margin
+        self.max_depth = max_depth
+        self.feature_names = list(feature_names)
+        self.objective = objective
+
+    @classmethod
+    def from_booster(cls, booster, feature_names=None):
+        """
+        Build the ensemble from an XGBoost booster
+
+        Parameters
+        -----------------
+        - booster: xgboost Booster instance (e.g. ModelHandler.get_original_model().get_booster())
+        - feature_names: list of features in the order expected by the model
+            (None to take them from the booster, which has none if trained without them)
+
+        Returns
+        -----------------
+        - ensemble: TreeEnsemble instance
+        """
+
+        model_json = json.loads(booster.save_raw("json"))
+        learner = model_json["learner"]
+        objective = learner["objective"]["name"]
+        if objective not in ("binary:logistic", "binary:logitraw"):
+            raise ValueError(f"objective {objective} not supported, only binary classifiers can be compiled")
+        gbm = learner["gradient_booster"]
+        if gbm["name"] != "gbtree":
+            raise ValueError(f"booster {gbm['name']} not supported, only gbtree can be compiled")
+        if feature_names is None:
+            feature_names = learner["feature_names"]
+        n_features = int(learner["learner_model_param"]["num_feature"])
+        if len(feature_names) == 0 or len(feature_names) != n_features:
+            raise ValueError(f"{len(feature_names)} feature names provided for a booster with {n_features} features")
+
+        # base_score is stored in probability space (as "5E-1" or "[5E-1]" depending on the xgboost version)
+        base_score = float(learner["learner_model_param"]["base_score"].strip("[]"))
+        base_margin = np.log(base_score / (1. - base_score)) if objective == "binary:logistic" else base_score
+
+        nodes = {key: [] for key in ["feature", "threshold", "left", "right", "default_left", "value"]}
+        roots, max_depth, offset = [], 0, 0
+        for tree in gbm["model"]["trees"]:
+            left = np.asarray(tree["left_children"], dtype=np.int64)
+            right = np.asarray(tree["right_children"], dtype=np.int64)
+            is_leaf = left == -1
+            node_ids = np.arange(len(left))
+            # leaves point to themselves, split values of leaves are the leaf values
+            nodes["left"].append(np.where(is_leaf, node_ids, left) + offset)
+            nodes["right"].append(np.where(is_leaf, node_ids, right) + offset)
+            nodes["feature"].append(np.where(is_leaf, 0, tree["split_indices"]))
+            nodes["threshold"].append(np.asarray(tree["split_conditions"], dtype=np.float32))
+            nodes["default_left"].append(np.asarray(tree["default_left"], dtype=bool))
+            nodes["value"].append(np.where(is_leaf, tree["split_conditions"], 0.))
+            roots.append(offset)
+            max_depth = max(max_depth, cls.__get_depth(left, right))
+            offset += len(left)
+
+        nodes = {
+            "feature": np.concatenate(nodes["feature"]).astype(np.int32),
+            "threshold": np.concatenate(nodes["threshold"]).astype(np.float32),
+            "left": np.concatenate(nodes["left"]).astype(np.int32),
+            "right": np.concatenate(nodes["right"]).astype(np.int32),
+            "default_left": np.concatenate(nodes["default_left"]),
+            "value": np.concatenate(nodes["value"]).astype(np.float64),
+        }
+
+        return cls(nodes, np.asarray(roots, dtype=np.int32), base_margin, max_depth,
+                   feature_names, objective)
+
+    @staticmethod
+    def __get_depth(left, right):
+        """
+        Helper method to get the depth of a tree
+
+        Parameters
+        -----------------
+        - left: numpy array with the left children of the nodes (-1 for leaves)
+        - right: numpy array with the right children of the nodes (-1 for leaves)
+
+        Returns
+        -----------------
+        - depth: depth of the tree
+        """
+
+        depth, level = 0, np.array([0])
+        while True:
+            level = np.concatenate([left[level], right[level]])
+            level = level[level >= 0]
+            if len(level) == 0:
+                return depth
+            depth += 1
+
+    def save(self, file_name):
+        """
+        Save the ensemble in a .npz file
+
+        Parameters
+        -----------------
+        - file_name: name of the output .npz file
+        """
+
+        np.savez(
+            file_name, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+            default_left=self.default_left, value=self.value, roots=self.roots,
+            base_margin=self.base_margin, max_depth=self.max_depth,
+            feature_names=np.asarray(self.feature_names), objective=self.objective
+        )
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Load an ensemble saved with the save method
+
+        Parameters
+        -----------------
+        - file_name: name of the input .npz file
+
+        Returns
+        -----------------
+        - ensemble: TreeEnsemble instance
+        """
+
+        with np.load(file_name) as infile:
+            nodes = {key: infile[key] for key in ["feature", "threshold", "left", "right", "default_left", "value"]}
+            return cls(nodes, infile["roots"], float(infile["base_margin"]), int(infile["max_depth"]),
+                       infile["feature_names"].tolist(), str(infile["objective"]))
+
+    def predict_margin(self, features, batch_size=10000):
+        """
+        Compute the raw output (margin) of the ensemble
+
+        Parameters
+        -----------------
+        - features: numpy array with shape (n_candidates, n_features), columns ordered as feature_names
+        - batch_size: number of candidates evaluated at the same time (memory ~ batch_size * n_trees)
+
+        Returns
+        -----------------
+        - margin: numpy array with the raw output of each candidate
+        """
+
+        features = np.asarray(features, dtype=np.float32)
+        margin = np.empty(len(features), dtype=np.float64)
+        for start in range(0, len(features), batch_size):
+            x_batch = features[start:start + batch_size]
+            rows = np.arange(len(x_batch))[:, np.newaxis]
+            idx = np.broadcast_to(self.roots, (len(x_batch), len(self.roots)))
+            for _ in range(self.max_depth):
+                x_node = x_batch[rows, self.feature[idx]]
+                # same convention as xgboost: left if x < threshold, default direction if missing
+                go_left = np.where(np.isnan(x_node), self.default_left[idx], x_node < self.threshold[idx])
+                idx = np.where(go_left, self.left[idx], self.right[idx])
+            margin[start:start + batch_size] = self.value[idx].sum(axis=1) + self.base_margin
+
+        return margin
+
+    def predict(self, features, batch_size=10000):
+        """
+        Compute the output of the ensemble (probability for binary:logistic, margin for binary:logitraw)
+
+        Parameters
+        -----------------
+        - features: numpy array with shape (n_candidates, n_features), columns ordered as feature_names
+        - batch_size: number of candidates evaluated at the same time
+
+        Returns
+        -----------------
+        - ypred: numpy array with the output of each candidate
+        """
+
+        margin = self.predict_margin(features, batch_size)
+        if self.objective == "binary:logistic":
+            return (1. / (1. + np.exp(-margin))).astype(np.float32)
+        return margin.astype(np.float32)
@@ -10,6 +10,7 @@ sys.path.append('utils') # pylint: disable=wrong-import-position
 import ROOT # pylint: disable=import-error
 import yaml
 from analysis_utils import get_n_events_from_zorro # pylint: disable=import-error
+from lumi_utils import load_lumi_index, get_n_events_from_index, get_bc_luminosities_from_index # pylint: disable=import-error
 # pylint: disable=no-member
 
 def main(config_file_name):
@@ -26,20 +27,37 @@ def main(config_file_name):
     with open(config_file_name, 'r', encoding='utf-8') as yml_config_file:
         config = yaml.load(yml_config_file, yaml.FullLoader)
 
+    # per-run index of all the files, read once (and stored if index_file is set)
+    df_index = None
+    if config['lumi']['index_file'] is not None:
+        df_index = load_lumi_index(
+            [file for files in config['lumi']['analysis_results_files'].values() for file in files],
+            config['lumi']['zorro_folder'], config['lumi']['h_collisions_path'],
+            config['lumi']['folder_bc_cuts'], index_file=config['lumi']['index_file']
+        )
+
     int_lumis_before_bc = []
     int_lumis_after_bc = []
     for year, analysis_results_files in config['lumi']['analysis_results_files'].items():
-        n_events = get_n_events_from_zorro(
-            analysis_results_files, config['lumi']['zorro_folder'],
-            config['lumi']['triggers_of_interest'], config['lumi']['h_collisions_path']
-        )
+        if df_index is not None:
+            n_events = get_n_events_from_index(
+                df_index, config['lumi']['triggers_of_interest'], infile_names=analysis_results_files
+            )
+        else:
+            n_events = get_n_events_from_zorro(
+                analysis_results_files, config['lumi']['zorro_folder'],
+                config['lumi']['triggers_of_interest'], config['lumi']['h_collisions_path']
+            )
         int_lumis_before_bc.append(n_events/config['lumi']['tvx_cross_section'][year] * config['lumi']['pileup_correction'][year])
 
 
     int_lumi_before_bc = sum(int_lumis_before_bc)
     int_lumi_after_bc = sum(int_lumis_after_bc)
 
-    if config['lumi']['lumi_before_bc_cuts'] is None or config['lumi']['lumi_after_bc_cuts'] is None:
+    if df_index is not None and (config['lumi']['lumi_before_bc_cuts'] is None or config['lumi']['lumi_after_bc_cuts'] is None):
+        lumi_before_bc, lumi_after_bc = get_bc_luminosities_from_index(df_index)
+        int_lumi_after_bc = int_lumi_before_bc * lumi_after_bc / lumi_before_bc
+    elif config['lumi']['lumi_before_bc_cuts'] is None or config['lumi']['lumi_after_bc_cuts'] is None:
         lumi_before_bc, lumi_after_bc = 0, 0
         for year, analysis_results_files in config['lumi']['analysis_results_files'].items():
             for file in analysis_results_files:
@@ -8,10 +8,10 @@ sys.path.append('utils') # pylint: disable=wrong-import-position
 import ctypes
 import argparse
 import ROOT # pylint: disable=import-error
-import pandas as pd
 import numpy as np
 import yaml
-from df_utils import read_parquet_in_batches # pylint: disable=import-error
+from df_utils import read_candidates # pylint: disable=import-error
+from cutset_selection import CutsetSelection # pylint: disable=import-error
 from analysis_utils import evaluate_efficiency_from_histos # pylint: disable=import-error
 from style_formatter import root_colors_from_matplotlib_colormap # pylint: disable=import-error
 # pylint: disable=no-member
@@ -192,27 +192,24 @@ def compute_efficiency(config_file_name): # pylint: disable=too-many-statements
     h_reco_trigger.Reset()
 
 
-    for i_pt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
+    # Read the reconstructed particles once (only in the pT bins) and assign them to the pT bins
+    selection = CutsetSelection(cut_set, skip_vars=['M'])
+    df_reco = read_candidates(config['reco_file_names'],
+                              columns=['fPt', 'fFlagMcMatchRec'] + selection.cut_vars,
+                              cut_set=cut_set, skip_vars=[var for var in cut_set if var != 'pt'])
+    df_reco = df_reco[np.abs(df_reco['fFlagMcMatchRec'].to_numpy()) == 1] # Require signal
+    pt_reco = df_reco['fPt'].to_numpy()
+    reco_trigger_indices = selection.get_bin_indices(df_reco, apply_cuts=False)
+    reco_indices = selection.get_bin_indices(df_reco)
 
-        # Apply the cuts on the reconstructed particles
-        require_signal = "(fFlagMcMatchRec == -1 or fFlagMcMatchRec == 1)"
-        df_reco = pd.concat(
-            [read_parquet_in_batches(parquet, f"{pt_min} < fPt < {pt_max} and {require_signal}")
-             for parquet in config['reco_file_names']])
+    for i_pt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
 
-        for pt in df_reco['fPt']:
+        for pt in pt_reco[reco_trigger_indices[i_pt]]:
             h_reco_trigger.Fill(pt)
         h_reco_trigger.Scale(1./config['eff_frac'])
 
-        sel_to_apply = ''
-        for cut_var in cut_set:
-            if cut_var in ('pt', 'M'):
-                continue
-            sel_to_apply += f" {cut_set[cut_var]['mins'][i_pt]} < {cut_var} < {cut_set[cut_var]['maxs'][i_pt]} and"
-        sel_to_apply = sel_to_apply[:-3] # Remove the last 'and'
-
-        df_reco = df_reco.query(sel_to_apply)
-        for pt in df_reco['fPt']:
+        # Apply the cuts on the reconstructed particles
+        for pt in pt_reco[reco_indices[i_pt]]:
             h_reco.Fill(pt)
         h_reco.Scale(1./config['eff_frac'])
 
@@ -3,7 +3,11 @@ Script for the raw-yield extraction of B mesons
 """
 
 import argparse
+import multiprocessing
 import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 os.environ["CUDA_VISIBLE_DEVICES"] = ""  # pylint: disable=wrong-import-position
 
 import numpy as np
@@ -15,6 +19,15 @@ from matplotlib.offsetbox import AnchoredText
 import zfit
 from flarefly.data_handler import DataHandler
 from flarefly.fitter import F2MassFitter
+sys.path.append('utils') # pylint: disable=wrong-import-position
+from fit_cache import FitCache, get_fit_key
+from df_utils import read_candidates
+from cutset_selection import CutsetSelection
+
+FIT_INPUTS = None  # configuration and dataframes used by the fit tasks
+# quantities of the fit of each pT bin stored in the output histograms
+RESULT_KEYS = ["raw_yields", "raw_yields_unc", "signif", "signif_unc", "s_over_b", "s_over_b_unc",
+               "means", "means_unc", "sigmas", "sigmas_unc", "means_mc", "means_mc_unc", "sigmas_mc", "sigmas_mc_unc"]
 
 def create_hist(pt_lims, contents, errors, label_pt=r"$p_\mathrm{T}~(\mathrm{GeV}/c)$"):
     """
@@ -82,6 +95,435 @@ def add_info_on_canvas(axs, loc, system, pt_min, pt_max, fitter=None):
     axs.add_artist(anchored_text)
 
 
+def init_fit_worker(fit_inputs, zfit_cpus):
+    """
+    Initializer of the processes performing the fits
+
+    Parameters
+    ----------
+
+    - fit_inputs (dict): configuration, dataframes and settings shared by the fits
+    - zfit_cpus (dict): intra- and inter-op number of threads of zfit for each worker (None to keep the current ones)
+    """
+    global FIT_INPUTS  # pylint: disable=global-statement
+    FIT_INPUTS = fit_inputs
+    if zfit_cpus is not None:
+        zfit.run.set_cpus_explicit(intra=zfit_cpus["intra"], inter=zfit_cpus["inter"])
+
+
+def merge_root_files(infile_names, outfile_name):
+    """
+    Helper method to copy the objects of ROOT files in an existing output file and delete them
+
+    Parameters
+    ----------
+
+    - infile_names (list): names of the input files
+    - outfile_name (str): name of the output file
+    """
+    with uproot.update(outfile_name) as outfile:
+        for infile_name in infile_names:
+            with uproot.open(infile_name) as infile:
+                for key, obj in infile.items(cycle=False):
+                    if infile.classname_of(key) != "TDirectory":
+                        outfile[key] = obj
+            os.remove(infile_name)
+
+
+def fit_pt_integrated(args): # pylint: disable=too-many-locals,too-many-statements,too-many-branches
+    """
+    Task performing the pT-integrated MC and data fits
+
+    Parameters
+    ----------
+
+    - args (tuple): pT limits and name of the output file of the fits
+    """
+    (pt_min, pt_max), outfile_name = args
+    cfg = FIT_INPUTS["cfg"]
+    particle = FIT_INPUTS["particle"]
+    particle_name = FIT_INPUTS["particle_name"]
+    decay_channel = FIT_INPUTS["decay_channel"]
+    pdg_id = FIT_INPUTS["pdg_id"]
+    outdir = FIT_INPUTS["outdir"]
+    df = FIT_INPUTS["df"]
+    df_mc_sig = FIT_INPUTS["df_mc_sig"]
+    df_mc_dk_sig = FIT_INPUTS["df_mc_dk_sig"]
+    dfs_prd_bkg = FIT_INPUTS["dfs_prd_bkg"]
+    fracs_ptint = FIT_INPUTS["fracs_ptint"]
+    correlated_bkgs = FIT_INPUTS["correlated_bkgs"]
+    use_corr_bkg_ptint = FIT_INPUTS["use_corr_bkg_ptint"]
+
+    # we first fit MC only
+    data_hdl_mc = DataHandler(df_mc_sig, var_name="fM",
+                              limits=cfg["fit_configs"]["pt_int"]["mass_limits"],
+                              nbins=cfg["plot_style"]["pt_int"]["n_bins"])
+    fitter_mc_ptint = F2MassFitter(data_hdl_mc,
+                                   ["doublegaus"],
+                                   ["nobkg"],
+                                   name=f"{particle}_mc_ptint",
+                                   label_signal_pdf=[rf"$\mathrm{{{particle_name}}}$ signal"])
+    fitter_mc_ptint.set_signal_initpar(0, "sigma1", 0.03, limits=[0.01, 0.10])
+    fitter_mc_ptint.set_signal_initpar(0, "sigma2", 0.085, limits=[0.01, 0.25])
+    fitter_mc_ptint.set_particle_mass(0, pdg_id=pdg_id)
+    result = fitter_mc_ptint.mass_zfit()
+    if result.converged:
+        fig, axs = fitter_mc_ptint.plot_mass_fit(
+            style="ATLAS",
+            figsize=(8, 8),
+            axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
+        )
+        add_info_on_canvas(axs, "upper left", "MC pp", pt_min, pt_max, fitter_mc_ptint)
+
+        fig_res, axs_res = fitter_mc_ptint.plot_raw_residuals(
+            style="ATLAS",
+            figsize=(8, 8),
+            axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
+        )
+        add_info_on_canvas(axs_res, "upper left", "MC pp", pt_min, pt_max, fitter_mc_ptint)
+
+
+        fig.savefig(os.path.join(outdir, f"{particle}_mass_ptint_MC.pdf"))
+        fig_res.savefig(os.path.join(outdir, f"{particle}_massres_ptint_MC.pdf"))
+
+    # then we fit data
+    data_hdl = DataHandler(df, var_name="fM",
+                           limits=cfg["fit_configs"]["pt_int"]["mass_limits"],
+                           nbins=cfg["plot_style"]["pt_int"]["n_bins"])
+    bkg_funcs = cfg["fit_configs"]["pt_int"]["bkg_funcs"]
+    label_bkg_pdf = ["Comb. bkg"]
+    data_hdls_prd_bkg = []
+    if use_corr_bkg_ptint:
+        for i_bkg, (bkg, df_prd_bkg) in enumerate(zip(correlated_bkgs, dfs_prd_bkg)):
+            data_hdls_prd_bkg.append(DataHandler(df_prd_bkg, var_name="fM",
+                                                 limits=cfg["fit_configs"]["pt_int"]["mass_limits"],
+                                                 nbins=cfg["plot_style"]["pt_int"]["n_bins"]))
+            bkg_funcs.insert(i_bkg, "kde_grid")
+            if cfg["fit_configs"]["pt_int"]["bkg_templ_opt"] == 0:
+                label_bkg_pdf.insert(i_bkg, bkg["name"])
+            else:
+                label_bkg_pdf.insert(i_bkg, "Correlated backgrounds")
+        if cfg["fit_configs"]["pt_int"]["bkg_templ_opt"] == 0:
+            data_hdl_dka = DataHandler(dfs_prd_bkg[-1], var_name="fM",
+                        limits=cfg["fit_configs"]["pt_int"]["mass_limits"],
+                        nbins=cfg["plot_style"]["pt_int"]["n_bins"])
+            bkg_funcs.insert(len(dfs_prd_bkg) - 1, "kde_grid")
+            label_bkg_pdf.insert(i_bkg, cfg["fit_configs"]["b_to_dk_bkg"]["name"])
+
+    fitter_ptint = F2MassFitter(data_hdl,
+                                cfg["fit_configs"]["pt_int"]["signal_funcs"],
+                                bkg_funcs,
+                                name=f"{particle}_ptint",
+                                label_signal_pdf=[rf"$\mathrm{{{particle_name}}}$ signal"],
+                                label_bkg_pdf=label_bkg_pdf)
+
+    if use_corr_bkg_ptint:
+        for i_bkg, (bkg, data_hdl_prd_bkg) in enumerate(zip(correlated_bkgs, data_hdls_prd_bkg)):
+            fitter_ptint.set_background_kde(i_bkg, data_hdl_prd_bkg)
+            if i_bkg == 0:
+                if cfg["fit_configs"]["pt_int"]["fix_correlated_bkg_to_signal"]:
+                    if cfg["fit_configs"]["pt_int"]["bkg_templ_opt"] == 0:
+                        fitter_ptint.fix_bkg_frac_to_signal_pdf(i_bkg, 0, fracs_ptint[i_bkg])
+                    else:
+                        fitter_ptint.fix_bkg_frac_to_signal_pdf(i_bkg, 0, sum(fracs_ptint))
+                continue
+            denom = data_hdls_prd_bkg[0].get_norm() * correlated_bkgs[0]["br_pdg"] / correlated_bkgs[0]["br_sim"]
+            fitter_ptint.fix_bkg_frac_to_bkg_pdf(
+                i_bkg, 0,
+                data_hdl_prd_bkg.get_norm() * bkg["br_pdg"] / bkg["br_sim"] / denom
+            )
+        if cfg["fit_configs"]["pt_int"]["bkg_templ_opt"] == 0:
+            fitter_ptint.set_background_kde(len(dfs_prd_bkg)-1, data_hdl_dka)
+            denom = len(df_mc_dk_sig) * cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["sim"]
+            fitter_ptint.fix_bkg_frac_to_signal_pdf(
+                len(dfs_prd_bkg)-1, 0,
+                data_hdl_dka.get_norm() * cfg["fit_configs"]["b_to_dk_bkg"]["br_pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["br_sim"] / denom
+            )
+
+    fitter_ptint.set_signal_initpar(0, "sigma", 0.03, limits=[0.02, 0.06])
+    fitter_ptint.set_particle_mass(0, pdg_id=pdg_id)
+    icombbkg = len(dfs_prd_bkg) if use_corr_bkg_ptint else 0
+    fitter_ptint.set_background_initpar(icombbkg, "c1", -0.05, limits=[-0.2, 0.])
+    fitter_ptint.set_background_initpar(icombbkg, "c2", 0.008, limits=[0.000, 0.030])
+    fitter_ptint.set_background_initpar(icombbkg, "lam", -1.2, limits=[-10., 10.])
+    fitter_ptint.set_signal_initpar(0, "frac", 0.2, limits=[0., 1.])
+    result = fitter_ptint.mass_zfit()
+    if result.converged:
+        fig, axs = fitter_ptint.plot_mass_fit(
+            style="ATLAS",
+            figsize=(8, 8),
+            axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)",
+            show_extra_info=True,
+            extra_info_loc=["lower right", "lower left"]
+        )
+        add_info_on_canvas(axs, "upper left", "pp", pt_min, pt_max)
+
+        fig_res, axs_res = fitter_ptint.plot_raw_residuals(
+            style="ATLAS",
+            figsize=(8, 8),
+            axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
+        )
+        add_info_on_canvas(axs_res, "upper left", "pp", pt_min, pt_max)
+
+        fig.savefig(os.path.join(outdir, f"{particle}_mass_ptint.pdf"))
+        fig_res.savefig(os.path.join(outdir, f"{particle}_massres_ptint.pdf"))
+
+        fitter_ptint.dump_to_root(
+            outfile_name, option="update", suffix="_ptint")
+
+
+def fit_pt_bin(args): # pylint: disable=too-many-locals,too-many-statements,too-many-branches
+    """
+    Task performing the MC and data fits of a pT bin
+
+    Parameters
+    ----------
+
+    - args (tuple): pT bin index, pT bin limits and name of the output file of the fits
+
+    Returns
+    ----------
+
+    - results (dict): raw yield, significance, S/B, means and sigmas (data and MC) with uncertainties
+    """
+    ipt, (pt_min, pt_max), outfile_name = args
+    cfg = FIT_INPUTS["cfg"]
+    particle = FIT_INPUTS["particle"]
+    particle_name = FIT_INPUTS["particle_name"]
+    decay_channel = FIT_INPUTS["decay_channel"]
+    pdg_id = FIT_INPUTS["pdg_id"]
+    outdir = FIT_INPUTS["outdir"]
+    df = FIT_INPUTS["df"]
+    df_mc_sig = FIT_INPUTS["df_mc_sig"]
+    df_mc_dk_bkg = FIT_INPUTS["df_mc_dk_bkg"]
+    df_mc_dk_sig = FIT_INPUTS["df_mc_dk_sig"]
+    dfs_prd_bkg_orig = FIT_INPUTS["dfs_prd_bkg_orig"]
+    correlated_bkgs = FIT_INPUTS["correlated_bkgs"]
+    fix_means = FIT_INPUTS["fix_means"]
+    fix_sigmas = FIT_INPUTS["fix_sigmas"]
+    ref_means = FIT_INPUTS["ref_means"]
+    ref_sigmas = FIT_INPUTS["ref_sigmas"]
+    pt_bin_indices = FIT_INPUTS["pt_bin_indices"]
+    fit_cache = FitCache(cfg["fit_configs"]["mc_fit_cache_dir"])
+
+    use_corr_bkg_pt = cfg["fit_configs"]["use_bkg_templ"][ipt]
+    # quantities not available (e.g. fit not converged) are left to 0
+    results = dict.fromkeys(RESULT_KEYS, 0.)
+
+    # we first fit MC only
+    df_mc_sig_pt = df_mc_sig.iloc[pt_bin_indices["df_mc_sig"][ipt]]
+    data_hdl_mc = DataHandler(df_mc_sig_pt, var_name="fM",
+                              limits=cfg["fit_configs"]["mass_limits"][ipt],
+                              nbins=cfg["plot_style"]["n_bins"][ipt])
+    # the MC fit is performed only if not found in the cache
+    fit_key = get_fit_key(df_mc_sig_pt["fM"].to_numpy(), model="doublegaus",
+                          fit_limits=cfg["fit_configs"]["mass_limits"][ipt],
+                          nbins=cfg["plot_style"]["n_bins"][ipt], pdg_code=pdg_id,
+                          sigma1_init=[0.03, 0.01, 0.10], sigma2_init=[0.085, 0.01, 0.25])
+    # the non-converged fits are cached as well so that they are not repeated
+    mc_fit_result = fit_cache.load(fit_key)
+    if mc_fit_result is None:
+        fitter_mc_pt = F2MassFitter(data_hdl_mc,
+                                    ["doublegaus"],
+                                    ["nobkg"],
+                                    name=f"{particle}_mc_pt{pt_min:.0f}_{pt_max:.0f}",
+                                    label_signal_pdf=[rf"$\mathrm{{{particle_name}}}$ signal"])
+        fitter_mc_pt.set_signal_initpar(0, "sigma1", 0.03, limits=[0.01, 0.10])
+        fitter_mc_pt.set_signal_initpar(0, "sigma2", 0.085, limits=[0.01, 0.25])
+        fitter_mc_pt.set_particle_mass(0, pdg_id=pdg_id)
+        result = fitter_mc_pt.mass_zfit()
+        if result.converged:
+            fig, axs = fitter_mc_pt.plot_mass_fit(
+                style="ATLAS",
+                figsize=(8, 8),
+                axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
+            )
+            add_info_on_canvas(axs, "upper left", "MC pp", pt_min, pt_max, fitter_mc_pt)
+
+            fig_res, axs_res = fitter_mc_pt.plot_raw_residuals(
+                style="ATLAS",
+                figsize=(8, 8),
+                axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
+            )
+            add_info_on_canvas(axs_res, "upper left", "MC pp", pt_min, pt_max, fitter_mc_pt)
+
+            fig.savefig(os.path.join(outdir, f"{particle}_mass_pt{pt_min:.0f}_{pt_max:.0f}_MC.pdf"))
+            fig_res.savefig(os.path.join(outdir, f"{particle}_massres_pt{pt_min:.0f}_{pt_max:.0f}_MC.pdf"))
+
+            mean, mean_unc = fitter_mc_pt.get_signal_parameter(0, "mu")
+            sigma1, sigma1_unc = fitter_mc_pt.get_signal_parameter(0, "sigma1")
+            sigma2, sigma2_unc = fitter_mc_pt.get_signal_parameter(0, "sigma2")
+            if sigma1 < sigma2:
+                sigma = sigma1
+                sigma_unc = sigma1_unc
+            else:
+                sigma = sigma2
+                sigma_unc = sigma2_unc
+            mc_fit_result = {"mean": mean, "mean_unc": mean_unc, "sigma": sigma, "sigma_unc": sigma_unc,
+                             "converged": True}
+        else:
+            mc_fit_result = {"converged": False}
+        fit_cache.save(fit_key, mc_fit_result)
+
+    if mc_fit_result["converged"]:
+        results.update({"means_mc": mc_fit_result["mean"], "means_mc_unc": mc_fit_result["mean_unc"],
+                        "sigmas_mc": mc_fit_result["sigma"], "sigmas_mc_unc": mc_fit_result["sigma_unc"]})
+
+    # then we fit data
+    df_pt = df.iloc[pt_bin_indices["df"][ipt]]
+    data_hdl = DataHandler(df_pt, var_name="fM",
+                           limits=cfg["fit_configs"]["mass_limits"][ipt],
+                           nbins=cfg["plot_style"]["n_bins"][ipt])
+
+    bkg_funcs = cfg["fit_configs"]["bkg_funcs"][ipt]
+    label_bkg_pdf = ["Comb. bkg"]
+    data_hdls_prd_bkg = []
+    dfs_prd_bkg_pt = []
+    fracs_pt = []
+    if use_corr_bkg_pt:
+        df_mc_dk_bkg_pt = df_mc_dk_bkg.iloc[pt_bin_indices["df_mc_dk_bkg"][ipt]]
+        df_mc_dk_sig_pt = df_mc_dk_sig.iloc[pt_bin_indices["df_mc_dk_sig"][ipt]]
+        den_norm = data_hdl_mc.get_norm() * cfg["fit_configs"]["signal_br"]["pdg"] / \
+            cfg["fit_configs"]["signal_br"]["sim"]
+
+        dfs_prd_bkg_orig_pt = [df_bkg.iloc[indices[ipt]] for df_bkg, indices
+                               in zip(dfs_prd_bkg_orig, pt_bin_indices["dfs_prd_bkg_orig"])]
+        for bkg, df_prd_bkg_orig_pt in zip(correlated_bkgs, dfs_prd_bkg_orig_pt):
+            fracs_pt.append(len(df_prd_bkg_orig_pt) * bkg["br_pdg"] / bkg["br_sim"] / den_norm)
+
+        den_norm = len(df_mc_dk_sig_pt) * cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["sim"]
+        fracs_pt.append(len(df_mc_dk_bkg_pt) * cfg["fit_configs"]["b_to_dk_bkg"]["br_pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["br_sim"] / den_norm)
+
+        sum_fracs = sum(fracs_pt)
+        fracs_pt_norm = [frac / sum_fracs for frac in fracs_pt]
+
+        dfs_prd_bkg_sampled_pt = []
+        if cfg["fit_configs"]["bkg_templ_opt"][ipt] == 1:
+            lengths = [len(df_bkg) for df_bkg in dfs_prd_bkg_orig_pt]
+            min_positive_lenght = min(l for l in lengths if l > 0)
+            sample_fracs = [
+                frac * min_positive_lenght / length / max(fracs_pt_norm)
+                    for frac, length in zip(fracs_pt_norm, lengths) if length > 0
+            ]
+            for frac, length, df_bkg in zip(fracs_pt_norm, lengths, dfs_prd_bkg_orig_pt):
+                if length > 0:
+                    sample_frac = frac * min_positive_lenght / length / max(fracs_pt_norm) / max(sample_fracs)
+                    if sample_frac == 1.:
+                        dfs_prd_bkg_sampled_pt.append(df_bkg)
+                    else:
+                        dfs_prd_bkg_sampled_pt.append(
+                            df_bkg.sample(frac=sample_frac, random_state=42))
+
+            dfs_prd_bkg_pt.append(pd.concat(dfs_prd_bkg_sampled_pt))
+        else:
+            dfs_prd_bkg_pt = dfs_prd_bkg_orig_pt
+
+        for i_bkg, (bkg, df_prd_bkg) in enumerate(zip(correlated_bkgs, dfs_prd_bkg_pt)):
+            data_hdls_prd_bkg.append(DataHandler(df_prd_bkg, var_name="fM",
+                                                 limits=cfg["fit_configs"]["mass_limits"][ipt],
+                                                 nbins=cfg["plot_style"]["n_bins"][ipt]))
+            bkg_funcs.insert(i_bkg, "kde_grid")
+            if cfg["fit_configs"]["bkg_templ_opt"][ipt] == 0:
+                label_bkg_pdf.insert(i_bkg, bkg["name"])
+            else:
+                label_bkg_pdf.insert(i_bkg, "Correlated backgrounds")
+
+        if cfg["fit_configs"]["bkg_templ_opt"][ipt] == 0:
+            data_hdl_dka_pt = DataHandler(dfs_prd_bkg_pt[-1], var_name="fM",
+                        limits=cfg["fit_configs"]["mass_limits"][ipt],
+                        nbins=cfg["plot_style"]["n_bins"][ipt])
+            bkg_funcs.insert(len(dfs_prd_bkg_pt) - 1, "kde_grid")
+            label_bkg_pdf.insert(i_bkg, cfg["fit_configs"]["b_to_dk_bkg"]["name"])
+
+    fitter_pt = F2MassFitter(data_hdl,
+                             cfg["fit_configs"]["signal_funcs"][ipt],
+                             bkg_funcs,
+                             name=f"{particle}_pt{pt_min:.0f}_{pt_max:.0f}",
+                             label_signal_pdf=[rf"$\mathrm{{{particle_name}}}$ signal"],
+                             label_bkg_pdf=label_bkg_pdf
+                             )
+    if use_corr_bkg_pt:
+        for i_bkg, (bkg, data_hdl_prd_bkg) in enumerate(zip(correlated_bkgs, data_hdls_prd_bkg)):
+            fitter_pt.set_background_kde(i_bkg, data_hdl_prd_bkg)
+            if i_bkg == 0:
+                if cfg["fit_configs"]["fix_correlated_bkg_to_signal"][ipt]:
+                    if cfg["fit_configs"]["bkg_templ_opt"][ipt] == 0:
+                        fitter_pt.fix_bkg_frac_to_signal_pdf(i_bkg, 0, fracs_pt[i_bkg])
+                    else:
+                        fitter_pt.fix_bkg_frac_to_signal_pdf(i_bkg, 0, sum(fracs_pt))
+                continue
+            denom = data_hdls_prd_bkg[0].get_norm() * correlated_bkgs[0]["br_pdg"] / correlated_bkgs[0]["br_sim"]
+            fitter_pt.fix_bkg_frac_to_bkg_pdf(
+                i_bkg, 0,
+                data_hdl_prd_bkg.get_norm() * bkg["br_pdg"] / bkg["br_sim"] / denom
+            )
+
+        if cfg["fit_configs"]["bkg_templ_opt"][ipt] == 0:
+            fitter_pt.set_background_kde(len(dfs_prd_bkg_pt) - 1, data_hdl_dka_pt)
+            denom = len(df_mc_dk_sig_pt) * cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["sim"]
+            fitter_pt.fix_bkg_frac_to_signal_pdf(
+                len(dfs_prd_bkg_pt) - 1, 0,
+                data_hdl_dka_pt.get_norm() * cfg["fit_configs"]["b_to_dk_bkg"]["br_pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["br_sim"] / denom
+            )
+
+    if not fix_means[ipt]:
+        fitter_pt.set_particle_mass(0, pdg_id=pdg_id, limits=[5., 5.56])
+    else:
+        fitter_pt.set_particle_mass(0, ref_means[ipt], fix=True)  # pylint: disable=too-many-function-args
+    if not fix_sigmas[ipt]:
+        if pt_min == 1 and pt_max == 2:
+            fitter_pt.set_signal_initpar(0, "sigma", 0.03, limits=[0.01, 0.06])
+        else:
+            sigma_init = results["sigmas_mc"] if mc_fit_result["converged"] else 0.03
+            fitter_pt.set_signal_initpar(0, "sigma", sigma_init, limits=[0.01, 0.1])
+    else:
+        fitter_pt.set_signal_initpar(0, "sigma", ref_sigmas[ipt], fix=True)
+    fitter_pt.set_signal_initpar(0, "frac", 0.2, limits=[0., 1.])
+    if use_corr_bkg_pt and not cfg["fit_configs"]["fix_correlated_bkg_to_signal"][ipt]:
+        fitter_pt.set_background_initpar(0, "frac", 0.05, limits=[0., 1.])
+    icombbkg = len(dfs_prd_bkg_pt) if use_corr_bkg_pt else 0
+    fitter_pt.set_background_initpar(icombbkg, "lam", -1.2, limits=[-10., 10.])
+    fitter_pt.set_background_initpar(icombbkg, "c1", -0.05, limits=[-0.2, 0.])
+    fitter_pt.set_background_initpar(icombbkg, "c2", 0.008, limits=[0.000, 0.03])
+    result = fitter_pt.mass_zfit()
+    if result.converged:
+        fig, axs = fitter_pt.plot_mass_fit(
+            style="ATLAS",
+            figsize=(8, 8),
+            axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)",
+            show_extra_info=True,
+            extra_info_loc=["lower right", "lower left"]
+        )
+        add_info_on_canvas(axs, "upper left", "pp", pt_min, pt_max)
+
+        fig_res, axs_res = fitter_pt.plot_raw_residuals(
+            style="ATLAS",
+            figsize=(8, 8),
+            axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
+        )
+        add_info_on_canvas(axs_res, "upper left", "pp", pt_min, pt_max)
+
+        fig.savefig(os.path.join(outdir, f"{particle}_mass_pt{pt_min:.0f}_{pt_max:.0f}.pdf"))
+        fig_res.savefig(os.path.join(outdir, f"{particle}_massres_pt{pt_min:.0f}_{pt_max:.0f}.pdf"))
+
+        rawy, rawy_unc = fitter_pt.get_raw_yield(0)
+        sign, sign_unc = fitter_pt.get_significance(0)
+        soverb, soverb_unc = fitter_pt.get_signal_over_background(0)
+        mean, mean_unc = fitter_pt.get_signal_parameter(0, "mu")
+        sigma, sigma_unc = fitter_pt.get_signal_parameter(0, "sigma")
+
+        results.update({"raw_yields": rawy, "raw_yields_unc": rawy_unc,
+                        "signif": sign, "signif_unc": sign_unc,
+                        "s_over_b": soverb, "s_over_b_unc": soverb_unc,
+                        "means": mean, "means_unc": mean_unc,
+                        "sigmas": sigma, "sigmas_unc": sigma_unc})
+
+        fitter_pt.dump_to_root(
+            outfile_name, option="update", suffix=f"_pt{pt_min:.0f}_{pt_max:.0f}")
+
+    return results
+
+
 def fit(config_file): # pylint: disable=too-many-locals,too-many-statements, too-many-branches
     """
     Main function for fitting
@@ -127,15 +569,6 @@ def fit(config_file): # pylint: disable=too-many-locals,too-many-statements, too
     pt_maxs = cut_set["pt"]["maxs"]
     pt_lims = pt_mins.copy()
     pt_lims.append(pt_maxs[-1])
-    selection_string = ""
-    for ipt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
-        cuts =  [k for k in cut_set.keys() if k != "pt"]
-        if ipt == 0:
-            selection_string += f"({pt_min} < fPt < {pt_max}) "
-        else:
-            selection_string += f" or ({pt_min} < fPt < {pt_max}) "
-        for cut in cuts:
-            selection_string += f" and {cut_set[cut]['mins'][ipt]} < {cut} < {cut_set[cut]['maxs'][ipt]}"
 
     ref_means = [0.03] * len(pt_mins)
     ref_sigmas = [0.03] * len(pt_mins)
@@ -158,11 +591,8 @@ def fit(config_file): # pylint: disable=too-many-locals,too-many-statements, too
     use_corr_bkg_ptint = cfg["fit_configs"]["pt_int"]["use_bkg_templ"]
     use_correlated_bkgs = use_corr_bkg_ptint or any(cfg["fit_configs"]["use_bkg_templ"])
 
-    # load data
-    df = pd.DataFrame()
-    for file in cfg["inputs"]["data"]:
-        df = pd.concat([df, pd.read_parquet(file)])
-    df.query(selection_string, inplace=True)
+    # load data (only the candidates passing the cutset are read)
+    df = read_candidates(cfg["inputs"]["data"], columns=["fM", "fPt"], cut_set=cut_set)
 
     # load mc and build correlated-background templates
     df_mc_sig = pd.DataFrame()
@@ -170,17 +600,12 @@ def fit(config_file): # pylint: disable=too-many-locals,too-many-statements, too
     df_mc_dk_sig = pd.DataFrame()
     correlated_bkgs = []
     dfs_prd_bkg, dfs_prd_bkg_orig, fracs_ptint = [], [], []
-    df_mc = pd.DataFrame()
-    for file in cfg["inputs"]["mc"]:
-        df_mc = pd.concat([df_mc, pd.read_parquet(file)])
-    df_mc.query(selection_string, inplace=True)
+    mc_columns = ["fM", "fPt", "fFlagMcMatchRec", "fPdgCodeBeautyMother", "fPdgCodeCharmMother"]
+    df_mc = read_candidates(cfg["inputs"]["mc"], columns=mc_columns, cut_set=cut_set)
     df_mc_sig = df_mc.query("fFlagMcMatchRec == -1 or fFlagMcMatchRec == 1")
 
     if use_correlated_bkgs:
-        df_mc_dk = pd.DataFrame()
-        for file in cfg["inputs"]["b_to_dk"]:
-            df_mc_dk = pd.concat([df_mc_dk, pd.read_parquet(file)])
-        df_mc_dk.query(selection_string, inplace=True)
+        df_mc_dk = read_candidates(cfg["inputs"]["b_to_dk"], columns=mc_columns, cut_set=cut_set)
         df_mc_dk_bkg = df_mc_dk.query(f"fFlagMcMatchRec == {flag_mc_b_to_dk}")
         df_mc_dk_sig = df_mc_dk.query("fFlagMcMatchRec == -1 or fFlagMcMatchRec == 1")
         if cfg["fit_configs"]["shift_bkg_templ"]:
@@ -226,6 +651,17 @@ def fit(config_file): # pylint: disable=too-many-locals,too-many-statements, too
         else:
             dfs_prd_bkg = dfs_prd_bkg_orig
 
+    # positional indices of the candidates of each pT bin, computed once for all the fits
+    # (the candidates already pass the cutset, hence only the pT bins are needed)
+    pt_selection = CutsetSelection(cut_set)
+    pt_bin_indices = {"df": pt_selection.get_bin_indices(df, apply_cuts=False),
+                      "df_mc_sig": pt_selection.get_bin_indices(df_mc_sig, apply_cuts=False)}
+    if use_correlated_bkgs:
+        pt_bin_indices["df_mc_dk_bkg"] = pt_selection.get_bin_indices(df_mc_dk_bkg, apply_cuts=False)
+        pt_bin_indices["df_mc_dk_sig"] = pt_selection.get_bin_indices(df_mc_dk_sig, apply_cuts=False)
+        pt_bin_indices["dfs_prd_bkg_orig"] = [pt_selection.get_bin_indices(df_bkg, apply_cuts=False)
+                                              for df_bkg in dfs_prd_bkg_orig]
+
     # define output file
     outdir = cfg["outputs"]["directory"]
     outfile_name = os.path.join(outdir,
@@ -233,346 +669,73 @@ def fit(config_file): # pylint: disable=too-many-locals,too-many-statements, too
     file_root = uproot.recreate(outfile_name)
     file_root.close()
 
-    # we first perform a pT-integrated fit
-    if cfg["fit_configs"]["pt_int"]["activate"]: #pylint:disable=too-many-nested-blocks
-        # we first fit MC only
-        data_hdl_mc = DataHandler(df_mc_sig, var_name="fM",
-                                  limits=cfg["fit_configs"]["pt_int"]["mass_limits"],
-                                  nbins=cfg["plot_style"]["pt_int"]["n_bins"])
-        fitter_mc_ptint = F2MassFitter(data_hdl_mc,
-                                       ["doublegaus"],
-                                       ["nobkg"],
-                                       name=f"{particle}_mc_ptint",
-                                       label_signal_pdf=[rf"$\mathrm{{{particle_name}}}$ signal"])
-        fitter_mc_ptint.set_signal_initpar(0, "sigma1", 0.03, limits=[0.01, 0.10])
-        fitter_mc_ptint.set_signal_initpar(0, "sigma2", 0.085, limits=[0.01, 0.25])
-        fitter_mc_ptint.set_particle_mass(0, pdg_id=pdg_id)
-        result = fitter_mc_ptint.mass_zfit()
-        if result.converged:
-            fig, axs = fitter_mc_ptint.plot_mass_fit(
-                style="ATLAS",
-                figsize=(8, 8),
-                axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
-            )
-            add_info_on_canvas(axs, "upper left", "MC pp", pt_mins[0], pt_maxs[-1], fitter_mc_ptint)
-
-            fig_res, axs_res = fitter_mc_ptint.plot_raw_residuals(
-                style="ATLAS",
-                figsize=(8, 8),
-                axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
-            )
-            add_info_on_canvas(axs_res, "upper left", "MC pp", pt_mins[0], pt_maxs[-1], fitter_mc_ptint)
-
-
-            fig.savefig(os.path.join(outdir, f"{particle}_mass_ptint_MC.pdf"))
-            fig_res.savefig(os.path.join(outdir, f"{particle}_massres_ptint_MC.pdf"))
-
-        # then we fit data
-        data_hdl = DataHandler(df, var_name="fM",
-                               limits=cfg["fit_configs"]["pt_int"]["mass_limits"],
-                               nbins=cfg["plot_style"]["pt_int"]["n_bins"])
-        bkg_funcs = cfg["fit_configs"]["pt_int"]["bkg_funcs"]
-        label_bkg_pdf = ["Comb. bkg"]
-        data_hdls_prd_bkg = []
-        if use_corr_bkg_ptint:
-            for i_bkg, (bkg, df_prd_bkg) in enumerate(zip(correlated_bkgs, dfs_prd_bkg)):
-                data_hdls_prd_bkg.append(DataHandler(df_prd_bkg, var_name="fM",
-                                                     limits=cfg["fit_configs"]["pt_int"]["mass_limits"],
-                                                     nbins=cfg["plot_style"]["pt_int"]["n_bins"]))
-                bkg_funcs.insert(i_bkg, "kde_grid")
-                if cfg["fit_configs"]["pt_int"]["bkg_templ_opt"] == 0:
-                    label_bkg_pdf.insert(i_bkg, bkg["name"])
-                else:
-                    label_bkg_pdf.insert(i_bkg, "Correlated backgrounds")
-            if cfg["fit_configs"]["pt_int"]["bkg_templ_opt"] == 0:
-                data_hdl_dka = DataHandler(dfs_prd_bkg[-1], var_name="fM",
-                            limits=cfg["fit_configs"]["pt_int"]["mass_limits"],
-                            nbins=cfg["plot_style"]["pt_int"]["n_bins"])
-                bkg_funcs.insert(len(dfs_prd_bkg) - 1, "kde_grid")
-                label_bkg_pdf.insert(i_bkg, cfg["fit_configs"]["b_to_dk_bkg"]["name"])
-
-        fitter_ptint = F2MassFitter(data_hdl,
-                                    cfg["fit_configs"]["pt_int"]["signal_funcs"],
-                                    bkg_funcs,
-                                    name=f"{particle}_ptint",
-                                    label_signal_pdf=[rf"$\mathrm{{{particle_name}}}$ signal"],
-                                    label_bkg_pdf=label_bkg_pdf)
-
-        if use_corr_bkg_ptint:
-            for i_bkg, (bkg, data_hdl_prd_bkg) in enumerate(zip(correlated_bkgs, data_hdls_prd_bkg)):
-                fitter_ptint.set_background_kde(i_bkg, data_hdl_prd_bkg)
-                if i_bkg == 0:
-                    if cfg["fit_configs"]["pt_int"]["fix_correlated_bkg_to_signal"]:
-                        if cfg["fit_configs"]["pt_int"]["bkg_templ_opt"] == 0:
-                            fitter_ptint.fix_bkg_frac_to_signal_pdf(i_bkg, 0, fracs_ptint[i_bkg])
-                        else:
-                            fitter_ptint.fix_bkg_frac_to_signal_pdf(i_bkg, 0, sum(fracs_ptint))
-                    continue
-                denom = data_hdls_prd_bkg[0].get_norm() * correlated_bkgs[0]["br_pdg"] / correlated_bkgs[0]["br_sim"]
-                fitter_ptint.fix_bkg_frac_to_bkg_pdf(
-                    i_bkg, 0,
-                    data_hdl_prd_bkg.get_norm() * bkg["br_pdg"] / bkg["br_sim"] / denom
-                )
-            if cfg["fit_configs"]["pt_int"]["bkg_templ_opt"] == 0:
-                fitter_ptint.set_background_kde(len(dfs_prd_bkg)-1, data_hdl_dka)
-                denom = len(df_mc_dk_sig) * cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["sim"]
-                fitter_ptint.fix_bkg_frac_to_signal_pdf(
-                    len(dfs_prd_bkg)-1, 0,
-                    data_hdl_dka.get_norm() * cfg["fit_configs"]["b_to_dk_bkg"]["br_pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["br_sim"] / denom
-                )
-
-        fitter_ptint.set_signal_initpar(0, "sigma", 0.03, limits=[0.02, 0.06])
-        fitter_ptint.set_particle_mass(0, pdg_id=pdg_id)
-        icombbkg = len(dfs_prd_bkg) if use_corr_bkg_ptint else 0
-        fitter_ptint.set_background_initpar(icombbkg, "c1", -0.05, limits=[-0.2, 0.])
-        fitter_ptint.set_background_initpar(icombbkg, "c2", 0.008, limits=[0.000, 0.030])
-        fitter_ptint.set_background_initpar(icombbkg, "lam", -1.2, limits=[-10., 10.])
-        fitter_ptint.set_signal_initpar(0, "frac", 0.2, limits=[0., 1.])
-        result = fitter_ptint.mass_zfit()
-        if result.converged:
-            fig, axs = fitter_ptint.plot_mass_fit(
-                style="ATLAS",
-                figsize=(8, 8),
-                axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)",
-                show_extra_info=True,
-                extra_info_loc=["lower right", "lower left"]
-            )
-            add_info_on_canvas(axs, "upper left", "pp", pt_mins[0], pt_maxs[-1])
-
-            fig_res, axs_res = fitter_ptint.plot_raw_residuals(
-                style="ATLAS",
-                figsize=(8, 8),
-                axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
-            )
-            add_info_on_canvas(axs_res, "upper left", "pp", pt_mins[0], pt_maxs[-1])
-
-            fig.savefig(os.path.join(outdir, f"{particle}_mass_ptint.pdf"))
-            fig_res.savefig(os.path.join(outdir, f"{particle}_massres_ptint.pdf"))
-
-            fitter_ptint.dump_to_root(
-                outfile_name, option="update", suffix="_ptint")
-
-    raw_yields, raw_yields_unc = [], []
-    signif, signif_unc, s_over_b, s_over_b_unc = [], [], [], []
-    means, means_unc, sigmas, sigmas_unc = [], [], [], []
-    means_mc, means_mc_unc, sigmas_mc, sigmas_mc_unc = [], [], [], []
-
-    for ipt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)): #pylint:disable=too-many-nested-blocks
-
-        use_corr_bkg_pt = cfg["fit_configs"]["use_bkg_templ"][ipt]
-
-        # we first fit MC only
-        df_mc_sig_pt = df_mc_sig.query(f"{pt_min} < fPt < {pt_max}")
-        data_hdl_mc = DataHandler(df_mc_sig_pt, var_name="fM",
-                                  limits=cfg["fit_configs"]["mass_limits"][ipt],
-                                  nbins=cfg["plot_style"]["n_bins"][ipt])
-        fitter_mc_pt = F2MassFitter(data_hdl_mc,
-                                    ["doublegaus"],
-                                    ["nobkg"],
-                                    name=f"{particle}_mc_pt{pt_min:.0f}_{pt_max:.0f}",
-                                    label_signal_pdf=[rf"$\mathrm{{{particle_name}}}$ signal"])
-        fitter_mc_pt.set_signal_initpar(0, "sigma1", 0.03, limits=[0.01, 0.10])
-        fitter_mc_pt.set_signal_initpar(0, "sigma2", 0.085, limits=[0.01, 0.25])
-        fitter_mc_pt.set_particle_mass(0, pdg_id=pdg_id)
-        result = fitter_mc_pt.mass_zfit()
-        if result.converged:
-            fig, axs = fitter_mc_pt.plot_mass_fit(
-                style="ATLAS",
-                figsize=(8, 8),
-                axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
-            )
-            add_info_on_canvas(axs, "upper left", "MC pp", pt_min, pt_max, fitter_mc_pt)
-
-            fig_res, axs_res = fitter_mc_pt.plot_raw_residuals(
-                style="ATLAS",
-                figsize=(8, 8),
-                axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
-            )
-            add_info_on_canvas(axs_res, "upper left", "MC pp", pt_min, pt_max, fitter_mc_pt)
-
-            fig.savefig(os.path.join(outdir, f"{particle}_mass_pt{pt_min:.0f}_{pt_max:.0f}_MC.pdf"))
-            fig_res.savefig(os.path.join(outdir, f"{particle}_massres_pt{pt_min:.0f}_{pt_max:.0f}_MC.pdf"))
-
-            mean, mean_unc = fitter_mc_pt.get_signal_parameter(0, "mu")
-            sigma1, sigma1_unc = fitter_mc_pt.get_signal_parameter(0, "sigma1")
-            sigma2, sigma2_unc = fitter_mc_pt.get_signal_parameter(0, "sigma2")
-            if sigma1 < sigma2:
-                sigma = sigma1
-                sigma_unc = sigma1_unc
-            else:
-                sigma = sigma2
-                sigma_unc = sigma2_unc
-
-            means_mc.append(mean)
-            means_mc_unc.append(mean_unc)
-            sigmas_mc.append(sigma)
-            sigmas_mc_unc.append(sigma_unc)
-
-        # then we fit data
-        df_pt = df.query(f"{pt_min} < fPt < {pt_max}")
-        data_hdl = DataHandler(df_pt, var_name="fM",
-                               limits=cfg["fit_configs"]["mass_limits"][ipt],
-                               nbins=cfg["plot_style"]["n_bins"][ipt])
-
-        bkg_funcs = cfg["fit_configs"]["bkg_funcs"][ipt]
-        label_bkg_pdf = ["Comb. bkg"]
-        data_hdls_prd_bkg = []
-        dfs_prd_bkg_pt = []
-        fracs_pt = []
-        if use_corr_bkg_pt:
-            df_mc_dk_bkg_pt = df_mc_dk_bkg.query(f"{pt_min} < fPt < {pt_max}")
-            df_mc_dk_sig_pt = df_mc_dk_sig.query(f"{pt_min} < fPt < {pt_max}")
-            den_norm = data_hdl_mc.get_norm() * cfg["fit_configs"]["signal_br"]["pdg"] / \
-                cfg["fit_configs"]["signal_br"]["sim"]
-
-            dfs_prd_bkg_orig_pt = [df.query(f"{pt_min} < fPt < {pt_max}") for df in dfs_prd_bkg_orig]
-            for bkg, df_prd_bkg_orig_pt in zip(correlated_bkgs, dfs_prd_bkg_orig_pt):
-                fracs_pt.append(len(df_prd_bkg_orig_pt) * bkg["br_pdg"] / bkg["br_sim"] / den_norm)
-
-            den_norm = len(df_mc_dk_sig_pt) * cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["sim"]
-            fracs_pt.append(len(df_mc_dk_bkg_pt) * cfg["fit_configs"]["b_to_dk_bkg"]["br_pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["br_sim"] / den_norm)
-
-            sum_fracs = sum(fracs_pt)
-            fracs_pt_norm = [frac / sum_fracs for frac in fracs_pt]
-
-            dfs_prd_bkg_sampled_pt = []
-            if cfg["fit_configs"]["bkg_templ_opt"][ipt] == 1:
-                lengths = [len(df_bkg) for df_bkg in dfs_prd_bkg_orig_pt]
-                min_positive_lenght = min(l for l in lengths if l > 0)
-                sample_fracs = [
-                    frac * min_positive_lenght / length / max(fracs_pt_norm)
-                        for frac, length in zip(fracs_pt_norm, lengths) if length > 0
-                ]
-                for frac, length, df_bkg in zip(fracs_pt_norm, lengths, dfs_prd_bkg_orig_pt):
-                    if length > 0:
-                        sample_frac = frac * min_positive_lenght / length / max(fracs_pt_norm) / max(sample_fracs)
-                        if sample_frac == 1.:
-                            dfs_prd_bkg_sampled_pt.append(df_bkg)
-                        else:
-                            dfs_prd_bkg_sampled_pt.append(
-                                df_bkg.sample(frac=sample_frac, random_state=42))
-
-                dfs_prd_bkg_pt.append(pd.concat(dfs_prd_bkg_sampled_pt))
-            else:
-                dfs_prd_bkg_pt = dfs_prd_bkg_orig_pt
-
-            for i_bkg, (bkg, df_prd_bkg) in enumerate(zip(correlated_bkgs, dfs_prd_bkg_pt)):
-                data_hdls_prd_bkg.append(DataHandler(df_prd_bkg, var_name="fM",
-                                                     limits=cfg["fit_configs"]["mass_limits"][ipt],
-                                                     nbins=cfg["plot_style"]["n_bins"][ipt]))
-                bkg_funcs.insert(i_bkg, "kde_grid")
-                if cfg["fit_configs"]["bkg_templ_opt"][ipt] == 0:
-                    label_bkg_pdf.insert(i_bkg, bkg["name"])
-                else:
-                    label_bkg_pdf.insert(i_bkg, "Correlated backgrounds")
-
-            if cfg["fit_configs"]["bkg_templ_opt"][ipt] == 0:
-                data_hdl_dka_pt = DataHandler(dfs_prd_bkg_pt[-1], var_name="fM",
-                            limits=cfg["fit_configs"]["mass_limits"][ipt],
-                            nbins=cfg["plot_style"]["n_bins"][ipt])
-                bkg_funcs.insert(len(dfs_prd_bkg_pt) - 1, "kde_grid")
-                label_bkg_pdf.insert(i_bkg, cfg["fit_configs"]["b_to_dk_bkg"]["name"])
-
-        fitter_pt = F2MassFitter(data_hdl,
-                                 cfg["fit_configs"]["signal_funcs"][ipt],
-                                 bkg_funcs,
-                                 name=f"{particle}_pt{pt_min:.0f}_{pt_max:.0f}",
-                                 label_signal_pdf=[rf"$\mathrm{{{particle_name}}}$ signal"],
-                                 label_bkg_pdf=label_bkg_pdf
-                                 )
-        if use_corr_bkg_pt:
-            for i_bkg, (bkg, data_hdl_prd_bkg) in enumerate(zip(correlated_bkgs, data_hdls_prd_bkg)):
-                fitter_pt.set_background_kde(i_bkg, data_hdl_prd_bkg)
-                if i_bkg == 0:
-                    if cfg["fit_configs"]["fix_correlated_bkg_to_signal"][ipt]:
-                        if cfg["fit_configs"]["bkg_templ_opt"][ipt] == 0:
-                            fitter_pt.fix_bkg_frac_to_signal_pdf(i_bkg, 0, fracs_pt[i_bkg])
-                        else:
-                            fitter_pt.fix_bkg_frac_to_signal_pdf(i_bkg, 0, sum(fracs_pt))
+    fit_inputs = {
+        "cfg": cfg, "particle": particle, "particle_name": particle_name, "decay_channel": decay_channel,
+        "pdg_id": pdg_id, "outdir": outdir, "df": df, "df_mc_sig": df_mc_sig,
+        "df_mc_dk_bkg": df_mc_dk_bkg, "df_mc_dk_sig": df_mc_dk_sig, "dfs_prd_bkg_orig": dfs_prd_bkg_orig,
+        "dfs_prd_bkg": dfs_prd_bkg, "fracs_ptint": fracs_ptint, "correlated_bkgs": correlated_bkgs,
+        "use_corr_bkg_ptint": use_corr_bkg_ptint, "fix_means": fix_means, "fix_sigmas": fix_sigmas,
+        "ref_means": ref_means, "ref_sigmas": ref_sigmas, "pt_bin_indices": pt_bin_indices
+    }
+
+    # the pT-integrated fit and the fits of the pT bins are independent
+    tasks = []
+    if cfg["fit_configs"]["pt_int"]["activate"]:
+        tasks.append((fit_pt_integrated, ((pt_mins[0], pt_maxs[-1]), "_ptint")))
+    for ipt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
+        tasks.append((fit_pt_bin, (ipt, (pt_min, pt_max), f"_pt{pt_min:.0f}_{pt_max:.0f}")))
+
+    results_pt = [None] * len(pt_mins)
+    failed_suffixes = []
+    max_workers = cfg["multiprocessing"]["max_workers"]
+    if max_workers == 1:
+        init_fit_worker(fit_inputs, None)
+        for task_function, (*task_args, _) in tasks:
+            result = task_function((*task_args, outfile_name))
+            if task_function is fit_pt_bin:
+                results_pt[task_args[0]] = result
+    else:
+        # each task writes its fits in a temporary file, merged in the output file at the end
+        tmp_file_names = []
+        for _, task_args in tasks:
+            tmp_file_names.append(os.path.join(outdir, f"tmp_{particle}_mass{task_args[-1]}.root"))
+            uproot.recreate(tmp_file_names[-1]).close()
+        # spawn instead of fork, TensorFlow is not fork-safe once initialised in the main process
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_fit_worker,
+                                 initargs=(fit_inputs, cfg["multiprocessing"]["zfit_n_cpus_per_worker"])) as executor:
+            futures = [executor.submit(task_function, (*task_args[:-1], tmp_file_name))
+                       for (task_function, task_args), tmp_file_name in zip(tasks, tmp_file_names)]
+            for (task_function, task_args), future in zip(tasks, futures):
+                try:
+                    result = future.result()
+                except Exception:  # pylint: disable=broad-exception-caught
+                    # a failed fit does not stop the others, the failure is reported at the end
+                    print(f"\033[91mERROR: fit{task_args[-1]} failed:\n{traceback.format_exc()}\033[0m")
+                    failed_suffixes.append(task_args[-1])
                     continue
-                denom = data_hdls_prd_bkg[0].get_norm() * correlated_bkgs[0]["br_pdg"] / correlated_bkgs[0]["br_sim"]
-                fitter_pt.fix_bkg_frac_to_bkg_pdf(
-                    i_bkg, 0,
-                    data_hdl_prd_bkg.get_norm() * bkg["br_pdg"] / bkg["br_sim"] / denom
-                )
-
-            if cfg["fit_configs"]["bkg_templ_opt"][ipt] == 0:
-                fitter_pt.set_background_kde(len(dfs_prd_bkg_pt) - 1, data_hdl_dka_pt)
-                denom = len(df_mc_dk_sig_pt) * cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["signal_br"]["sim"]
-                fitter_pt.fix_bkg_frac_to_signal_pdf(
-                    len(dfs_prd_bkg_pt) - 1, 0,
-                    data_hdl_dka_pt.get_norm() * cfg["fit_configs"]["b_to_dk_bkg"]["br_pdg"] / cfg["fit_configs"]["b_to_dk_bkg"]["br_sim"] / denom
-                )
-
-        if not fix_means[ipt]:
-            fitter_pt.set_particle_mass(0, pdg_id=pdg_id, limits=[5., 5.56])
-        else:
-            fitter_pt.set_particle_mass(0, ref_means[ipt], fix=True)  # pylint: disable=too-many-function-args
-        if not fix_sigmas[ipt]:
-            if pt_min == 1 and pt_max == 2:
-                fitter_pt.set_signal_initpar(0, "sigma", 0.03, limits=[0.01, 0.06])
-            else:
-                fitter_pt.set_signal_initpar(0, "sigma", sigmas_mc[ipt], limits=[0.01, 0.1])
-        else:
-            fitter_pt.set_signal_initpar(0, "sigma", ref_sigmas[ipt], fix=True)
-        fitter_pt.set_signal_initpar(0, "frac", 0.2, limits=[0., 1.])
-        if use_corr_bkg_pt and not cfg["fit_configs"]["fix_correlated_bkg_to_signal"][ipt]:
-            fitter_pt.set_background_initpar(0, "frac", 0.05, limits=[0., 1.])
-        icombbkg = len(dfs_prd_bkg_pt) if use_corr_bkg_pt else 0
-        fitter_pt.set_background_initpar(icombbkg, "lam", -1.2, limits=[-10., 10.])
-        fitter_pt.set_background_initpar(icombbkg, "c1", -0.05, limits=[-0.2, 0.])
-        fitter_pt.set_background_initpar(icombbkg, "c2", 0.008, limits=[0.000, 0.03])
-        result = fitter_pt.mass_zfit()
-        if result.converged:
-            fig, axs = fitter_pt.plot_mass_fit(
-                style="ATLAS",
-                figsize=(8, 8),
-                axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)",
-                show_extra_info=True,
-                extra_info_loc=["lower right", "lower left"]
-            )
-            add_info_on_canvas(axs, "upper left", "pp", pt_min, pt_max)
-
-            fig_res, axs_res = fitter_pt.plot_raw_residuals(
-                style="ATLAS",
-                figsize=(8, 8),
-                axis_title=rf"$M(\mathrm{{{decay_channel}}})$ (GeV/$c^2$)"
-            )
-            add_info_on_canvas(axs_res, "upper left", "pp", pt_min, pt_max)
-
-            fig.savefig(os.path.join(outdir, f"{particle}_mass_pt{pt_min:.0f}_{pt_max:.0f}.pdf"))
-            fig_res.savefig(os.path.join(outdir, f"{particle}_massres_pt{pt_min:.0f}_{pt_max:.0f}.pdf"))
-
-            rawy, rawy_unc = fitter_pt.get_raw_yield(0)
-            sign, sign_unc = fitter_pt.get_significance(0)
-            soverb, soverb_unc = fitter_pt.get_signal_over_background(0)
-            mean, mean_unc = fitter_pt.get_signal_parameter(0, "mu")
-            sigma, sigma_unc = fitter_pt.get_signal_parameter(0, "sigma")
-
-            raw_yields.append(rawy)
-            raw_yields_unc.append(rawy_unc)
-            signif.append(sign)
-            signif_unc.append(sign_unc)
-            s_over_b.append(soverb)
-            s_over_b_unc.append(soverb_unc)
-            means.append(mean)
-            means_unc.append(mean_unc)
-            sigmas.append(sigma)
-            sigmas_unc.append(sigma_unc)
-
-            fitter_pt.dump_to_root(
-                outfile_name, option="update", suffix=f"_pt{pt_min:.0f}_{pt_max:.0f}")
+                if task_function is fit_pt_bin:
+                    results_pt[task_args[0]] = result
+        merge_root_files(tmp_file_names, outfile_name)
 
+    # fill the histograms in pT order, 0 for the failed fits
+    results_pt = [result if result is not None else dict.fromkeys(RESULT_KEYS, 0.) for result in results_pt]
+    values = {key: [result[key] for result in results_pt] for key in RESULT_KEYS}
     file_root = uproot.update(outfile_name)
-    file_root["h_rawyields"] = create_hist(pt_lims, raw_yields, raw_yields_unc)
-    file_root["h_significance"] = create_hist(pt_lims, signif, signif_unc)
-    file_root["h_soverb"] = create_hist(pt_lims, s_over_b, s_over_b_unc)
-    file_root["h_means"] = create_hist(pt_lims, means, means_unc)
-    file_root["h_sigmas"] = create_hist(pt_lims, sigmas, sigmas_unc)
-    file_root["h_means_mc"] = create_hist(pt_lims, means_mc, means_mc_unc)
-    file_root["h_sigmas_mc"] = create_hist(pt_lims, sigmas_mc, sigmas_mc_unc)
+    file_root["h_rawyields"] = create_hist(pt_lims, values["raw_yields"], values["raw_yields_unc"])
+    file_root["h_significance"] = create_hist(pt_lims, values["signif"], values["signif_unc"])
+    file_root["h_soverb"] = create_hist(pt_lims, values["s_over_b"], values["s_over_b_unc"])
+    file_root["h_means"] = create_hist(pt_lims, values["means"], values["means_unc"])
+    file_root["h_sigmas"] = create_hist(pt_lims, values["sigmas"], values["sigmas_unc"])
+    file_root["h_means_mc"] = create_hist(pt_lims, values["means_mc"], values["means_mc_unc"])
+    file_root["h_sigmas_mc"] = create_hist(pt_lims, values["sigmas_mc"], values["sigmas_mc_unc"])
     file_root.close()
 
+    if failed_suffixes:
+        print(f"\033[91mERROR: fits {', '.join(failed_suffixes)} failed, their bins are filled with 0\033[0m")
+        sys.exit(1)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Arguments")
     parser.add_argument("--config", "-c", metavar="text", default="config_fit.yml",
@@ -5,7 +5,6 @@ Run: python get_bdt_systematic.py config_file
 """
 
 import argparse
-from concurrent.futures import ProcessPoolExecutor
 import os
 os.environ["CUDA_VISIBLE_DEVICES"] = ""  # pylint: disable=wrong-import-position
 import uproot  # noqa; E402
@@ -20,6 +19,18 @@ import zfit
 from flarefly.utils import Logger  # noqa; E402
 from flarefly.data_handler import DataHandler  # noqa; E402
 from flarefly.fitter import F2MassFitter  # noqa; E402
+import sys
+sys.path.append('utils')  # pylint: disable=wrong-import-position
+from fit_cache import FitCache, get_fit_key  # noqa; E402
+from template_pool import CorrelatedBkgTemplatePool  # noqa; E402
+from df_utils import read_candidates  # noqa; E402
+from cutset_selection import CutsetSelection  # noqa; E402
+from shared_candidates import SharedCandidateStore  # noqa; E402
+from task_journal import TaskJournal, get_group_name, get_inputs_hash, get_task_key  # noqa; E402
+from timeout_runner import run_tasks_with_timeout  # noqa; E402
+
+CANDIDATES = None  # shared-memory store of the candidates, inherited by the forked variations
+TEMPLATE_POOL = None  # pool of correlated backgrounds of the pT bin, built once per pT bin
 
 
 def get_axis_range(df, column, central_value, central_unc, is_ratio=False):
@@ -249,20 +260,24 @@ def draw_cut_variation(df, config, pt_min, pt_max, idx_assigned_syst):  # pylint
     )
 
 
-def load_data_mc_df(config):
+def load_data_mc_df(config, central_cutset):
     """
-    Load the data from the input file.
+    Load the data from the input file, reading only the candidates in the pT bins of the central cutset.
 
     Parameters:
         - config (dict): The configuration object containing input information.
+        - central_cutset (dict): The central cutset (only the pT bins are used).
     Returns:
         - df_data (pandas.DataFrame): The data dataframe.
         - df_mc (pandas.DataFrame): The MC dataframe.
     """
-    df_data = pd.concat([pd.read_parquet(input_file) for input_file in config["inputs"]["data"]])
-    df_mc = pd.concat([pd.read_parquet(input_file) for input_file in config["inputs"]["mc"]])
+    # the selections are varied, hence only the pT ranges are pushed down to the reader
+    skip_vars = [var for var in central_cutset if var != "pt"]
+    df_data = read_candidates(config["inputs"]["data"], cut_set=central_cutset, skip_vars=skip_vars)
+    df_mc = read_candidates(config["inputs"]["mc"], cut_set=central_cutset, skip_vars=skip_vars)
     if config["inputs"]["mc_for_efficiency"] is not None:
-        df_mc_for_efficiency = pd.concat([pd.read_parquet(input_file) for input_file in config["inputs"]["mc_for_efficiency"]])
+        df_mc_for_efficiency = read_candidates(config["inputs"]["mc_for_efficiency"],
+                                               cut_set=central_cutset, skip_vars=skip_vars)
     else:
         df_mc_for_efficiency = df_mc
     return df_data, df_mc, df_mc_for_efficiency
@@ -324,6 +339,8 @@ def get_fit_config(config, i_pt):
             - "n_bins": Number of bins for the given pt bin.
             - "sigma": Fixed sigma value if specified in the config, otherwise None.
             - "mean": Fixed mean value if specified in the config, otherwise None.
+            - "bkg_init_pars": Initial values of the combinatorial background parameters
+                replacing the default ones (None to keep the default ones).
     """
     with open(config["fit"]["fit_config"], 'r', encoding="utf8") as f:
         fit_config = yaml.safe_load(f)
@@ -347,6 +364,7 @@ def get_fit_config(config, i_pt):
         "correlated_bkgs": fit_config["fit_configs"]["correlated_bkgs"],
         "signal_br": fit_config["fit_configs"]["signal_br"],
         "corr_bkg_frac": None,
+        "bkg_init_pars": None,
         "i_pt": i_pt
     }
 
@@ -410,15 +428,54 @@ def build_fitter(df_data, df_mc_prd_bkg, fit_config):
         fitter.set_signal_initpar(0, "sigma", 0.04, limits=[0.01, 0.08])
     fitter.set_signal_initpar(0, "frac", 0.05, limits=[0., 1.])
 
+    init_pars = {"c1": -0.05, "c2": 0.008}
+    if fit_config["bkg_init_pars"] is not None:
+        init_pars.update(fit_config["bkg_init_pars"])
     fitter.set_background_initpar(1, "c0", 1.)
-    fitter.set_background_initpar(1, "c1", -0.05, limits=[-2, 2.])
-    fitter.set_background_initpar(1, "c2", 0.008, limits=[0.000, 0.5])
+    fitter.set_background_initpar(1, "c1", init_pars["c1"], limits=[-2, 2.])
+    fitter.set_background_initpar(1, "c2", init_pars["c2"], limits=[0.000, 0.5])
 
     fitter.fix_bkg_frac_to_signal_pdf(0, 0, fit_config["corr_bkg_frac"])
 
     return fitter
 
 
+def get_mc_signal_parameters(df_mc_sig, fit_config, cache_dir):
+    """
+    Get mean and width of the MC signal peak from a Gaussian fit, the fit is
+    performed only if not found in the on-disk cache (non-converged fits included).
+
+    Parameters:
+    - df_mc_sig (pd.DataFrame): DataFrame containing the selected MC signal.
+    - fit_config (dict): Configuration dictionary for the fit.
+    - cache_dir (str): Directory of the cache of the MC signal fits (None to always perform the fit).
+
+    Returns:
+    - mean, sigma (float, float): Mean and width of the signal peak (None if the fit did not converge).
+    """
+    fit_cache = FitCache(cache_dir)
+    fit_key = get_fit_key(df_mc_sig["fM"].to_numpy(), model="gaussian", fit_limits=fit_config["mass_limits"],
+                          nbins=fit_config["n_bins"], pdg_code=511, sigma_init=[0.03, 0.01, 0.08])
+    fit_result = fit_cache.load(fit_key)
+    if fit_result is not None and not fit_result["converged"]:
+        return None, None
+    if fit_result is None:
+        data_hdl_mc = DataHandler(df_mc_sig, var_name="fM", limits=fit_config["mass_limits"],
+                                  nbins=fit_config["n_bins"])
+        fitter = F2MassFitter(data_hdl_mc, ["gaussian"], ["nobkg"],
+                              name=f"b0_mc_{fit_config['i_pt']}_{fit_config['i_var']}", verbosity=0)
+        fitter.set_signal_initpar(0, "sigma", 0.03, limits=[0.01, 0.08])
+        fitter.set_particle_mass(0, pdg_id=511)
+        result = fitter.mass_zfit()
+        if not result.converged:
+            fit_cache.save(fit_key, {"converged": False})
+            return None, None
+        fit_result = {"mu": fitter.get_mass(0)[0], "sigma": fitter.get_sigma(0)[0], "converged": True}
+        fit_cache.save(fit_key, fit_result)
+
+    return fit_result["mu"], fit_result["sigma"]
+
+
 def get_fit_results(fitter, result):
     """
     Extract and return the fit results from a fitter object.
@@ -519,13 +576,14 @@ def get_corr_rawy(results):
     return corr_rawy, corr_rawy_unc
 
 
-def run_variation(df_data, df_mc, df_mc_eff, selection, config, fit_config):  # pylint: disable=too-many-locals
+def run_variation(df_data, df_mc, df_mc_eff, template_pool, selection, config, fit_config):  # pylint: disable=too-many-locals,too-many-arguments # noqa: E501
     """
     Run the variation for the given selection.
 
     Args:
         - df_data (pandas.DataFrame): The data dataframe.
         - df_mc (pandas.DataFrame): The MC dataframe.
+        - template_pool (CorrelatedBkgTemplatePool): The pool of correlated backgrounds of the pT bin.
         - selection (str): The selection string to apply.
     Returns:
         - results (dict): A dictionary containing the results of the variation.
@@ -536,23 +594,15 @@ def run_variation(df_data, df_mc, df_mc_eff, selection, config, fit_config):  #
     df_mc_sel_sig = df_mc_sel.query("abs(fFlagMcMatchRec) == 1")
     df_mc_eff_sig = df_mc_eff.query("abs(fFlagMcMatchRec) == 1")
     df_mc_eff_sel_sig = df_mc_eff_sig.query(selection)
-    df_mc_prd_bkg = df_mc_sel.query("fFlagMcMatchRec == 8")
+    if config["fit"]["sigma_from_mc_fit"]:
+        # sigma fixed to the one of the MC signal with the same selection
+        _, sigma_mc = get_mc_signal_parameters(df_mc_sel_sig, fit_config, config["fit"]["mc_fit_cache_dir"])
+        if sigma_mc is not None:
+            fit_config.update({"sigma": sigma_mc})
 
-    dfs_prd_bkg_orig = []
-    fracs = []
     den_norm = len(df_mc_sel_sig) * fit_config["signal_br"]["pdg"] / fit_config["signal_br"]["sim"]
-    for bkg in fit_config["correlated_bkgs"]:
-        df_prd_bkg = df_mc_prd_bkg.query(f"fPdgCodeBeautyMother == {bkg['beauty_id']} and "
-                                         f"fPdgCodeCharmMother == {bkg['charm_id']}")
-        dfs_prd_bkg_orig.append(df_prd_bkg)
-        fracs.append(len(df_prd_bkg) * bkg["br_pdg"] / bkg["br_sim"] / den_norm)
-    sum_fracs = sum(fracs)
-    fracs_norm = [frac / sum_fracs for frac in fracs]
-
-    dfs_prd_bkg_sampled = []
-    for frac, df_bkg in zip(fracs_norm, dfs_prd_bkg_orig):
-        dfs_prd_bkg_sampled.append(df_bkg.sample(frac=frac, random_state=42))
-    df_prd_bkg_sampled = pd.concat(dfs_prd_bkg_sampled)
+    df_prd_bkg_sampled, fracs = template_pool.get_template(
+        den_norm, score_range=[fit_config["min_selection"], fit_config["max_selection"]])
     fit_config.update({"corr_bkg_frac": sum(fracs)})
 
     # get the raw yields
@@ -586,10 +636,67 @@ def run_variation(df_data, df_mc, df_mc_eff, selection, config, fit_config):  #
         "min_selection": fit_config["min_selection"],
         "max_selection": fit_config["max_selection"]
     })
-    del df_data_sel, df_mc_sel, df_mc_sel_sig, df_mc_prd_bkg, fitter
+    del df_data_sel, df_mc_sel, df_mc_sel_sig, df_prd_bkg_sampled, fitter
     return variation_results
 
 
+def set_variation_inputs(candidate_store, i_pt, correlated_bkgs):
+    """
+    Set the shared-memory store of the candidates (no new attachment) and build the
+    pool of correlated backgrounds of the pT bin, inherited by the forked variations.
+
+    Parameters:
+        - candidate_store (SharedCandidateStore): The store of the candidates.
+        - i_pt (int): The index of the pT bin.
+        - correlated_bkgs (list): The correlated backgrounds.
+    """
+    global CANDIDATES, TEMPLATE_POOL  # pylint: disable=global-statement
+    CANDIDATES = candidate_store
+    TEMPLATE_POOL = CorrelatedBkgTemplatePool(CANDIDATES.get_df(f"mc_{i_pt}").query("fFlagMcMatchRec == 8"),
+                                              correlated_bkgs)
+
+
+def run_variation_task(args, i_attempt=0):
+    """
+    Run the variation of a pT bin with the candidates of the shared-memory store.
+
+    Args:
+        - args (tuple): The pT bin index, the selection string, the configuration and the fit configuration.
+        - i_attempt (int): The index of the attempt, the retries of timed-out variations
+            use the alternative initial background parameters.
+    Returns:
+        - results (dict): A dictionary containing the results of the variation.
+    """
+    i_pt, selection, config, fit_config = args
+    if i_attempt > 0:
+        fit_config.update({"bkg_init_pars": config["fit"]["retry_bkg_init_pars"][i_attempt - 1]})
+    results = run_variation(CANDIDATES.get_df(f"data_{i_pt}"), CANDIDATES.get_df(f"mc_{i_pt}"),
+                            CANDIDATES.get_df(f"mc_eff_{i_pt}"), TEMPLATE_POOL, selection, config, fit_config)
+    results.update({"timed_out": False})
+    return results
+
+
+def get_not_converged_variation(fit_config, timed_out):
+    """
+    Get the results of a variation whose fit did not finish (timed out or failed), recorded as not converged.
+
+    Args:
+        - fit_config (dict): The fit configuration of the variation.
+        - timed_out (bool): Whether the variation timed out.
+    Returns:
+        - results (dict): A dictionary containing the results of the variation set to None.
+    """
+    results = dict.fromkeys(["rawy", "rawy_unc", "significance", "significance_unc", "soverb", "soverb_unc",
+                             "mean", "mean_unc", "sigma", "sigma_unc", "chi2",
+                             "eff", "eff_unc", "corr_rawy", "corr_rawy_unc"])
+    results.update({
+        "min_selection": fit_config["min_selection"],
+        "max_selection": fit_config["max_selection"],
+        "timed_out": timed_out
+    })
+    return results
+
+
 def get_rms_shift_sum_quadrature(df, cfg, i_pt, rel=False):
     """
     Calculate the sum in quadrature of the RMS and shift from the central value for raw yields.
@@ -731,57 +838,113 @@ def cut_variation(config_file_name, draw_only=False):  # pylint: disable=too-man
     print(min_selections)
     print(max_selections)
 
-    df_data, df_mc, df_mc_eff = load_data_mc_df(config)
-
-    idx_assigned_syst = 0
-    out_dfs = []
-    for i_pt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
+    df_data, df_mc, df_mc_eff = load_data_mc_df(config, central_cutset)
+    # candidates of each pT bin (the selections are varied, hence not applied)
+    pt_selection = CutsetSelection(central_cutset)
+    data_indices = pt_selection.get_bin_indices(df_data, apply_cuts=False)
+    mc_indices = pt_selection.get_bin_indices(df_mc, apply_cuts=False)
+    mc_eff_indices = pt_selection.get_bin_indices(df_mc_eff, apply_cuts=False)
+    candidate_store = None
+    try:
+        # candidates of each pT bin in shared memory, so that the variations do not copy them
         if not draw_only:
-            if config["cut_variations"]["pt_bins"] is not None:
-                if i_pt not in config["cut_variations"]["pt_bins"]:
-                    out_dfs.append(None)
-                    continue
-            fit_config = get_fit_config(config, i_pt)
-            df_data_pt = df_data.query(f"{pt_min} < fPt < {pt_max}")
-            df_mc_pt = df_mc.query(f"{pt_min} < fPt < {pt_max}")
-            df_mc_eff_pt = df_mc_eff.query(f"{pt_min} < fPt < {pt_max}")
-            results = []
-            with ProcessPoolExecutor(max_workers=config["max_workers"]) as executor:
-                for i_var, (min_selection, max_selection) in enumerate(zip(min_selections[i_pt], max_selections[i_pt])):  # pylint: disable=line-too-long # noqa: E501
+            data_columns = ["fM", "fPt", "ML_output"]
+            mc_columns = data_columns + ["fFlagMcMatchRec", "fPdgCodeBeautyMother", "fPdgCodeCharmMother"]
+            dfs_shared = {}
+            for i_pt, (indices, mc_idx, mc_eff_idx) in enumerate(zip(data_indices, mc_indices, mc_eff_indices)):
+                dfs_shared[f"data_{i_pt}"] = df_data[data_columns].iloc[indices]
+                dfs_shared[f"mc_{i_pt}"] = df_mc[mc_columns].iloc[mc_idx]
+                dfs_shared[f"mc_eff_{i_pt}"] = df_mc_eff[["fPt", "ML_output", "fFlagMcMatchRec"]].iloc[mc_eff_idx]
+            candidate_store = SharedCandidateStore(dfs=dfs_shared)
+            inputs_hashes = [get_inputs_hash(*[dfs_shared[f"{name}_{i_pt}"][col].to_numpy()
+                                               for name in ["data", "mc", "mc_eff"]
+                                               for col in dfs_shared[f"{name}_{i_pt}"].columns])
+                             for i_pt in range(len(pt_mins))]
+            del dfs_shared, df_data, df_mc, df_mc_eff
+        # the completed variations are journaled, so that an interrupted run is resumed, in groups specific
+        # to the selections, settings, inputs and output file of each pT bin
+        journal = TaskJournal(config["output"]["task_journal"])
+        journal_groups = [
+            get_group_name(f"BDT_{pt_min * 10:.0f}_{pt_max * 10:.0f}", min_selections=min_selections[i_pt],
+                           max_selections=max_selections[i_pt], fit=config["fit"], inputs=config["inputs"],
+                           efficiency_file=config["efficiency_file"], output_file=os.path.abspath(os.path.join(
+                               os.path.expanduser(f"{config['output']['output_dir']}"),
+                               f"BDT_{pt_min * 10:.0f}_{pt_max * 10:.0f}.parquet")))
+            for i_pt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs))
+        ]
+
+        idx_assigned_syst = 0
+        out_dfs = []
+        for i_pt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
+            if not draw_only:
+                if config["cut_variations"]["pt_bins"] is not None:
+                    if i_pt not in config["cut_variations"]["pt_bins"]:
+                        out_dfs.append(None)
+                        continue
+                fit_config = get_fit_config(config, i_pt)
+                results, tasks, task_infos = [], [], []
+                for i_var, (min_selection, max_selection) in enumerate(zip(min_selections[i_pt], max_selections[i_pt])):
                     fit_config.update({
                         "i_var": i_var,
                         "min_selection": min_selection,
                         "max_selection": max_selection
                     })
                     selection = f"{min_selection} < ML_output < {max_selection}"
-                    results.append(executor.submit(
-                        run_variation, df_data_pt, df_mc_pt, df_mc_eff_pt,
-                        selection, config, fit_config.copy()
-                    ))
-
-            merge_and_clean_pdfs(config, pt_min, pt_max, i_pt)
-            out_df = []
-            for result in results:
-                result = result.result()
-                # Wrap into list to avoid ValueError: If using all scalar values, you must pass an index
-                out_df.append(pd.DataFrame([result]))
-
-            out_df = pd.concat(out_df)
-            if not os.path.exists(os.path.expanduser(f"{config['output']['output_dir']}")):
-                os.makedirs(os.path.expanduser(f"{config['output']['output_dir']}"))
-            out_df.to_parquet(os.path.join(
-                os.path.expanduser(f"{config['output']['output_dir']}"),
-                f"BDT_{pt_min * 10:.0f}_{pt_max * 10:.0f}.parquet")
-            )
-        else:
-            out_df = pd.read_parquet(os.path.join(
-                os.path.expanduser(f"{config['output']['output_dir']}"),
-                f"BDT_{pt_min * 10:.0f}_{pt_max * 10:.0f}.parquet")
-            )
-        out_dfs.append(out_df)
-
-        draw_cut_variation(out_df, config, pt_min, pt_max, idx_assigned_syst)
-        idx_assigned_syst += 1
+                    task_key = get_task_key(inputs=inputs_hashes[i_pt], selection=selection, fit_config=fit_config,
+                                            fit=config["fit"], efficiency_file=config["efficiency_file"])
+                    results.append(journal.get(task_key))
+                    if results[-1] is None:
+                        tasks.append((i_pt, selection, config, fit_config.copy()))
+                        task_infos.append((i_var, task_key))
+                # each variation has a wall-clock budget, the hanging fits are killed
+                for i_task, status, result, i_attempt in run_tasks_with_timeout(
+                        run_variation_task, tasks, config["max_workers"], timeout=config["timeout"],
+                        n_retries=len(config["fit"]["retry_bkg_init_pars"]), setup=set_variation_inputs,
+                        setup_args=(candidate_store, i_pt, fit_config["correlated_bkgs"])):
+                    i_var, task_key = task_infos[i_task]
+                    if status == "done":
+                        results[i_var] = result
+                        journal.append(task_key, result, group=journal_groups[i_pt])
+                        continue
+                    # timed-out and failed variations are not journaled, so that they are tried again in the next run
+                    if status == "timeout":
+                        Logger(f"The variation {i_var} of the pT bin {i_pt} timed out after {i_attempt + 1} "
+                               "attempt(s), recorded as not converged", "WARNING")
+                    else:
+                        Logger(f"The variation {i_var} of the pT bin {i_pt} failed, recorded as not converged:\n"
+                               f"{result}", "ERROR")
+                    results[i_var] = get_not_converged_variation(tasks[i_task][3], status == "timeout")
+
+                merge_and_clean_pdfs(config, pt_min, pt_max, i_pt)
+                out_df = []
+                for result in results:
+                    # Wrap into list to avoid ValueError: If using all scalar values, you must pass an index
+                    out_df.append(pd.DataFrame([result]))
+
+                out_df = pd.concat(out_df)
+                if not os.path.exists(os.path.expanduser(f"{config['output']['output_dir']}")):
+                    os.makedirs(os.path.expanduser(f"{config['output']['output_dir']}"))
+                out_df.to_parquet(os.path.join(
+                    os.path.expanduser(f"{config['output']['output_dir']}"),
+                    f"BDT_{pt_min * 10:.0f}_{pt_max * 10:.0f}.parquet")
+                )
+            elif os.path.isfile(os.path.join(os.path.expanduser(f"{config['output']['output_dir']}"),
+                                             f"BDT_{pt_min * 10:.0f}_{pt_max * 10:.0f}.parquet")):
+                out_df = pd.read_parquet(os.path.join(
+                    os.path.expanduser(f"{config['output']['output_dir']}"),
+                    f"BDT_{pt_min * 10:.0f}_{pt_max * 10:.0f}.parquet")
+                )
+            else:
+                # sweep not completed, the variations in the journal are drawn
+                out_df = pd.DataFrame(journal.get_group(journal_groups[i_pt]))
+            out_dfs.append(out_df)
+
+            draw_cut_variation(out_df, config, pt_min, pt_max, idx_assigned_syst)
+            idx_assigned_syst += 1
+    finally:
+        # the shared memory is released also if the variations are interrupted
+        if candidate_store is not None:
+            candidate_store.close()
     dump_results_to_root(out_dfs, config, central_cutset)
 
 
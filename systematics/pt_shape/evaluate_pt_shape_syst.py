@@ -3,10 +3,13 @@ Script to evaluate pt-shape systematic uncertainty for B0 mesons
 """
 
 import argparse
+import sys
 import pandas as pd
 import numpy as np
 import yaml
 import ROOT
+sys.path.append('../../utils')  # pylint: disable=wrong-import-position
+from df_utils import read_candidates  # pylint: disable=import-error # noqa: E402
 
 def set_style(histo, color):
     """
@@ -84,26 +87,12 @@ def evaluate_systematics(infile_fonll, infile_gen, infiles_reco, cutset):
     hist_pt_weights_max = hist_pt_fonll_max.Clone("hist_pt_weights_max")
     hist_pt_weights_max.Divide(hist_pt_gen_norm)
 
-    # load reco
-    df = pd.DataFrame()
-    for infile in infiles_reco:
-        df = pd.concat([df, pd.read_parquet(infile)])
-    # apply selections
-
     with open(cutset, "r") as yml_cfg:  # pylint: disable=unspecified-encoding
         cfg = yaml.load(yml_cfg, yaml.FullLoader)
 
-    string_selection = ""
-    for ipt, (pt_min, pt_max, cut) in enumerate(zip(cfg["pt"]["mins"],
-                                                    cfg["pt"]["maxs"],
-                                                    cfg["ML_output"]["mins"])): 
-
-        if ipt < len(cfg["pt"]["mins"])-1:
-            string_selection += f"({pt_min} < fPt < {pt_max} and ML_output > {cut}) or "
-        else:
-            string_selection += f"({pt_min} < fPt < {pt_max} and ML_output > {cut})"
-
-    df_sel = df.query(string_selection)
+    # load reco applying the selections (only lower ML_output cuts)
+    skip_vars = [var for var in cfg if var not in ("pt", "ML_output")]
+    df_sel = read_candidates(infiles_reco, columns=["fPt"], cut_set=cfg, skip_vars=skip_vars, lower_only=True)
 
     hist_pt_reco = hist_pt_gen.Clone("hist_reco")
     hist_pt_reco.Reset()
@@ -9,8 +9,8 @@ import re
 import argparse
 import itertools
 import os
+import sys
 os.environ["CUDA_VISIBLE_DEVICES"] = ""  # pylint: disable=wrong-import-position
-from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import yaml
 import uproot
@@ -22,6 +22,14 @@ import zfit
 from flarefly.data_handler import DataHandler
 from flarefly.fitter import F2MassFitter
 from flarefly.utils import Logger
+sys.path.append('utils')  # pylint: disable=wrong-import-position
+from df_utils import read_candidates  # noqa: E402
+from cutset_selection import CutsetSelection  # noqa: E402
+from shared_candidates import SharedCandidateStore  # noqa: E402
+from task_journal import TaskJournal, get_group_name, get_inputs_hash, get_task_key  # noqa: E402
+from timeout_runner import run_tasks_with_timeout  # noqa: E402
+
+CANDIDATES = None  # shared-memory store of the candidates, inherited by the forked trials
 
 
 def draw_multitrial(df_multitrial, cfg, pt_min, pt_max, idx_assigned_syst, h_rawy, h_sigma):  # pylint: disable=too-many-locals, too-many-statements # noqa: 501
@@ -223,29 +231,31 @@ def get_input_data(cfg, pt_mins, pt_maxs, bdt_cut_mins, bdt_cut_maxs):  # pylint
             to be fixed in the fit
     """
 
-    # pt integrated dataframes
+    # pt integrated dataframes, only the candidates in the selected pT and BDT ranges are read
+    cut_set = {"pt": {"mins": pt_mins, "maxs": pt_maxs},
+               "ML_output": {"mins": bdt_cut_mins, "maxs": bdt_cut_maxs}}
     # load data
-    df_data = pd.DataFrame()
-    for file in cfg["inputs"]["data"]:
-        df_data = pd.concat([df_data, pd.read_parquet(file)])
+    df_data = read_candidates(cfg["inputs"]["data"], columns=["fM", "fPt", "ML_output"], cut_set=cut_set)
     # load mc
-    df_mc = pd.DataFrame()
-    for file in cfg["inputs"]["mc"]:
-        df_mc = pd.concat([df_mc, pd.read_parquet(file)])
+    df_mc = read_candidates(cfg["inputs"]["mc"], cut_set=cut_set,
+                            columns=["fM", "fPt", "ML_output", "fFlagMcMatchRec",
+                                     "fPdgCodeBeautyMother", "fPdgCodeCharmMother"])
 
     correlated_bkgs = cfg["correlated_bkgs"]
 
-    dfs_data, dfs_prd_bkg_orig, dfs_prd_bkg_av, fracs_singlecontr = ([] for _ in range(4))
-    for ipt, (pt_min, pt_max, bdt_cut_min, bdt_cut_max) in enumerate(zip(pt_mins, pt_maxs,
-                                                                         bdt_cut_mins, bdt_cut_maxs)):
+    # candidates of each pT bin passing its BDT selection
+    selection = CutsetSelection(cut_set)
+    data_indices = selection.get_bin_indices(df_data)
+    mc_indices = selection.get_bin_indices(df_mc)
 
-        selection_string = f"({pt_min} < fPt < {pt_max} and {bdt_cut_min} < ML_output < {bdt_cut_max})"
+    dfs_data, dfs_prd_bkg_orig, dfs_prd_bkg_av, fracs_singlecontr = ([] for _ in range(4))
+    for ipt in range(len(pt_mins)):
 
         # data
-        dfs_data.append(df_data.query(selection_string))
+        dfs_data.append(df_data.iloc[data_indices[ipt]])
 
         # mc
-        df_mc_pt = df_mc.query(selection_string)
+        df_mc_pt = df_mc.iloc[mc_indices[ipt]]
         dfs_mc_sig = df_mc_pt.query("fFlagMcMatchRec == -1 or fFlagMcMatchRec == 1")
 
         # mc correlated bkgs
@@ -360,7 +370,7 @@ def build_data_handlers(trial, df_pt, df_mc_prd_bkg_pt, df_mc_prd_bkg_av_pt):
 
 def build_fitter(
         trial, data_hdl, data_hdl_prd_bkg,
-        mean_with_unc, sigma_with_unc, fitter_suffix, cfg, fracs
+        mean_with_unc, sigma_with_unc, fitter_suffix, cfg, fracs, bkg_init_pars=None
     ):  # pylint: disable=too-many-arguments,too-many-branches,too-many-statements # noqa: 121, 125
     """
     Build a flarefly mass fitter for fitting the data candidate distribution.
@@ -376,6 +386,8 @@ def build_fitter(
     - cfg (dict): config for labels of correlated backgrounds
     - fracs (list): fractions of correlated backgrounds
     - sigma_mc ()
+    - bkg_init_pars (dict): initial values of the combinatorial background parameters
+        replacing the default ones (None to keep the default ones)
 
     Returns:
     - fitter (flarefly.F2MassFitter): The mass fitter object.
@@ -444,10 +456,13 @@ def build_fitter(
                                   limits=[sigma_with_unc[0] * 0.5, sigma_with_unc[0] * 1.5])
 
     icombbkg = len(data_hdl_prd_bkg)
-    fitter.set_background_initpar(icombbkg, "lam", -1.2, limits=[-10., 10.])
-    fitter.set_background_initpar(icombbkg, "c1", -0.05, limits=[-2., 2.])
-    fitter.set_background_initpar(icombbkg, "c2", 0.008, limits=[0.000, 0.2])
-    fitter.set_background_initpar(icombbkg, "c3", 0.008, limits=[-0.1, 0.1])
+    init_pars = {"lam": -1.2, "c1": -0.05, "c2": 0.008, "c3": 0.008}
+    if bkg_init_pars is not None:
+        init_pars.update(bkg_init_pars)
+    fitter.set_background_initpar(icombbkg, "lam", init_pars["lam"], limits=[-10., 10.])
+    fitter.set_background_initpar(icombbkg, "c1", init_pars["c1"], limits=[-2., 2.])
+    fitter.set_background_initpar(icombbkg, "c2", init_pars["c2"], limits=[0.000, 0.2])
+    fitter.set_background_initpar(icombbkg, "c3", init_pars["c3"], limits=[-0.1, 0.1])
 
     return fitter
 
@@ -603,21 +618,105 @@ def dump_results_to_root(dfs, cfg, h_rawy, h_sigma, cut_set):
         f["assigned_syst"] = (np.array(assigned_syst), pt_edges)
 
 
-def process_trial(args):
-    """Process a single trial."""
-    trial, dfs_data, dfs_mc_prd_bkg, dfs_mc_prd_bkg_av, h_mean_mc, h_sigma_mc, fracs_prd_bkg, cfg, i_pt, pt_min, pt_max, i_trial = args
+def get_candidate_store(dfs_data, dfs_mc_prd_bkg, dfs_mc_prd_bkg_av):
+    """
+    Store the candidates used by the trials in shared memory (only fM, fPt and ML_output).
+
+    Parameters:
+    - dfs_data (list): List of pandas.DataFrame of the data (one per pT bin).
+    - dfs_mc_prd_bkg (list): List of lists of pandas.DataFrame of the MC partly reco decays
+        (one list with all the contributions per pT bin).
+    - dfs_mc_prd_bkg_av (list): List of pandas.DataFrame of the average of the MC partly reco decays
+        (one per pT bin).
+
+    Returns:
+    - store (SharedCandidateStore): The store, with keys data_<ipt>, prd_bkg_<ipt>_<ibkg> and prd_bkg_av_<ipt>.
+    """
+    columns = ["fM", "fPt", "ML_output"]
+    dfs = {}
+    for i_pt, (df_data, dfs_prd_bkg, df_prd_bkg_av) in enumerate(zip(dfs_data, dfs_mc_prd_bkg, dfs_mc_prd_bkg_av)):
+        dfs[f"data_{i_pt}"] = df_data[columns]
+        for i_bkg, df_prd_bkg in enumerate(dfs_prd_bkg):
+            dfs[f"prd_bkg_{i_pt}_{i_bkg}"] = df_prd_bkg[columns]
+        dfs[f"prd_bkg_av_{i_pt}"] = df_prd_bkg_av[columns]
+
+    return SharedCandidateStore(dfs=dfs)
+
+
+def get_expected_trial_cost(trial, masses_pt, n_correlated_bkgs):
+    """
+    Get the expected (relative) cost of a trial, used to start the longest trials first.
+
+    Parameters:
+    - trial (dict): A dictionary containing the trial parameters.
+    - masses_pt (numpy.ndarray): The sorted invariant masses of the data of the pT bin.
+    - n_correlated_bkgs (int): The number of correlated backgrounds.
+
+    Returns:
+    - cost (float): The number of candidates in the fit range times the number of fitted components.
+    """
+    n_cands = np.searchsorted(masses_pt, trial["maxs"]) - np.searchsorted(masses_pt, trial["mins"])
+    bkg_funcs = trial["bkg_funcs"] if isinstance(trial["bkg_funcs"], list) else [trial["bkg_funcs"]]
+    n_components = 1 + len(bkg_funcs)
+    if trial["use_bkg_templ"]:
+        n_components += n_correlated_bkgs if trial["bkg_templ_opt"] == 0 else 1
+
+    return float(n_cands * n_components)
+
+
+def set_trial_candidates(candidate_store):
+    """Set the shared-memory store of the candidates inherited by the forked trials (no new attachment)."""
+    global CANDIDATES  # pylint: disable=global-statement
+    CANDIDATES = candidate_store
+
+
+def get_not_converged_trial(trial, cfg):
+    """
+    Get the results of a trial whose fit did not finish (e.g. timed out), recorded as not converged.
+
+    Parameters:
+    - trial (dict): A dictionary containing the trial parameters.
+    - cfg (dict): Configuration dictionary.
+
+    Returns:
+    - trial_dict (dict): The trial parameters and the fit results set to None.
+    """
+    trial_dict = dict.fromkeys(["rawy", "rawy_unc", "significance", "significance_unc", "soverb", "soverb_unc",
+                                "mean", "mean_unc", "sigma", "sigma_unc", "chi2_ndf"])
+    for nsigma in cfg["multitrial"]["bincounting_nsigma"]:
+        trial_dict[f"rawy_bincounting_{nsigma}"] = None
+        trial_dict[f"rawy_bincounting_{nsigma}_unc"] = None
+    trial_renamed = trial.copy()
+    trial_renamed['sigma_type'] = trial_renamed.pop('sigma')
+    trial_renamed['mean_type'] = trial_renamed.pop('mean')
+    trial_dict.update(trial_renamed)
+
+    return trial_dict
+
+
+def process_trial(args, i_attempt=0):
+    """
+    Process a single trial, the candidates are taken from the shared-memory store.
+    The retries (i_attempt > 0) of timed-out trials use the alternative initial background parameters.
+    """
+    trial, h_mean_mc, h_sigma_mc, fracs_prd_bkg, cfg, i_pt, pt_min, pt_max, i_trial = args
+    bkg_init_pars = None
+    if i_attempt > 0:
+        bkg_init_pars = cfg["multiprocessing"]["retry_bkg_init_pars"][i_attempt - 1]
 
     suffix = f"{pt_min*10:.0f}_{pt_max*10:.0f}_{i_trial}"
     mean_with_unc = [h_mean_mc.values()[i_pt], h_mean_mc.errors()[i_pt]]
     sigma_with_unc = [h_sigma_mc.values()[i_pt], h_sigma_mc.errors()[i_pt]]
 
+    df_mc_prd_bkg_pt = [CANDIDATES.get_df(f"prd_bkg_{i_pt}_{i_bkg}")
+                        for i_bkg in range(len(cfg["correlated_bkgs"]))]
     data_hdl, data_hdl_prd_bkg = build_data_handlers(
-        trial, dfs_data[i_pt], dfs_mc_prd_bkg[i_pt], dfs_mc_prd_bkg_av[i_pt]
+        trial, CANDIDATES.get_df(f"data_{i_pt}"), df_mc_prd_bkg_pt, CANDIDATES.get_df(f"prd_bkg_av_{i_pt}")
     )
 
     fitter = build_fitter(
         trial, data_hdl, data_hdl_prd_bkg, mean_with_unc, sigma_with_unc,
-        suffix, cfg, fracs_prd_bkg[i_pt]
+        suffix, cfg, fracs_prd_bkg[i_pt], bkg_init_pars
     )
 
     trial_dict = fit(fitter, cfg, i_trial, suffix)
@@ -625,6 +724,7 @@ def process_trial(args):
     trial_renamed['sigma_type'] = trial_renamed.pop('sigma')
     trial_renamed['mean_type'] = trial_renamed.pop('mean')
     trial_dict.update(trial_renamed)
+    trial_dict["timed_out"] = False
 
     return trial_dict
 
@@ -673,42 +773,118 @@ def multi_trial(config_file_name: str, draw_only: bool = False):
     trials = list(itertools.product(*(multitrial_cfg[var] for var in MULTITRIAL_PARAMS)))
     trials = [dict(zip(MULTITRIAL_PARAMS, trial)) for trial in trials]
 
-    # Get input data
-    dfs_data, dfs_mc_prd_bkg, dfs_mc_prd_bkg_av, fracs_prd_bkg = get_input_data(
-        cfg, pt_mins, pt_maxs, bdt_cut_mins, bdt_cut_maxs
-    )
+    pt_bins = [i_pt for i_pt in range(len(pt_mins))
+               if multitrial_cfg["pt_bins"] is None or i_pt in multitrial_cfg["pt_bins"]]
+    outfile_names = [
+        os.path.join(cfg["output_dir"], f"raw_yields_{pt_min*10:.0f}_{pt_max*10:.0f}.parquet")
+        for pt_min, pt_max in zip(pt_mins, pt_maxs)
+    ]
+
+    fit_settings = {
+        "correlated_bkgs": cfg["correlated_bkgs"], "signal_br": cfg["signal_br"],
+        "multitrial": {key: value for key, value in multitrial_cfg.items()
+                       if key not in MULTITRIAL_PARAMS + ["pt_bins"]}
+    }
+
+    # the completed trials are journaled, so that an interrupted run is resumed,
+    # in groups specific to the trials, settings, inputs and output file of each pT bin
+    journal = TaskJournal(cfg["task_journal"])
+    journal_groups = [
+        get_group_name(os.path.basename(outfile_name), trials=trials, fit_settings=fit_settings,
+                       inputs=cfg["inputs"], bdt_cuts=[bdt_cut_min, bdt_cut_max],
+                       mean_mc=h_mean_mc.values()[i_pt], sigma_mc=h_sigma_mc.values()[i_pt],
+                       output_file=os.path.abspath(outfile_name))
+        for i_pt, (outfile_name, bdt_cut_min, bdt_cut_max) in enumerate(zip(outfile_names, bdt_cut_mins,
+                                                                            bdt_cut_maxs))
+    ]
+    dfs_trials = {}
+    if not draw_only:
+        # Get input data and share it with the workers
+        dfs_data, dfs_mc_prd_bkg, dfs_mc_prd_bkg_av, fracs_prd_bkg = get_input_data(
+            cfg, pt_mins, pt_maxs, bdt_cut_mins, bdt_cut_maxs
+        )
+        candidate_store = get_candidate_store(dfs_data, dfs_mc_prd_bkg, dfs_mc_prd_bkg_av)
+        try:
+            masses_data = [np.sort(df_data["fM"].to_numpy()) for df_data in dfs_data]
+            inputs_hashes = [
+                get_inputs_hash(df_data["fM"].to_numpy(), df_prd_bkg_av["fM"].to_numpy(),
+                                *[df_prd_bkg["fM"].to_numpy() for df_prd_bkg in dfs_prd_bkg])
+                for df_data, dfs_prd_bkg, df_prd_bkg_av in zip(dfs_data, dfs_mc_prd_bkg, dfs_mc_prd_bkg_av)
+            ]
+            del dfs_data, dfs_mc_prd_bkg, dfs_mc_prd_bkg_av
+
+            # Prepare the trials of all the pT bins (the candidates are in shared memory), the longest expected first,
+            # the trials already in the journal are not repeated
+            tasks, task_keys = [], {}
+            trial_results = {i_pt: [None] * len(trials) for i_pt in pt_bins}
+            n_trials_left = dict.fromkeys(pt_bins, len(trials))
+            for i_pt in pt_bins:
+                for i_trial, trial in enumerate(trials):
+                    task_keys[(i_pt, i_trial)] = get_task_key(
+                        trial=trial, pt_range=[pt_mins[i_pt], pt_maxs[i_pt]], inputs=inputs_hashes[i_pt],
+                        mean_mc=h_mean_mc.values()[i_pt], sigma_mc=h_sigma_mc.values()[i_pt],
+                        fracs_prd_bkg=fracs_prd_bkg[i_pt], fit_settings=fit_settings
+                    )
+                    trial_results[i_pt][i_trial] = journal.get(task_keys[(i_pt, i_trial)])
+                    if trial_results[i_pt][i_trial] is not None:
+                        n_trials_left[i_pt] -= 1
+                        continue
+                    cost = get_expected_trial_cost(trial, masses_data[i_pt], len(cfg["correlated_bkgs"]))
+                    tasks.append((cost, (trial, h_mean_mc, h_sigma_mc, fracs_prd_bkg, cfg,
+                                         i_pt, pt_mins[i_pt], pt_maxs[i_pt], i_trial)))
+            tasks.sort(key=lambda task: task[0], reverse=True)
+            print(f"{len(tasks)} trials to be run, {len(task_keys) - len(tasks)} found in the journal")
+
+            # Parallelize the trials, each one with a wall-clock budget,
+            # the results of each pT bin are saved once complete
+            if not os.path.exists(cfg["output_dir"]):
+                os.makedirs(cfg["output_dir"])
+            for i_pt in [i_pt for i_pt in pt_bins if n_trials_left[i_pt] == 0]:
+                dfs_trials[i_pt] = pd.DataFrame(trial_results.pop(i_pt))
+                dfs_trials[i_pt].to_parquet(outfile_names[i_pt])
+            tasks = [args for _, args in tasks]
+            for i_task, status, result, i_attempt in run_tasks_with_timeout(
+                    process_trial, tasks, cfg["multiprocessing"]["max_workers"],
+                    timeout=cfg["multiprocessing"]["timeout"],
+                    n_retries=len(cfg["multiprocessing"]["retry_bkg_init_pars"]),
+                    setup=set_trial_candidates, setup_args=(candidate_store,)):
+                trial, i_pt, i_trial = tasks[i_task][0], tasks[i_task][5], tasks[i_task][8]
+                if status == "done":
+                    trial_results[i_pt][i_trial] = result
+                    journal.append(task_keys[(i_pt, i_trial)], result, group=journal_groups[i_pt])
+                else:
+                    # timed-out and failed trials are not journaled, so that they are tried again in the next run
+                    if status == "timeout":
+                        Logger(f"The trial {i_trial} of the pT bin {i_pt} timed out after {i_attempt + 1} attempt(s), "
+                               "recorded as not converged", "WARNING")
+                    else:
+                        Logger(f"The trial {i_trial} of the pT bin {i_pt} failed, recorded as not converged:\n{result}",
+                               "ERROR")
+                    trial_results[i_pt][i_trial] = get_not_converged_trial(trial, cfg)
+                    trial_results[i_pt][i_trial]["timed_out"] = status == "timeout"
+                n_trials_left[i_pt] -= 1
+                if n_trials_left[i_pt] == 0:
+                    dfs_trials[i_pt] = pd.DataFrame(trial_results.pop(i_pt))
+                    dfs_trials[i_pt].to_parquet(outfile_names[i_pt])
+        finally:
+            # the shared memory is released also if the trials are interrupted
+            candidate_store.close()
 
     dfs = []
     idx_assigned_syst = 0
     print(pt_mins, pt_maxs)
 
     for i_pt, (pt_min, pt_max) in enumerate(zip(pt_mins, pt_maxs)):
-        if multitrial_cfg["pt_bins"] is not None and i_pt not in multitrial_cfg["pt_bins"]:
+        if i_pt not in pt_bins:
             dfs.append(None)
             continue
-        if not draw_only:
-
-            # Prepare arguments for parallel execution of trials
-            args = [
-                (trial, dfs_data, dfs_mc_prd_bkg, dfs_mc_prd_bkg_av, h_mean_mc, h_sigma_mc, fracs_prd_bkg, cfg, i_pt, pt_min, pt_max, i_trial)
-                for i_trial, trial in enumerate(trials)
-            ]
-
-            # Parallelize the trials
-            with ProcessPoolExecutor(max_workers=cfg["multiprocessing"]["max_workers"]) as executor:
-                trial_results = list(executor.map(process_trial, args))
-
-            # Save results
-            df_trials = pd.DataFrame(trial_results)
-            if not os.path.exists(cfg["output_dir"]):
-                os.makedirs(cfg["output_dir"])
-            df_trials.to_parquet(
-                os.path.join(cfg["output_dir"], f"raw_yields_{pt_min*10:.0f}_{pt_max*10:.0f}.parquet")
-            )
+        if i_pt in dfs_trials:
+            df_trials = dfs_trials[i_pt]
+        elif os.path.isfile(outfile_names[i_pt]):
+            df_trials = pd.read_parquet(outfile_names[i_pt])
         else:
-            df_trials = pd.read_parquet(
-                os.path.join(cfg["output_dir"], f"raw_yields_{pt_min*10:.0f}_{pt_max*10:.0f}.parquet")
-            )
+            # sweep not completed, the trials in the journal are drawn
+            df_trials = pd.DataFrame(journal.get_group(journal_groups[i_pt]))
         dfs.append(df_trials)
 
         # Draw results
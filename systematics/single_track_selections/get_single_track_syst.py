@@ -1,13 +1,17 @@
 import argparse
 from itertools import product
 import os
-from concurrent.futures import ProcessPoolExecutor
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import copy
 import yaml
 import pandas as pd
 import numpy as np
 import uproot
 import matplotlib.pyplot as plt
+sys.path.append('utils')  # pylint: disable=wrong-import-position
+from df_utils import read_candidates  # noqa: E402
+from task_journal import TaskJournal, get_task_key  # noqa: E402
 
 def get_all_selections(config):
     
@@ -53,8 +57,8 @@ def get_all_selections(config):
     return query_dicts
 
 def create_datasets(config, query_dicts):
-    df_data = pd.concat([pd.read_parquet(f) for f in config['inputs']['data']])
-    df_mc = pd.concat([pd.read_parquet(f) for f in config['inputs']['mc']])
+    df_data = read_candidates(config['inputs']['data'])
+    df_mc = read_candidates(config['inputs']['mc'])
 
     for query_dict in query_dicts:
         output_dir = os.path.join(config['output_dir'], "data", query_dict['selection_name'])
@@ -179,13 +183,37 @@ def create_cross_section_configs(config, query_dicts, cross_section_cfg):
             yaml.dump(config_mod, f, default_flow_style=False)
 
 def extract_rawyield(fit_config_name):
-    os.system(f"python3 fit/extract_rawyield.py -c {fit_config_name}")
+    return os.system(f"python3 fit/extract_rawyield.py -c {fit_config_name}")
 
 def extract_efficiency(efficiency_config_name):
-    os.system(f"python3 efficiency/get_efficiency_bmesons.py {efficiency_config_name}")
+    return os.system(f"python3 efficiency/get_efficiency_bmesons.py {efficiency_config_name}")
 
 def extract_cross_section(cross_section_config_name):
-    os.system(f"python3 cross_section/compute_cross_section.py {cross_section_config_name}")
+    return os.system(f"python3 cross_section/compute_cross_section.py {cross_section_config_name}")
+
+def run_stage(config, journal, stage, task_function, config_names, input_files):
+    """
+    Run in parallel the tasks of a stage, skipping the ones completed in the journal.
+    A task is identified by its configuration and the modification times of its input files,
+    it is journaled only if it exits successfully.
+    """
+    with ProcessPoolExecutor(max_workers=config["max_workers"]) as executor:
+        futures = {}
+        for config_name, inputs in zip(config_names, input_files):
+            with open(config_name, 'r') as f:
+                task_config = yaml.safe_load(f)
+            task_key = get_task_key(
+                stage=stage, config=task_config,
+                inputs=[(file, os.path.getmtime(file)) for file in inputs if os.path.isfile(file)]
+            )
+            if journal.get(task_key) is None:
+                futures[executor.submit(task_function, config_name)] = (config_name, task_key)
+            else:
+                print(f"{stage} for {config_name} found in the journal, skipped")
+        for future in as_completed(futures):
+            config_name, task_key = futures[future]
+            if future.result() == 0:
+                journal.append(task_key, {"config": config_name}, group=stage)
 
 def draw_results(config, query_dicts):
     rawyields, efficiencies, cross_sections = [], [], []
@@ -362,38 +390,40 @@ def produce_files_for_syst(config_file, data, raw_yields, efficiency, cross_sect
     if cross_section:
         create_cross_section_configs(config, query_dicts, cross_section_cfg)
 
+    # the completed tasks are journaled, so that an interrupted run is resumed
+    journal = TaskJournal(config["task_journal"])
+    data_dirs = [os.path.join(config['output_dir'], 'data', query_dict['selection_name'])
+                 for query_dict in query_dicts]
+
     if raw_yields:
-        with ProcessPoolExecutor(max_workers=config["max_workers"]) as executor:
-            for query_dict in query_dicts:
-                fit_config_name = os.path.join(
-                    config['output_dir'],
-                    'fits',
-                    query_dict['selection_name'],
-                    "config_fit.yml"
-                )
-                executor.submit(extract_rawyield, fit_config_name)
+        fit_config_names = [
+            os.path.join(config['output_dir'], 'fits', query_dict['selection_name'], "config_fit.yml")
+            for query_dict in query_dicts
+        ]
+        input_files = [[os.path.join(data_dir, 'data.parquet'), os.path.join(data_dir, 'mc.parquet')]
+                       for data_dir in data_dirs]
+        run_stage(config, journal, "raw_yields", extract_rawyield, fit_config_names, input_files)
 
     if efficiency:
-        with ProcessPoolExecutor(max_workers=config["max_workers"]) as executor:
-            for query_dict in query_dicts:
-                efficiency_config_name = os.path.join(
-                    config['output_dir'],
-                    'efficiencies',
-                    query_dict['selection_name'],
-                    "config_efficiency.yml"
-                )
-                executor.submit(extract_efficiency, efficiency_config_name)
-            
+        efficiency_config_names = [
+            os.path.join(config['output_dir'], 'efficiencies', query_dict['selection_name'], "config_efficiency.yml")
+            for query_dict in query_dicts
+        ]
+        input_files = [[os.path.join(data_dir, 'mc.parquet')] for data_dir in data_dirs]
+        run_stage(config, journal, "efficiency", extract_efficiency, efficiency_config_names, input_files)
+
     if cross_section:
-        with ProcessPoolExecutor(max_workers=config["max_workers"]) as executor:
-            for query_dict in query_dicts:
-                cross_section_config_name = os.path.join(
-                    config['output_dir'],
-                    'cross_sections',
-                    query_dict['selection_name'],
-                    "config_cross_section.yml"
-                )
-                executor.submit(extract_cross_section, cross_section_config_name)
+        cross_section_config_names = [
+            os.path.join(config['output_dir'], 'cross_sections', query_dict['selection_name'],
+                         "config_cross_section.yml")
+            for query_dict in query_dicts
+        ]
+        input_files = []
+        for cross_section_config_name in cross_section_config_names:
+            with open(cross_section_config_name, 'r') as f:
+                cross_section_cfg_mod = yaml.safe_load(f)
+            input_files.append([cross_section_cfg_mod['rawyield_file'], cross_section_cfg_mod['efficiency_file']])
+        run_stage(config, journal, "cross_section", extract_cross_section, cross_section_config_names, input_files)
 
     if draw:
         draw_results(config, query_dicts)
@@ -0,0 +1,99 @@
+"""Module containing the compiled selection of the candidates defined by a cutset."""
+import numpy as np
+
+
+class CutsetSelection:
+    """
+    Selection of the candidates defined by a cutset (pt and selection variables, each with mins and maxs lists),
+    compiled once into arrays of limits per pT bin.
+    The pT bin of the candidates is found with np.digitize and the cuts are applied as vectorised masks,
+    so that the candidates of each pT bin are obtained as index arrays without query strings and copies.
+    The selections are min < var < max (pT included), as in the selection strings of the scripts.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, cut_set, name_pt_var="fPt", skip_vars=None, lower_only=False):
+        """
+        Init method.
+
+        Parameters:
+        cut_set (dict): The cutset, with non-overlapping pT bins in increasing order.
+        name_pt_var (str, optional): The name of the pT column. Defaults to "fPt".
+        skip_vars (list, optional): The selection variables not to be applied. Defaults to None.
+        lower_only (bool, optional): Apply only the lower limits of the selection variables. Defaults to False.
+
+        """
+        skip_vars = [] if skip_vars is None else skip_vars
+        self.name_pt_var = name_pt_var
+        self.pt_mins = np.asarray(cut_set["pt"]["mins"], dtype=np.float64)
+        self.pt_maxs = np.asarray(cut_set["pt"]["maxs"], dtype=np.float64)
+        self.pt_edges = np.append(self.pt_mins, self.pt_maxs[-1])
+        self.cut_vars = [var for var in cut_set if var != "pt" and var not in skip_vars]
+        # limits with shape (number of variables, number of pT bins + 1), the last bin is for rejected candidates
+        n_vars, n_pt_bins = len(self.cut_vars), len(self.pt_mins)
+        self.mins = np.full((n_vars, n_pt_bins + 1), np.inf)
+        self.maxs = np.full((n_vars, n_pt_bins + 1), -np.inf)
+        for ivar, var in enumerate(self.cut_vars):
+            self.mins[ivar, :-1] = cut_set[var]["mins"]
+            self.maxs[ivar, :-1] = np.inf if lower_only else cut_set[var]["maxs"]
+
+    def get_pt_bins(self, df):
+        """
+        Get the pT bin of each candidate.
+
+        Parameters:
+        df (pandas.DataFrame): The candidates.
+
+        Returns:
+        numpy.ndarray: The index of the pT bin of each candidate, -1 if outside the pT bins.
+
+        """
+        pt = df[self.name_pt_var].to_numpy()
+        pt_bins = np.digitize(pt, self.pt_edges) - 1
+        in_range = (pt_bins >= 0) & (pt_bins < len(self.pt_mins))
+        pt_bins[~in_range] = -1
+        # strict limits and gaps between pT bins
+        in_range[in_range] = (pt[in_range] > self.pt_mins[pt_bins[in_range]]) & \
+            (pt[in_range] < self.pt_maxs[pt_bins[in_range]])
+        pt_bins[~in_range] = -1
+        return pt_bins
+
+    def get_mask(self, df, pt_bins=None):
+        """
+        Get the mask of the candidates passing the selections of their pT bin.
+
+        Parameters:
+        df (pandas.DataFrame): The candidates.
+        pt_bins (numpy.ndarray, optional): The pT bins from get_pt_bins, computed if not provided. Defaults to None.
+
+        Returns:
+        numpy.ndarray: The boolean mask of the selected candidates.
+
+        """
+        if pt_bins is None:
+            pt_bins = self.get_pt_bins(df)
+        mask = pt_bins >= 0
+        for ivar, var in enumerate(self.cut_vars):
+            values = df[var].to_numpy()
+            mask &= (values > self.mins[ivar, pt_bins]) & (values < self.maxs[ivar, pt_bins])
+        return mask
+
+    def get_bin_indices(self, df, apply_cuts=True):
+        """
+        Get the positional indices of the selected candidates in each pT bin, to be used with df.iloc.
+
+        Parameters:
+        df (pandas.DataFrame): The candidates.
+        apply_cuts (bool, optional): Apply the selections of the variables, otherwise only the pT bins.
+            Defaults to True.
+
+        Returns:
+        list: The sorted indices (numpy.ndarray) of the candidates of each pT bin.
+
+        """
+        pt_bins = self.get_pt_bins(df)
+        selected = np.flatnonzero(self.get_mask(df, pt_bins) if apply_cuts else pt_bins >= 0)
+        selected_bins = pt_bins[selected]
+        order = np.argsort(selected_bins, kind="stable")
+        bounds = np.searchsorted(selected_bins[order], np.arange(len(self.pt_mins) + 1))
+        return [selected[order[bounds[ipt]:bounds[ipt + 1]]] for ipt in range(len(self.pt_mins))]
@@ -1,5 +1,6 @@
 """Module containing utility functions for working with dataframes."""
 import pandas as pd
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 
 def read_parquet_in_batches(file_path, selections=None, batch_size=1000000):
@@ -23,3 +24,95 @@ def read_parquet_in_batches(file_path, selections=None, batch_size=1000000):
             batch_df = batch_df.query(selections)
         df.append(batch_df)
     return pd.concat(df)
+
+
+# pylint: disable=too-many-arguments
+def read_partitioned_dataset(dataset_dir, data_tags=None, pt_range=None, ml_output_range=None,
+                             columns=None, name_pt_var="fPt"):
+    """
+    Read the partitioned Parquet dataset written by the ML application (data_tag=*/pt_bin=* directories).
+    The ranges are pushed down to the Parquet reader, which skips the partitions and the row groups
+    whose statistics are outside them.
+
+    Parameters:
+    dataset_dir (str): The path to the dataset directory.
+    data_tags (list, optional): The data tags to be read. Defaults to None (all data tags).
+    pt_range (list, optional): The [min, max) pT range of the candidates. Defaults to None.
+    ml_output_range (list, optional): The [min, max) ML_output range of the candidates. Defaults to None.
+    columns (list, optional): The columns to be read. Defaults to None (all columns).
+    name_pt_var (str, optional): The name of the pT column. Defaults to "fPt".
+
+    Returns:
+    pandas.DataFrame: The DataFrame with the selected candidates.
+
+    """
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning="hive")
+    selection = None
+    if data_tags is not None:
+        selection = ds.field("data_tag").isin(data_tags)
+    for var, var_range in zip([name_pt_var, "ML_output"], [pt_range, ml_output_range]):
+        if var_range is None:
+            continue
+        var_selection = (ds.field(var) >= var_range[0]) & (ds.field(var) < var_range[1])
+        selection = var_selection if selection is None else selection & var_selection
+    return dataset.to_table(columns=columns, filter=selection).to_pandas()
+
+
+def get_cutset_filter(cut_set, name_pt_var="fPt", skip_vars=None, lower_only=False):
+    """
+    Convert a cutset into a pyarrow filter expression, OR of the pT bins of the AND of the
+    min < var < max selections of the bin (same definition as the selection strings of the scripts).
+
+    Parameters:
+    cut_set (dict): The cutset (pt and selection variables, each with mins and maxs lists).
+    name_pt_var (str, optional): The name of the pT column. Defaults to "fPt".
+    skip_vars (list, optional): The selection variables not to be included. Defaults to None.
+    lower_only (bool, optional): Include only the lower limits of the selection variables. Defaults to False.
+
+    Returns:
+    pyarrow.dataset.Expression: The filter expression.
+
+    """
+    skip_vars = [] if skip_vars is None else skip_vars
+    cut_vars = [var for var in cut_set if var != "pt" and var not in skip_vars]
+    selection = None
+    for ipt, (pt_min, pt_max) in enumerate(zip(cut_set["pt"]["mins"], cut_set["pt"]["maxs"])):
+        bin_selection = (ds.field(name_pt_var) > pt_min) & (ds.field(name_pt_var) < pt_max)
+        for var in cut_vars:
+            bin_selection &= ds.field(var) > cut_set[var]["mins"][ipt]
+            if not lower_only:
+                bin_selection &= ds.field(var) < cut_set[var]["maxs"][ipt]
+        selection = bin_selection if selection is None else selection | bin_selection
+    return selection
+
+
+# pylint: disable=too-many-arguments
+def read_candidates(file_names, columns=None, cut_set=None, selection=None, name_pt_var="fPt",
+                    skip_vars=None, lower_only=False):
+    """
+    Read the candidates of several Parquet files as a single dataset, in parallel threads.
+    The cutset and the additional selection are pushed down to the Parquet reader, which skips
+    the row groups whose statistics are outside them and never materialises the rejected candidates.
+
+    Parameters:
+    file_names (str or list): The name(s) of the Parquet file(s).
+    columns (list, optional): The columns to be read (the filter can use other columns).
+        Defaults to None (all columns).
+    cut_set (dict, optional): The cutset to be applied (see get_cutset_filter). Defaults to None.
+    selection (pyarrow.dataset.Expression, optional): An additional filter, in AND with the cutset.
+        Defaults to None.
+    name_pt_var (str, optional): The name of the pT column. Defaults to "fPt".
+    skip_vars (list, optional): The cutset variables not to be applied. Defaults to None.
+    lower_only (bool, optional): Apply only the lower limits of the cutset variables. Defaults to False.
+
+    Returns:
+    pandas.DataFrame: The DataFrame with the selected candidates.
+
+    """
+    if not isinstance(file_names, list):
+        file_names = [file_names]
+    dataset = ds.dataset(file_names, format="parquet")
+    if cut_set is not None:
+        cut_set_selection = get_cutset_filter(cut_set, name_pt_var, skip_vars, lower_only)
+        selection = cut_set_selection if selection is None else selection & cut_set_selection
+    return dataset.to_table(columns=columns, filter=selection, use_threads=True).to_pandas()
@@ -0,0 +1,86 @@
+"""Module containing an on-disk cache of the results of mass fits, shared between scripts and processes."""
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+def get_fit_key(masses, **fit_settings):
+    """
+    Get the key of a fit from the content of the fitted candidates and the fit settings.
+
+    Parameters:
+    masses (array-like): The invariant masses of the fitted candidates (the order is irrelevant).
+    **fit_settings: The settings defining the fit (e.g. model, fit limits, number of bins, initial parameters),
+        they must be JSON serialisable.
+
+    Returns:
+    str: The SHA-256 hex digest identifying the fit.
+
+    """
+    hasher = hashlib.sha256()
+    hasher.update(np.sort(np.asarray(masses, dtype=np.float64)).tobytes())
+    hasher.update(json.dumps(fit_settings, sort_keys=True, default=float).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class FitCache:
+    """
+    Cache of fit results stored as one JSON file per fit key in a directory.
+    Files are written atomically, so the cache can be shared by concurrent processes.
+    With cache_dir set to None the cache is disabled (no fit is found, nothing is stored).
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Init method.
+
+        Parameters:
+        cache_dir (str): The cache directory (None to disable the cache).
+
+        """
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __get_file_name(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def load(self, key):
+        """
+        Load the result of a fit.
+
+        Parameters:
+        key (str): The fit key from get_fit_key.
+
+        Returns:
+        dict: The stored fit result, None if not found.
+
+        """
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self.__get_file_name(key), "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save(self, key, result):
+        """
+        Store the result of a fit.
+
+        Parameters:
+        key (str): The fit key from get_fit_key.
+        result (dict): The fit result, it must be JSON serialisable.
+
+        """
+        if self.cache_dir is None:
+            return
+        file_name = self.__get_file_name(key)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(file_name), suffix=".tmp",
+                                         delete=False, encoding="utf-8") as file:
+            json.dump(result, file, default=float)
+        os.replace(file.name, file_name)
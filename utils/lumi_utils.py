@@ -0,0 +1,176 @@
+"""Module containing a persistent per-run index of the event counts and luminosities of analysis outputs."""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import uproot
+
+
+def index_analysis_results_file(args):
+    """
+    Read once the per-run information of an AnalysisResults file.
+    The BC-cut luminosities are assigned to the runs by bin label if the histograms are labelled with
+    the run numbers, otherwise the totals of the file are shared among the runs proportionally to InspectedTVX.
+
+    Parameters:
+    args (tuple): The file name, the Zorro folder, the path to the hCollisions histogram (None to skip)
+        and the folder with the hLumiTVX and hLumiTVXafterBCcuts histograms (None to skip).
+
+    Returns:
+    pandas.DataFrame: One row per run with the file name and modification time, indexing settings,
+        run number, InspectedTVX,
+        analysed triggers of interest, selected triggers (one sel_<trigger> column per trigger),
+        z-vertex efficiency (of the file) and luminosities before and after BC cuts.
+
+    """
+    infile_name, zorro_folder, h_collisions_path, folder_bc_cuts = args
+    rows = []
+    with uproot.open(infile_name) as infile:
+        for run_name, run_folder in infile[zorro_folder].items(recursive=False):
+            selections = run_folder["Selections"]
+            row = {
+                "file": infile_name,
+                "mtime": os.path.getmtime(infile_name),
+                "run": int(run_name.split(";")[0]),
+                "inspected_tvx": float(sum(run_folder["InspectedTVX"].values())),
+                "analysed_triggers": float(sum(run_folder["AnalysedTriggersOfInterest"].values())),
+            }
+            for label, value in zip(selections.axis().labels(), selections.values()):
+                row[f"sel_{label}"] = float(value)
+            rows.append(row)
+        df_runs = pd.DataFrame(rows)
+        # settings used to build the index of the file
+        df_runs["zorro_folder"] = zorro_folder
+        df_runs["h_collisions_path"] = "" if h_collisions_path is None else h_collisions_path
+        df_runs["folder_bc_cuts"] = "" if folder_bc_cuts is None else folder_bc_cuts
+
+        df_runs["z_vtx_eff"] = 1.
+        if h_collisions_path is not None:
+            h_collisions = infile[h_collisions_path]
+            labels = h_collisions.axis().labels()
+            values = h_collisions.values()
+            df_runs["z_vtx_eff"] = values[labels.index('PV #it{z}')] / values[labels.index('PV #it{z}') - 1]
+
+        for col, hist_name in zip(["lumi_tvx", "lumi_tvx_after_bc"], ["hLumiTVX", "hLumiTVXafterBCcuts"]):
+            df_runs[col] = np.nan
+            if folder_bc_cuts is None:
+                continue
+            hist = infile[f"{folder_bc_cuts}/{hist_name}"]
+            labels = hist.axis().labels()
+            if labels and all(label.isdigit() for label in labels):
+                lumi_per_run = dict(zip((int(label) for label in labels), hist.values()))
+                df_runs[col] = df_runs["run"].map(lumi_per_run).fillna(0.)
+            else:
+                df_runs[col] = sum(hist.values()) * df_runs["inspected_tvx"] / df_runs["inspected_tvx"].sum()
+
+    return df_runs
+
+
+# pylint: disable=too-many-arguments
+def load_lumi_index(infile_names, zorro_folder, h_collisions_path=None, folder_bc_cuts=None,
+                    index_file=None, max_workers=None):
+    """
+    Load the per-run index of AnalysisResults files, (re)indexing in parallel only the files that are
+    missing in the index file, have been modified since they were indexed or were indexed with other settings.
+
+    Parameters:
+    infile_names (str or list): The name(s) of the .root input file(s).
+    zorro_folder (str): The name of the Zorro folder.
+    h_collisions_path (str, optional): The path to the hCollisions histogram. Defaults to None.
+    folder_bc_cuts (str, optional): The folder with the BC-cut luminosity histograms. Defaults to None.
+    index_file (str, optional): The parquet file storing the index (None to not store it). Defaults to None.
+    max_workers (int, optional): The number of processes reading the files. Defaults to None (number of CPUs).
+
+    Returns:
+    pandas.DataFrame: The index of the requested files.
+
+    """
+    if not isinstance(infile_names, list):
+        infile_names = [infile_names]
+
+    df_index = pd.DataFrame()
+    if index_file is not None and os.path.isfile(index_file):
+        df_index = pd.read_parquet(index_file)
+        mtimes = df_index["file"].map(lambda file: os.path.isfile(file) and os.path.getmtime(file))
+        up_to_date = (mtimes == df_index["mtime"]) & (df_index["zorro_folder"] == zorro_folder)
+        up_to_date &= df_index["h_collisions_path"] == ("" if h_collisions_path is None else h_collisions_path)
+        up_to_date &= df_index["folder_bc_cuts"] == ("" if folder_bc_cuts is None else folder_bc_cuts)
+        # files indexed with other settings are kept in the index file only if not requested
+        df_index = df_index[up_to_date | ~df_index["file"].isin(infile_names)]
+
+    indexed_files = set(df_index["file"]) if len(df_index) > 0 else set()
+    files_to_index = [file for file in dict.fromkeys(infile_names) if file not in indexed_files]
+    if files_to_index:
+        tasks = [(file, zorro_folder, h_collisions_path, folder_bc_cuts) for file in files_to_index]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            dfs_new = list(executor.map(index_analysis_results_file, tasks))
+        df_index = pd.concat([df_index] + dfs_new, ignore_index=True)
+        sel_cols = [col for col in df_index.columns if col.startswith("sel_")]
+        df_index[sel_cols] = df_index[sel_cols].fillna(0.)
+        if index_file is not None:
+            df_index.to_parquet(index_file, index=False)
+
+    return df_index[df_index["file"].isin(infile_names)]
+
+
+def select_index_rows(df_index, infile_names=None, runs=None):
+    """
+    Select the rows of the per-run index of the given files and runs.
+
+    Parameters:
+    df_index (pandas.DataFrame): The index from load_lumi_index.
+    infile_names (str or list, optional): The files to be considered. Defaults to None (all the files).
+    runs (list, optional): The runs to be considered. Defaults to None (all the runs).
+
+    Returns:
+    pandas.DataFrame: The selected rows.
+
+    """
+    mask = np.ones(len(df_index), dtype=bool)
+    if infile_names is not None:
+        mask &= df_index["file"].isin(infile_names if isinstance(infile_names, list) else [infile_names]).to_numpy()
+    if runs is not None:
+        mask &= df_index["run"].isin(runs).to_numpy()
+    return df_index[mask]
+
+
+def get_n_events_from_index(df_index, triggers_of_interest_names, infile_names=None, runs=None):
+    """
+    Get the total number of events from the per-run index (same definition as get_n_events_from_zorro).
+
+    Parameters:
+    df_index (pandas.DataFrame): The index from load_lumi_index.
+    triggers_of_interest_names (str or list): The name(s) of the triggers of interest.
+    infile_names (list, optional): The files to be considered. Defaults to None (all the files).
+    runs (list, optional): The runs to be considered. Defaults to None (all the runs).
+
+    Returns:
+    float: The total number of events.
+
+    """
+    if not isinstance(triggers_of_interest_names, list):
+        triggers_of_interest_names = [triggers_of_interest_names]
+
+    df_sel = select_index_rows(df_index, infile_names, runs)
+    triggers_of_interest_skimming = df_sel[[f"sel_{trigger}" for trigger in triggers_of_interest_names]].sum(axis=1)
+    n_events = df_sel["inspected_tvx"] * df_sel["analysed_triggers"] / triggers_of_interest_skimming
+
+    return float((n_events * df_sel["z_vtx_eff"]).sum())
+
+
+def get_bc_luminosities_from_index(df_index, infile_names=None, runs=None):
+    """
+    Get the luminosities before and after the BC cuts from the per-run index.
+
+    Parameters:
+    df_index (pandas.DataFrame): The index from load_lumi_index.
+    infile_names (list, optional): The files to be considered. Defaults to None (all the files).
+    runs (list, optional): The runs to be considered. Defaults to None (all the runs).
+
+    Returns:
+    tuple: The luminosities before and after the BC cuts.
+
+    """
+    df_sel = select_index_rows(df_index, infile_names, runs)
+    return float(df_sel["lumi_tvx"].sum()), float(df_sel["lumi_tvx_after_bc"].sum())
@@ -0,0 +1,83 @@
+"""Module containing a store of candidate columns in shared memory, read by the workers of process pools."""
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+
+class SharedCandidateStore:
+    """
+    Columns of several DataFrames stored contiguously in a single shared-memory block.
+    The creating process owns the block and unlinks it with close(), the workers attach to it
+    from the (small, picklable) spec and get read-only DataFrames whose columns are views of the block,
+    so that the candidates are neither pickled in the task payloads nor copied in the workers.
+    """
+
+    def __init__(self, dfs=None, spec=None):
+        """
+        Init method, either creating the store from DataFrames or attaching to an existing one.
+
+        Parameters:
+        dfs (dict, optional): The DataFrames to be stored (all their columns are stored) by key.
+            Defaults to None.
+        spec (dict, optional): The spec of an existing store (see get_spec). Defaults to None.
+
+        """
+        if (dfs is None) == (spec is None):
+            raise ValueError("Exactly one of dfs and spec must be provided.")
+
+        self.owner = dfs is not None
+        if self.owner:
+            layout, size = {}, 0
+            for key, df in dfs.items():
+                layout[key] = []
+                for col in df.columns:
+                    values = np.ascontiguousarray(df[col].to_numpy())
+                    layout[key].append((col, size, len(values), values.dtype.str))
+                    # 8-byte alignment of each column
+                    size += -(-values.nbytes // 8) * 8
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            self.layout = layout
+            for key, df in dfs.items():
+                for col, offset, n_cands, dtype in layout[key]:
+                    np.ndarray(n_cands, dtype=dtype, buffer=self.shm.buf, offset=offset)[:] = df[col].to_numpy()
+        else:
+            self.shm = shared_memory.SharedMemory(name=spec["name"])
+            self.layout = spec["layout"]
+
+    def get_spec(self):
+        """
+        Get the spec needed to attach to the store from other processes.
+
+        Returns:
+        dict: The name of the shared-memory block and the layout of the columns.
+
+        """
+        return {"name": self.shm.name, "layout": self.layout}
+
+    def get_df(self, key):
+        """
+        Get a stored DataFrame, with read-only columns viewing the shared memory.
+
+        Parameters:
+        key (str): The key of the DataFrame.
+
+        Returns:
+        pandas.DataFrame: The DataFrame.
+
+        """
+        columns = {}
+        for col, offset, n_cands, dtype in self.layout[key]:
+            values = np.ndarray(n_cands, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            values.flags.writeable = False
+            columns[col] = pd.Series(values, copy=False)
+        return pd.DataFrame(columns, copy=False)
+
+    def close(self):
+        """
+        Detach from the store, releasing the shared memory if owned.
+        The DataFrames from get_df must not be used afterwards.
+        """
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,153 @@
+"""Module containing an append-only journal of the completed tasks of long sweeps, used to resume them."""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def to_json_serialisable(obj):
+    """
+    Convert the numpy (and other non-JSON) objects of the task parameters and results.
+
+    Parameters:
+    obj (object): The object to be converted.
+
+    Returns:
+    object: The list or python scalar of numpy objects, the string representation otherwise.
+
+    """
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    return str(obj)
+
+
+def get_inputs_hash(*arrays):
+    """
+    Get the hash of the content of the inputs of a group of tasks (e.g. the candidates of a pT bin).
+
+    Parameters:
+    *arrays (array-like): The input arrays (the order of the values matters).
+
+    Returns:
+    str: The SHA-256 hex digest of the inputs.
+
+    """
+    hasher = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        hasher.update(f"{array.dtype.str}{array.shape}".encode("utf-8"))
+        hasher.update(array.tobytes())
+    return hasher.hexdigest()
+
+
+def get_task_key(**task_settings):
+    """
+    Get the key of a task from its parameters and the hash of its inputs.
+
+    Parameters:
+    **task_settings: The parameters of the task and the hashes of its inputs.
+
+    Returns:
+    str: The SHA-256 hex digest identifying the task.
+
+    """
+    return hashlib.sha256(
+        json.dumps(task_settings, sort_keys=True, default=to_json_serialisable).encode("utf-8")).hexdigest()
+
+
+def get_group_name(prefix, **sweep_settings):
+    """
+    Get the journal group of a sweep, specific to its settings, so that the records of the sweeps
+    with other settings (e.g. another trial grid or output path) in the same journal are not mixed with it.
+
+    Parameters:
+    prefix (str): The readable part of the group name (e.g. the output file of the sweep).
+    **sweep_settings: The settings identifying the sweep.
+
+    Returns:
+    str: The group name, prefix followed by the first 16 characters of the hash of the settings.
+
+    """
+    return f"{prefix}_{get_task_key(**sweep_settings)[:16]}"
+
+
+class TaskJournal:
+    """
+    Journal of completed tasks stored as one JSON record (key, group, result) per line.
+    Each record is appended with a single write on a file opened in append mode, so the journal
+    can be shared by concurrent processes and a crash can at most truncate the last record, which is skipped.
+    With file_name set to None the journal is disabled (no task is found, nothing is stored).
+    """
+
+    def __init__(self, file_name, load_records=True):
+        """
+        Init method, loading the records already in the journal.
+
+        Parameters:
+        file_name (str): The journal file (.jsonl), None to disable the journal.
+        load_records (bool, optional): Load the records already in the journal (not needed by
+            processes that only append records). Defaults to True.
+
+        """
+        self.file_name = file_name
+        self.records = {}
+        if not load_records or self.file_name is None or not os.path.isfile(self.file_name):
+            return
+        with open(self.file_name, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.records[record["key"]] = record
+
+    def get(self, key):
+        """
+        Get the result of a completed task.
+
+        Parameters:
+        key (str): The task key from get_task_key.
+
+        Returns:
+        object: The result of the task, None if not completed.
+
+        """
+        record = self.records.get(key)
+        return None if record is None else record["result"]
+
+    def get_group(self, group):
+        """
+        Get the results of all the completed tasks of a group.
+
+        Parameters:
+        group (str): The group of the tasks.
+
+        Returns:
+        list: The results, in order of completion.
+
+        """
+        return [record["result"] for record in self.records.values() if record["group"] == group]
+
+    def append(self, key, result, group=None):
+        """
+        Record a completed task.
+
+        Parameters:
+        key (str): The task key from get_task_key.
+        result (object): The result of the task, it must be JSON serialisable (numpy objects are converted).
+        group (str, optional): The group of the task (e.g. the output file of its sweep). Defaults to None.
+
+        """
+        record = {"key": key, "group": group, "result": result}
+        if self.file_name is not None:
+            line = json.dumps(record, default=to_json_serialisable) + "\n"
+            if os.path.dirname(self.file_name):
+                os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+            file_descriptor = os.open(self.file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(file_descriptor, line.encode("utf-8"))
+            finally:
+                os.close(file_descriptor)
+            record = json.loads(line)
+        self.records[key] = record
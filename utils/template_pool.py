@@ -0,0 +1,102 @@
+"""Module containing the pool of MC candidates used to build the correlated-background templates."""
+import numpy as np
+import pandas as pd
+
+
+class CorrelatedBkgTemplatePool:
+    """
+    Pool of partly reconstructed decays grouped once by (beauty mother, charm mother), with the candidates
+    of each group sorted by ML_output, so that the template of any (pT, ML_output) selection is obtained
+    with binary searches and masks instead of dataframe queries.
+    The sampling of the weighted-average template is seeded, hence reproducible for any call order.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, df_mc_prd_bkg, correlated_bkgs, seed=42, name_pt_var="fPt", name_score_var="ML_output"):
+        """
+        Init method.
+
+        Parameters:
+        df_mc_prd_bkg (pandas.DataFrame): The partly reconstructed decays (only fM, pT and ML_output are kept).
+        correlated_bkgs (list): The correlated backgrounds (dicts with beauty_id, charm_id, br_pdg, br_sim).
+        seed (int, optional): The seed of the sampling of the templates. Defaults to 42.
+        name_pt_var (str, optional): The name of the pT column. Defaults to "fPt".
+        name_score_var (str, optional): The name of the ML output column. Defaults to "ML_output".
+
+        """
+        self.correlated_bkgs = correlated_bkgs
+        self.seed = seed
+        self.groups = []
+        for bkg in correlated_bkgs:
+            df_bkg = df_mc_prd_bkg.query(f"fPdgCodeBeautyMother == {bkg['beauty_id']} and "
+                                         f"fPdgCodeCharmMother == {bkg['charm_id']}")
+            order = np.argsort(df_bkg[name_score_var].to_numpy(), kind="stable")
+            self.groups.append({
+                "score": df_bkg[name_score_var].to_numpy()[order],
+                "pt": df_bkg[name_pt_var].to_numpy()[order],
+                "mass": df_bkg["fM"].to_numpy()[order],
+                "weight": bkg["br_pdg"] / bkg["br_sim"],
+            })
+
+    def __get_selected_indices(self, group, pt_range, score_range):
+        """
+        Get the indices of the candidates of a group with pt_range[0] < pT < pt_range[1]
+        and score_range[0] < ML_output < score_range[1] (None for no selection).
+        """
+        first, last = 0, len(group["score"])
+        if score_range is not None:
+            if score_range[0] is not None:
+                first = np.searchsorted(group["score"], score_range[0], side="right")
+            if score_range[1] is not None:
+                last = np.searchsorted(group["score"], score_range[1], side="left")
+        indices = np.arange(first, max(first, last))
+        if pt_range is not None:
+            pt_values = group["pt"][indices]
+            indices = indices[(pt_values > pt_range[0]) & (pt_values < pt_range[1])]
+        return indices
+
+    def get_fractions(self, den_norm, pt_range=None, score_range=None):
+        """
+        Get the fractions of the correlated backgrounds with respect to the signal.
+
+        Parameters:
+        den_norm (float): The normalisation of the signal (number of MC signal candidates x BR_pdg / BR_sim).
+        pt_range (list, optional): The (pT min, pT max) selection. Defaults to None.
+        score_range (list, optional): The (ML_output min, ML_output max) selection, None for open limits.
+            Defaults to None.
+
+        Returns:
+        list: The fraction of each correlated background.
+
+        """
+        return [len(self.__get_selected_indices(group, pt_range, score_range)) * group["weight"] / den_norm
+                for group in self.groups]
+
+    def get_template(self, den_norm, pt_range=None, score_range=None):
+        """
+        Get the weighted-average template of the correlated backgrounds, built sampling each
+        background with its normalised fraction.
+
+        Parameters:
+        den_norm (float): The normalisation of the signal (number of MC signal candidates x BR_pdg / BR_sim).
+        pt_range (list, optional): The (pT min, pT max) selection. Defaults to None.
+        score_range (list, optional): The (ML_output min, ML_output max) selection, None for open limits.
+            Defaults to None.
+
+        Returns:
+        pandas.DataFrame: The template (fM column).
+        list: The fraction of each correlated background.
+
+        """
+        rng = np.random.default_rng(self.seed)
+        selected_indices = [self.__get_selected_indices(group, pt_range, score_range) for group in self.groups]
+        fracs = [len(indices) * group["weight"] / den_norm for group, indices in zip(self.groups, selected_indices)]
+        sum_fracs = sum(fracs)
+
+        masses = []
+        for group, indices, frac in zip(self.groups, selected_indices, fracs):
+            n_sampled = int(round(frac / sum_fracs * len(indices))) if sum_fracs > 0 else 0
+            sampled = np.sort(rng.choice(indices, size=n_sampled, replace=False))
+            masses.append(group["mass"][sampled])
+
+        return pd.DataFrame({"fM": np.concatenate(masses)}), fracs
@@ -0,0 +1,96 @@
+"""Module containing a process runner enforcing a wall-clock budget on each task."""
+import multiprocessing
+import time
+import traceback
+from multiprocessing.connection import wait
+
+
+def run_task_in_process(task_function, args, i_attempt, connection):
+    """
+    Run a task in the current (child) process and send its outcome to the parent.
+
+    Parameters:
+    task_function (function): The task, called as task_function(args, i_attempt).
+    args (object): The arguments of the task.
+    i_attempt (int): The index of the attempt (0 for the first one).
+    connection (multiprocessing.connection.Connection): The connection to the parent.
+
+    """
+    try:
+        connection.send(("done", task_function(args, i_attempt)))
+    except Exception:  # pylint: disable=broad-exception-caught
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def run_tasks_with_timeout(task_function, tasks, max_workers, timeout=None, n_retries=0,
+                           setup=None, setup_args=()):
+    """
+    Run tasks in parallel, each in a new forked process that is killed if it exceeds its wall-clock budget,
+    so that a hanging task never blocks a worker. A timed-out task is retried up to n_retries times,
+    the task function gets the index of the attempt to change its settings (e.g. the initial parameters).
+    The outcomes are yielded as soon as available, in order of completion.
+
+    Parameters:
+    task_function (function): The task, called as task_function(args, i_attempt), it must be defined at module level.
+    tasks (list): The arguments of the tasks.
+    max_workers (int): The maximum number of tasks running at the same time.
+    timeout (float, optional): The wall-clock budget of each attempt in seconds. Defaults to None (no limit).
+    n_retries (int, optional): The number of retries of the timed-out tasks. Defaults to 0.
+    setup (function, optional): Function run once in the parent (not in the forked processes) before
+        the first task, to set the module-level state inherited by all the tasks (skipped without tasks).
+        Defaults to None.
+    setup_args (tuple, optional): The arguments of the setup function. Defaults to ().
+
+    Yields:
+    tuple: The index of the task, its status ("done", "error" or "timeout"), its result
+        (traceback for "error", None for "timeout") and the index of the last attempt.
+
+    """
+    context = multiprocessing.get_context("fork")
+    if setup is not None and len(tasks) > 0:
+        setup(*setup_args)
+
+    pending = [(i_task, 0) for i_task in reversed(range(len(tasks)))]
+    running = {}
+    while pending or running:
+        while pending and len(running) < max_workers:
+            i_task, i_attempt = pending.pop()
+            recv_connection, send_connection = context.Pipe(duplex=False)
+            process = context.Process(target=run_task_in_process,
+                                      args=(task_function, tasks[i_task], i_attempt, send_connection),
+                                      daemon=True)
+            process.start()
+            send_connection.close()
+            deadline = None if timeout is None else time.monotonic() + timeout
+            running[recv_connection] = (i_task, i_attempt, process, deadline)
+
+        deadlines = [deadline for *_, deadline in running.values() if deadline is not None]
+        wait_time = None if not deadlines else max(0., min(deadlines) - time.monotonic())
+        for connection in wait(list(running), timeout=wait_time):
+            i_task, i_attempt, process, _ = running.pop(connection)
+            try:
+                status, result = connection.recv()
+            except EOFError:
+                status, result = "error", None
+            connection.close()
+            process.join()
+            if status == "error" and result is None:
+                result = f"process exited with code {process.exitcode}"
+            yield i_task, status, result, i_attempt
+
+        now = time.monotonic()
+        for connection, (i_task, i_attempt, process, deadline) in list(running.items()):
+            if deadline is None or now < deadline:
+                continue
+            # the hanging process is killed and the slot is recycled
+            process.kill()
+            process.join()
+            connection.close()
+            del running[connection]
+            if i_attempt < n_retries:
+                pending.append((i_task, i_attempt + 1))
+            else:
+                yield i_task, "timeout", None, i_attempt